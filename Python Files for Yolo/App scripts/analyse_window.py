@@ -1,6 +1,7 @@
 import os
 import sys
 import cv2
+import numpy as np
 import subprocess
 import json
 from datetime import datetime
@@ -171,14 +172,13 @@ class AnalysisWindow(QWidget):
 
         for i, (name, model) in enumerate(self.models.items()):
             results = model(image)
-            boxes = getattr(results[0], "boxes", [])
-            for box in boxes:
-                try:
-                    cls = int(box.cls[0])
-                    label = model.names[cls]
-                except:
-                    label = getattr(box, "label", "cell")
-                combined_counts[label] = combined_counts.get(label, 0) + 1
+            boxes = getattr(results[0], "boxes", None)
+            if boxes is not None and len(boxes):
+                # Count every class in one go instead of box by box
+                classes, counts = np.unique(boxes.cls.cpu().numpy().astype(int), return_counts=True)
+                for cls, count in zip(classes.tolist(), counts.tolist()):
+                    label = model.names.get(cls, "cell")
+                    combined_counts[label] = combined_counts.get(label, 0) + count
             try:
                 annotated_image = results[0].plot()
             except:
@@ -3,8 +3,12 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 import os
 import sys
 from PyQt6.QtCore import QThread, pyqtSignal
-from ultralytics import YOLO
 import cv2
+import numpy as np
+
+# Shared model registry (pythonbackend/model_registry.py): models load on first use
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "pythonbackend"))
+from model_registry import registry_from_paths
 
 def resource_path(rel):
     try:
@@ -46,17 +50,8 @@ def resolve_model(folder_name):
 
 class CellDetector:
     def __init__(self):
-        self.models = {}
-        for name, folder in MODEL_DIRS.items():
-            path = resolve_model(folder)
-            if path and os.path.exists(path):
-                try:
-                    self.models[name] = YOLO(path)
-                    print(f"Loaded model: {name}")
-                except Exception as e:
-                    print("Error loading", name, e)
-            else:
-                print("Model not found:", name)
+        # Set BENTARA_MODEL_BACKEND=onnx to use the best.onnx exported next to each best.pt
+        self.models = registry_from_paths({name: resolve_model(folder) for name, folder in MODEL_DIRS.items()})
 
     def run_on_image(self, image_path):
         image = cv2.imread(image_path)
@@ -64,11 +59,10 @@ class CellDetector:
         annotated = image.copy()
         for name, model in self.models.items():
             results = model(image)
-            boxes = results[0].boxes
-            for box in boxes:
-                cls = int(box.cls[0])
+            classes, counts = np.unique(results[0].boxes.cls.cpu().numpy().astype(int), return_counts=True)
+            for cls, count in zip(classes.tolist(), counts.tolist()):
                 label = model.names[cls]
-                combined[label] = combined.get(label, 0) + 1
+                combined[label] = combined.get(label, 0) + count
             annotated = results[0].plot()  # returns annotated image (numpy)
         # save annotated to unique file
         out_path = os.path.join(os.path.dirname(__file__), "annotated_last.jpg")
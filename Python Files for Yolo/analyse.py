@@ -2,8 +2,12 @@ import sys
 import os
 import json
 import cv2
+import numpy as np
 from datetime import datetime
-from ultralytics import YOLO
+
+# Shared model registry (pythonbackend/model_registry.py): models load on first use
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "pythonbackend"))
+from model_registry import registry_from_paths
 
 # --------------------------------------------------------------------
 # CONFIGURATION: Paths to YOLO models
@@ -18,15 +22,11 @@ MODEL_PATHS = {
 }
 
 # --------------------------------------------------------------------
-# LOAD MODELS
+# REGISTER MODELS
 # --------------------------------------------------------------------
-MODELS = {}
-for name, path in MODEL_PATHS.items():
-    if os.path.exists(path):
-        print(f"Loading model: {name}")
-        MODELS[name] = YOLO(path)
-    else:
-        print(f"⚠️ Model file missing: {path}")
+# Set BENTARA_MODEL_BACKEND=onnx to run the best.onnx exported next to each
+# best.pt (see pythonbackend/export_onnx.py) through ONNX Runtime instead
+MODELS = registry_from_paths(MODEL_PATHS)
 
 # --------------------------------------------------------------------
 # ANALYSIS FUNCTION
@@ -48,24 +48,28 @@ def run_analysis(image_path: str):
         results = model(image, conf=0.25, imgsz=640, verbose=False)
         result = results[0]
 
-        for box in result.boxes:
-            cls_id = int(box.cls[0])
-            conf = float(box.conf[0])
-            label = f"{model_name}_{model.names[cls_id]}"
-            xyxy = [float(x) for x in box.xyxy[0]]
+        # Pull the whole result out as arrays instead of converting box by box
+        boxes = result.boxes
+        xyxy = boxes.xyxy.cpu().numpy().tolist()
+        confs = boxes.conf.cpu().numpy().astype(np.float64).round(3).tolist()
+        names = np.array([f"{model_name}_{model.names[c]}" for c in range(len(model.names))], dtype=object)
+        labels = names[boxes.cls.cpu().numpy().astype(int)]
 
+        for label, conf, (x1, y1, x2, y2) in zip(labels.tolist(), confs, xyxy):
             all_detections.append({
                 "label": label,
-                "confidence": round(conf, 3),
+                "confidence": conf,
                 "box": {
-                    "x1": xyxy[0],
-                    "y1": xyxy[1],
-                    "x2": xyxy[2],
-                    "y2": xyxy[3]
+                    "x1": x1,
+                    "y1": y1,
+                    "x2": x2,
+                    "y2": y2
                 }
             })
 
-            cell_counts[label] = cell_counts.get(label, 0) + 1
+        unique, counts = np.unique(labels.astype(str), return_counts=True)
+        for label, count in zip(unique.tolist(), counts.tolist()):
+            cell_counts[label] = cell_counts.get(label, 0) + count
 
     # ----------------------------------------------------------------
     # Annotated output
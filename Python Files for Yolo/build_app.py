@@ -48,6 +48,9 @@ cmd = [
     "--windowed",
     "--name",
     exe_name,
+    # The shared model registry is imported from pythonbackend/
+    "--paths",
+    os.path.join(BASE_PATH, "..", "pythonbackend"),
     MAIN_SCRIPT
 ] + add_data_args
 
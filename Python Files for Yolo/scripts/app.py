@@ -12,11 +12,15 @@ from datetime import datetime
 from fastapi import FastAPI, File, UploadFile, Form
 from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from ultralytics import YOLO
 from reportlab.lib.pagesizes import A4
 from reportlab.pdfgen import canvas
 from reportlab.lib.utils import ImageReader
 from PIL import Image
+import sys
+
+# Shared model registry (pythonbackend/model_registry.py): models load on first use
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "pythonbackend"))
+from model_registry import registry_from_paths
 
 # ==========================================================
 # INITIALIZE FASTAPI APP
@@ -49,19 +53,9 @@ MODEL_PATHS = {
 }
 
 # ==========================================================
-# LOAD YOLO MODELS INTO MEMORY
+# REGISTER YOLO MODELS (each loads on first use)
 # ==========================================================
-MODELS = {}
-for cell_type, path in MODEL_PATHS.items():
-    if os.path.exists(path):
-        try:
-            model = YOLO(path)
-            MODELS[cell_type] = model
-            print(f"✅ Loaded {cell_type} model from {path}")
-        except Exception as e:
-            print(f"❌ Failed to load {cell_type} model: {e}")
-    else:
-        print(f"⚠️ Model not found for {cell_type} at {path}")
+MODELS = registry_from_paths(MODEL_PATHS)
 
 if not MODELS:
     raise RuntimeError("❌ No YOLO models loaded. Check model paths!")
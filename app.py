@@ -1,11 +1,15 @@
 import streamlit as st
-from ultralytics import YOLO
 from collections import Counter
 import cv2
 import os
 import pandas as pd
 import glob
 import numpy as np
+import sys
+
+# Shared model registry (pythonbackend/model_registry.py): models load on first use
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "pythonbackend"))
+from model_registry import registry_from_paths
 
 # -----------------------------
 # Model paths
@@ -19,15 +23,9 @@ MODEL_PATHS = {
 }
 
 # -----------------------------
-# Load multiple models (safe)
+# Register models (each loads on first use)
 # -----------------------------
-MODELS = {}
-for name, path in MODEL_PATHS.items():
-    if os.path.exists(path):
-        MODELS[name] = YOLO(path)
-        print(f"✅ Loaded {name} model from {path}")
-    else:
-        print(f"⚠️ Skipping {name}, model not found at {path}")
+MODELS = registry_from_paths(MODEL_PATHS)
 
 if not MODELS:
     raise RuntimeError("❌ No models could be loaded. Check your paths in MODEL_PATHS.")
@@ -67,8 +65,14 @@ def run_models_on_image(img_path):
     merged_counts = Counter()
     annotated_frames = []
 
+    # Decode once and hand the same array to every model
+    image = cv2.imread(img_path)
+    if image is None:
+        # predict() would fail on None deep inside ultralytics, without naming the file
+        raise ValueError(f"Could not read {os.path.basename(img_path)} as an image")
+
     for model_name, model in MODELS.items():
-        results = model.predict(source=img_path, conf=0.25, save=False, verbose=False)
+        results = model.predict(source=image, conf=0.25, save=False, verbose=False)
         result = results[0]
 
         # Count detections
@@ -106,7 +110,11 @@ if mode == "Upload Images":
             with open(img_path, "wb") as f:
                 f.write(uploaded_file.getbuffer())
 
-            counts, annotated_img = run_models_on_image(img_path)
+            try:
+                counts, annotated_img = run_models_on_image(img_path)
+            except ValueError as e:
+                st.error(f"❌ {e}. Is it a valid JPG or PNG file?")
+                continue
 
             # Show annotated image
             st.image(cv2.cvtColor(annotated_img, cv2.COLOR_BGR2RGB),
@@ -134,15 +142,22 @@ elif mode == "Process Folder":
                       glob.glob(os.path.join(folder_path, "*.png")) + \
                       glob.glob(os.path.join(folder_path, "*.jpeg"))
 
+        skipped = []
         for img_path in image_files:
             img_name = os.path.basename(img_path)
-            counts, _ = run_models_on_image(img_path)
+            try:
+                counts, _ = run_models_on_image(img_path)
+            except ValueError:
+                skipped.append(img_name)
+                continue
 
             row = {"image": img_name}
             row.update(counts)
             results_data.append(row)
 
-        st.success(f"Processed {len(image_files)} images from {folder_path}")
+        st.success(f"Processed {len(image_files) - len(skipped)} images from {folder_path}")
+        if skipped:
+            st.warning(f"⚠️ Skipped {len(skipped)} unreadable images: {', '.join(skipped)}")
 
 # -----------------------------
 # Results Table + CSV Download
@@ -0,0 +1,141 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict
+
+# --- TOKEN SETTINGS ---
+# Access tokens are HS256 JWTs signed with this secret. Without one set, a random
+# secret is generated once and kept in BENTARA_TOKEN_SECRET_FILE, so every worker
+# process and restart accepts the same tokens.
+TOKEN_SECRET = os.environ.get("BENTARA_TOKEN_SECRET", "")
+TOKEN_SECRET_FILE = os.environ.get("BENTARA_TOKEN_SECRET_FILE", ".token_secret")
+TOKEN_TTL_SECONDS = int(os.environ.get("BENTARA_TOKEN_TTL_SECONDS", str(8 * 3600)))  # One shift
+# Profiles (full name, email, licence) looked up by username, kept this long
+USER_CACHE_SECONDS = float(os.environ.get("BENTARA_USER_CACHE_SECONDS", "60"))
+USER_CACHE_SIZE = int(os.environ.get("BENTARA_USER_CACHE_SIZE", "1024"))
+
+
+class TokenError(Exception):
+    pass
+
+
+def load_secret(secret=TOKEN_SECRET, path=TOKEN_SECRET_FILE):
+    if secret:
+        return secret.encode()
+    try:
+        with open(path, "rb") as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+
+    # Written to a private temp file, then linked into place: the link fails if another
+    # worker got there first (then its secret is used), and no one can read a half
+    # written file
+    new_secret = secrets.token_hex(32).encode()
+    temp_path = f"{path}.{os.getpid()}.{secrets.token_hex(4)}"
+    fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(new_secret)
+        os.link(temp_path, path)
+        print(f"🔑 Generated a new secret in {path}")
+        return new_secret
+    except FileExistsError:
+        with open(path, "rb") as f:
+            return f.read().strip()
+    finally:
+        os.remove(temp_path)
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+
+def b64decode(data):
+    return base64.urlsafe_b64decode(data + b"=" * (-len(data) % 4))
+
+
+# --- SIGNED TOKENS ---
+# header.payload.signature, the payload carrying the user id, username, role and the
+# user's token version. Changing the password bumps the version, which revokes every
+# token issued before it (see check_token_version).
+HEADER = b64encode(json.dumps({"alg": "HS256", "typ": "JWT"}, separators=(",", ":")).encode())
+
+
+def create_token(secret, user_id, username, role, version=0, ttl=TOKEN_TTL_SECONDS):
+    now = int(time.time())
+    payload = {"sub": username, "uid": user_id, "role": role, "ver": version, "iat": now, "exp": now + ttl}
+    signing_input = HEADER + b"." + b64encode(json.dumps(payload, separators=(",", ":")).encode())
+    signature = hmac.new(secret, signing_input, hashlib.sha256).digest()
+    return (signing_input + b"." + b64encode(signature)).decode()
+
+
+def verify_token(secret, token):
+    try:
+        header, payload, signature = token.encode().split(b".")
+        expected = hmac.new(secret, header + b"." + payload, hashlib.sha256).digest()
+        if header != HEADER or not hmac.compare_digest(b64decode(signature), expected):
+            raise TokenError("Invalid token")
+        claims = json.loads(b64decode(payload))
+    except (ValueError, UnicodeError):
+        raise TokenError("Invalid token")
+
+    if not isinstance(claims, dict) or not isinstance(claims.get("exp"), (int, float)):
+        raise TokenError("Invalid token")
+    if claims["exp"] < time.time():
+        raise TokenError("Token expired")
+    return claims
+
+
+def check_token_version(claims, current_version):
+    # current_version: the user's token_version now, None if the user is gone.
+    # Tokens from before versions existed count as version 0.
+    if current_version is None or claims.get("ver", 0) != current_version:
+        raise TokenError("Token revoked")
+
+
+# --- USER CACHE ---
+# Small TTL + LRU cache for the user lookups that remain. Entries are dropped when
+# the profile changes (/users/update) and expire anyway after max_age seconds.
+class UserCache:
+    def __init__(self, max_age=USER_CACHE_SECONDS, max_entries=USER_CACHE_SIZE):
+        self.max_age = max_age
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # username -> (expires at, user)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, username):
+        # The cached user, or None on a miss (the caller loads it and put()s it)
+        with self._lock:
+            entry = self._entries.get(username)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(username)
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+            return None
+
+    def put(self, username, user):
+        if user is None or self.max_age <= 0:
+            return
+        with self._lock:
+            self._entries[username] = (time.monotonic() + self.max_age, user)
+            self._entries.move_to_end(username)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username):
+        with self._lock:
+            self._entries.pop(username, None)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "max_age_seconds": self.max_age}
@@ -0,0 +1,79 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import torch
+
+
+# --- DYNAMIC MICRO-BATCHING ---
+# One scheduler thread per model. The first request to arrive opens a window of
+# window_ms; everything else that arrives inside it (up to max_batch) is stacked
+# into a single batched forward pass, and each caller gets its own slice back.
+# A lone request only ever waits window_ms, so latency stays bounded when idle.
+# Requests carry a key (e.g. the model version they were pinned to) and only
+# requests with the same key are batched together.
+class MicroBatcher:
+    def __init__(self, forward, window_ms=20, max_batch=8, name="model"):
+        # forward(batch_tensor, key) -> list with one output per batch item
+        self.forward = forward
+        self.window = window_ms / 1000.0
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self.batches_run = 0
+        self.items_run = 0
+
+        threading.Thread(target=self._loop, name=f"batcher-{name}", daemon=True).start()
+
+    def submit(self, tensor, key=None):
+        # tensor: (1, 3, H, W). Returns a Future resolving to this item's output.
+        future = Future()
+        self._queue.put((tensor, key, future))
+        return future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _loop(self):
+        while True:
+            self._run(self._collect())
+
+    def _run(self, batch):
+        # Separate method so nothing (e.g. a swapped-out model used as key) stays
+        # referenced while the loop sits waiting for the next request.
+        # Only tensors of the same shape (and key) can be stacked together.
+        groups = {}
+        for tensor, key, future in batch:
+            groups.setdefault((tuple(tensor.shape), key), []).append((tensor, future))
+
+        for (_, key), items in groups.items():
+            futures = [f for _, f in items]
+            try:
+                outputs = self.forward(torch.cat([t for t, _ in items]), key)
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            self.batches_run += 1
+            self.items_run += len(items)
+            for future, output in zip(futures, outputs):
+                future.set_result(output)
+
+    def stats(self):
+        return {
+            "pending": self._queue.qsize(),
+            "batches_run": self.batches_run,
+            "avg_batch_size": round(self.items_run / self.batches_run, 2) if self.batches_run else 0.0
+        }
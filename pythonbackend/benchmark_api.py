@@ -0,0 +1,369 @@
+import json
+import os
+import random
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import cv2
+import numpy as np
+import requests
+
+# --- API LOAD TEST ---
+# python benchmark_api.py
+#
+# Starts the backend (uvicorn main:app) in a throwaway folder with its own empty
+# database, uploads folder and small randomly initialised YOLOv8n models, replays a
+# mix of clinical traffic against it and writes throughput and p50/p95/p99 latency
+# per endpoint as JSON. Runs offline on CPU; every BENTARA_* setting in the
+# environment is passed through, so two runs (or two commits) can be compared.
+
+DURATION = float(os.environ.get("BENCH_DURATION", "60"))  # Seconds of traffic
+CONCURRENCY = int(os.environ.get("BENCH_CONCURRENCY", "8"))  # Simulated clients
+PATIENTS = int(os.environ.get("BENCH_PATIENTS", "50"))
+SEED_UPLOADS = int(os.environ.get("BENCH_SEED_UPLOADS", "4"))  # Reports that exist before traffic starts
+# Folder of smear images to upload (e.g. a TXL-PBC split); synthetic smears if empty
+IMAGE_DIR = os.environ.get("BENCH_IMAGES", "")
+# Use these weights folder instead of random YOLOv8n stand-ins (e.g. "models")
+MODEL_DIR = os.environ.get("BENCH_MODEL_DIR", "")
+STUB_MODELS = int(os.environ.get("BENCH_STUB_MODELS", "2"))  # How many of STUB_MODEL_FILES get a stand-in
+# 1 = every upload is a new image; 0 = repeats allowed, so the result cache answers some
+UNIQUE_UPLOADS = os.environ.get("BENCH_UNIQUE_UPLOADS", "1") == "1"
+OUTPUT_DIR = os.environ.get("BENCH_OUTPUT_DIR", "benchmarks")
+STARTUP_TIMEOUT = 300
+SEED = 0
+
+# Relative weight of each request in the replayed traffic: consultants mostly poll
+# their worklist and open reports, technicians upload slides
+TRAFFIC_MIX = {
+    "POST /upload": 1,
+    "GET /reports/pending": 4,
+    "GET /patients/{id}": 2,
+    "GET /reports/{id}": 3
+}
+
+# Same names as MODEL_FILES in engine.py, detector first
+STUB_MODEL_FILES = ["blood_cell_best.pt", "neutrophil_best.pt", "lymphocyte_best.pt", "monocyte_best.pt",
+                    "eosinophil_best.pt"]
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp")
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile_ms(latencies, q):
+    return round(float(np.percentile(latencies, q)) * 1000, 2) if latencies else None
+
+
+def synthetic_smear(rng, width=1024, height=768):
+    # Pale background, a few hundred RBC discs and the odd stained WBC, so decode,
+    # letterbox and JPEG sizes are close to a real smear photo
+    image = np.full((height, width, 3), (205, 190, 230), dtype=np.uint8)
+    for _ in range(rng.randint(150, 300)):
+        centre = (rng.randrange(width), rng.randrange(height))
+        cv2.circle(image, centre, rng.randint(14, 20), (150, 120, 215), -1)
+        cv2.circle(image, centre, rng.randint(5, 8), (185, 165, 225), -1)
+    for _ in range(rng.randint(1, 4)):
+        centre = (rng.randrange(width), rng.randrange(height))
+        cv2.circle(image, centre, rng.randint(24, 32), (140, 60, 110), -1)
+    noise = np.random.default_rng(rng.randrange(2 ** 32)).integers(0, 12, image.shape, dtype=np.uint8)
+    ok, buffer = cv2.imencode(".jpg", cv2.add(image, noise), [cv2.IMWRITE_JPEG_QUALITY, 90])
+    return buffer.tobytes()
+
+
+def load_images(rng):
+    if IMAGE_DIR:
+        paths = sorted(os.path.join(IMAGE_DIR, f) for f in os.listdir(IMAGE_DIR) if f.lower().endswith(IMAGE_EXTS))
+        if not paths:
+            raise RuntimeError(f"No images found in {IMAGE_DIR}")
+        images = []
+        for path in paths[:200]:
+            with open(path, "rb") as f:
+                images.append((os.path.basename(path), f.read()))
+        return images
+    return [(f"smear_{i}.jpg", synthetic_smear(rng)) for i in range(20)]
+
+
+def prepare_models(model_dir):
+    os.makedirs(model_dir, exist_ok=True)
+    if MODEL_DIR:
+        for name in os.listdir(MODEL_DIR):
+            shutil.copy(os.path.join(MODEL_DIR, name), model_dir)
+        return
+
+    # Untrained YOLOv8n built from its yaml: no download, real forward-pass cost
+    from ultralytics import YOLO
+    stub = os.path.join(model_dir, "stub.pt")
+    YOLO("yolov8n.yaml").save(stub)
+    for name in STUB_MODEL_FILES[:STUB_MODELS]:
+        shutil.copy(stub, os.path.join(model_dir, name))
+    os.remove(stub)
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = {}  # endpoint -> [seconds]
+        self.statuses = {}  # endpoint -> {status code: count}
+        self._lock = threading.Lock()
+
+    def record(self, endpoint, seconds, status):
+        with self._lock:
+            self.latencies.setdefault(endpoint, []).append(seconds)
+            codes = self.statuses.setdefault(endpoint, {})
+            codes[status] = codes.get(status, 0) + 1
+
+    def summary(self, elapsed):
+        endpoints = {}
+        for endpoint, latencies in sorted(self.latencies.items()):
+            codes = self.statuses[endpoint]
+            errors = sum(n for code, n in codes.items() if code == "error" or int(code) >= 400)
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "errors": errors,
+                "throughput_rps": round(len(latencies) / elapsed, 2),
+                "p50_ms": percentile_ms(latencies, 50),
+                "p95_ms": percentile_ms(latencies, 95),
+                "p99_ms": percentile_ms(latencies, 99),
+                "mean_ms": round(sum(latencies) / len(latencies) * 1000, 2),
+                "max_ms": round(max(latencies) * 1000, 2),
+                "status_codes": {str(code): n for code, n in sorted(codes.items(), key=str)}
+            }
+        return endpoints
+
+
+class LoadTest:
+    def __init__(self, base_url, images, rng):
+        self.base_url = base_url
+        self.images = images
+        self.rng = rng
+        self.stats = Stats()
+        self.headers = {}
+        self.patient_ids = []
+        self.report_ids = []
+        self.jobs = {}  # job id -> upload time
+        self.analysis_seconds = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def session(self):
+        # One keep-alive connection per client thread, like a browser tab
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def request(self, endpoint, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            response = self.session().request(method, self.base_url + path, headers=self.headers, timeout=120,
+                                              **kwargs)
+        except requests.RequestException:
+            self.stats.record(endpoint, time.perf_counter() - start, "error")
+            return None
+        self.stats.record(endpoint, time.perf_counter() - start, response.status_code)
+        return response
+
+    # --- Setup ---
+    def wait_ready(self, server):
+        deadline = time.time() + STARTUP_TIMEOUT
+        while time.time() < deadline:
+            if server.poll() is not None:
+                raise RuntimeError(f"Backend exited during startup (code {server.returncode})")
+            try:
+                if requests.get(self.base_url + "/health/ready", timeout=2).status_code == 200:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(0.5)
+        raise RuntimeError("Backend did not become ready in time")
+
+    def setup(self):
+        requests.post(self.base_url + "/register", json={
+            "username": "bench_consultant", "password": "bench", "full_name": "Bench Consultant",
+            "email": "bench@example.org", "role": "Consultant", "license_id": "BENCH-001"}).raise_for_status()
+        token = requests.post(self.base_url + "/token",
+                              data={"username": "bench_consultant", "password": "bench"}).json()["access_token"]
+        self.headers = {"Authorization": f"Bearer {token}"}
+
+        for i in range(PATIENTS):
+            response = requests.post(self.base_url + "/patients/register", json={
+                "name": f"Patient {i}", "mrn": f"BENCH{i:05d}", "nhs_number": f"{9000000000 + i}",
+                "dob": "1980-01-01", "gender": "F" if i % 2 else "M"})
+            response.raise_for_status()
+            self.patient_ids.append(response.json()["id"])
+
+        for _ in range(SEED_UPLOADS):
+            self.upload()
+        self.drain_jobs(STARTUP_TIMEOUT)
+        # Seeding is not part of the measured run
+        self.stats = Stats()
+        self.analysis_seconds = []
+
+    # --- Traffic ---
+    def upload(self):
+        name, data = self.rng.choice(self.images)
+        if UNIQUE_UPLOADS:
+            # Bytes after the JPEG end marker change the hash (so the result cache
+            # misses) without changing the decoded image
+            data += os.urandom(16)
+        response = self.request("POST /upload", "POST", "/upload",
+                                files={"file": (name, data, "image/jpeg")},
+                                data={"patient_id": self.rng.choice(self.patient_ids), "sample_date": "2024-01-01",
+                                      "assigned_to_id": "BENCH-001"})
+        if response is not None and response.ok:
+            body = response.json()
+            with self._lock:
+                self.report_ids.append(body["report_id"])
+                if body["job_id"]:
+                    self.jobs[body["job_id"]] = time.perf_counter()
+
+    def drain_jobs(self, timeout):
+        # Polls every outstanding job, recording upload -> analysed latency
+        deadline = time.time() + timeout
+        while self.jobs and time.time() < deadline:
+            with self._lock:
+                outstanding = list(self.jobs.items())
+            for job_id, started in outstanding:
+                response = requests.get(f"{self.base_url}/jobs/{job_id}", headers=self.headers, timeout=10)
+                if response.status_code == 404 or response.json()["status"] in ("done", "failed"):
+                    with self._lock:
+                        self.jobs.pop(job_id, None)
+                        self.analysis_seconds.append(time.perf_counter() - started)
+            time.sleep(0.2)
+
+    def poll_jobs(self, stop):
+        while not stop.is_set():
+            self.drain_jobs(0.5)
+            stop.wait(0.5)
+
+    def step(self):
+        endpoint = self.rng.choices(list(TRAFFIC_MIX), weights=list(TRAFFIC_MIX.values()))[0]
+        if endpoint == "POST /upload":
+            self.upload()
+        elif endpoint == "GET /reports/pending":
+            self.request(endpoint, "GET", "/reports/pending")
+        elif endpoint == "GET /patients/{id}":
+            self.request(endpoint, "GET", f"/patients/{self.rng.choice(self.patient_ids)}")
+        elif self.report_ids:
+            self.request(endpoint, "GET", f"/reports/{self.rng.choice(self.report_ids)}")
+
+    def client(self, deadline):
+        while time.perf_counter() < deadline:
+            self.step()
+
+    def run(self):
+        stop = threading.Event()
+        poller = threading.Thread(target=self.poll_jobs, args=(stop,), daemon=True)
+        poller.start()
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(CONCURRENCY) as pool:
+            for _ in range(CONCURRENCY):
+                pool.submit(self.client, start + DURATION)
+        elapsed = time.perf_counter() - start
+
+        stop.set()
+        poller.join()
+        pending = len(self.jobs)
+        self.drain_jobs(STARTUP_TIMEOUT)
+        return elapsed, pending
+
+    def server_stages(self):
+        # Mean time per stage from the backend's own /metrics histograms
+        text = requests.get(self.base_url + "/metrics", timeout=10).text
+        sums, counts = {}, {}
+        for line in text.splitlines():
+            if line.startswith(("bentara_stage_seconds_sum", "bentara_stage_seconds_count")):
+                series, value = line.rsplit(" ", 1)
+                kind, labels = series.split("{", 1)
+                labels = dict(pair.split("=", 1) for pair in labels.rstrip("}").split(","))
+                key = "/".join(v.strip('"') for v in (labels["path"], labels["stage"], labels["model"]) if v != '""')
+                (sums if kind.endswith("_sum") else counts)[key] = float(value)
+        return {key: {"count": int(counts[key]), "mean_ms": round(sums[key] / counts[key] * 1000, 2)}
+                for key in sorted(sums) if counts.get(key)}
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark():
+    rng = random.Random(SEED)
+    images = load_images(rng)
+    work_dir = tempfile.mkdtemp(prefix="bentara_bench_")
+    port = free_port()
+    print(f"🧪 Benchmark folder: {work_dir}")
+
+    try:
+        prepare_models(os.path.join(work_dir, "models"))
+        # Relative paths in main.py (bentara.db, uploads, models) resolve in work_dir
+        env = {**os.environ, "BENTARA_INFERENCE_SERVER": os.environ.get("BENTARA_INFERENCE_SERVER", "")}
+        server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--app-dir", BACKEND_DIR,
+                                   "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning"],
+                                  cwd=work_dir, env=env)
+        try:
+            test = LoadTest(f"http://127.0.0.1:{port}", images, rng)
+            print("⏳ Waiting for the backend to load its models...")
+            test.wait_ready(server)
+            test.setup()
+
+            print(f"🚀 Replaying traffic: {CONCURRENCY} clients for {DURATION:.0f}s")
+            elapsed, pending = test.run()
+            stages = test.server_stages()
+        finally:
+            server.terminate()
+            server.wait(timeout=30)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    analysis = test.analysis_seconds
+    results = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(),
+        "config": {
+            "duration_s": DURATION, "concurrency": CONCURRENCY, "patients": PATIENTS,
+            "images": IMAGE_DIR or "synthetic", "models": MODEL_DIR or f"{STUB_MODELS} random yolov8n",
+            "unique_uploads": UNIQUE_UPLOADS, "traffic_mix": TRAFFIC_MIX,
+            "settings": {k: v for k, v in sorted(os.environ.items()) if k.startswith("BENTARA_")}
+        },
+        "elapsed_s": round(elapsed, 2),
+        "endpoints": test.stats.summary(elapsed),
+        # Upload accepted -> job finished, for the slides uploaded during the run
+        "analysis": {
+            "slides": len(analysis),
+            "still_queued_at_end": pending,
+            "p50_ms": percentile_ms(analysis, 50),
+            "p95_ms": percentile_ms(analysis, 95),
+            "p99_ms": percentile_ms(analysis, 99)
+        },
+        "server_stages": stages
+    }
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    output = os.path.join(OUTPUT_DIR, f"api_{results['commit'] or 'nogit'}_{datetime.now():%Y%m%d_%H%M%S}.json")
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{'endpoint':<24}{'req/s':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'errors':>8}")
+    for endpoint, s in results["endpoints"].items():
+        print(f"{endpoint:<24}{s['throughput_rps']:>8}{s['p50_ms']:>10}{s['p95_ms']:>10}{s['p99_ms']:>10}{s['errors']:>8}")
+    print(f"✅ Results written to {output}")
+    return results
+
+
+if __name__ == "__main__":
+    run_benchmark()
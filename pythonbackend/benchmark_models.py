@@ -0,0 +1,163 @@
+import json
+import multiprocessing as mp
+import os
+import time
+from datetime import datetime
+
+from benchmark_api import IMAGE_EXTS, git_commit, percentile_ms
+
+try:
+    import resource
+except ImportError:  # Not on Windows
+    resource = None
+
+# --- OFFLINE ENSEMBLE BENCHMARK ---
+# python benchmark_models.py
+#
+# Runs the backend's own analysis (engine.analyse_image) over a folder of slides for
+# every backend x input size, each in a fresh process so its peak RSS is its own.
+# Reports images/second and where the time goes (decode, per-model preprocess /
+# forward / postprocess, fusion) as JSON plus a comparison table, to pick the engine
+# to deploy. Models come from 'models' like in the API (export_onnx.py and
+# quantize_models.py produce the onnx / int8 ones).
+
+# Same split predict_yolo.py runs on
+IMAGE_DIR = os.environ.get("BENCH_IMAGES", os.path.join("..", "Datasets", "TXL-PBC_Dataset-master", "TXL-PBC",
+                                                        "images", "test"))
+BACKENDS = os.environ.get("BENCH_BACKENDS", "torch,onnx,int8").split(",")
+IMAGE_SIZES = [int(size) for size in os.environ.get("BENCH_IMGSZ", "640").split(",")]
+MAX_IMAGES = int(os.environ.get("BENCH_MAX_IMAGES", "100"))  # 0 = the whole folder
+WARMUP_IMAGES = 2  # Untimed, after the dummy-tensor warm up
+OUTPUT_DIR = os.environ.get("BENCH_OUTPUT_DIR", "benchmarks")
+
+
+def image_paths():
+    if not os.path.isdir(IMAGE_DIR):
+        raise RuntimeError(f"Image folder not found: {IMAGE_DIR} (set BENCH_IMAGES)")
+    paths = sorted(os.path.join(IMAGE_DIR, f) for f in os.listdir(IMAGE_DIR) if f.lower().endswith(IMAGE_EXTS))
+    if not paths:
+        raise RuntimeError(f"No images found in {IMAGE_DIR}")
+    return paths[:MAX_IMAGES] if MAX_IMAGES else paths
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if resource else None
+
+
+def stage_summary(samples):
+    # samples: [seconds] of one stage, one per image
+    return {"mean_ms": round(sum(samples) / len(samples) * 1000, 2), "p50_ms": percentile_ms(samples, 50),
+            "p95_ms": percentile_ms(samples, 95)}
+
+
+def bench_config(backend, imgsz, paths):
+    # Runs in its own process: engine reads its settings from the environment on import
+    os.environ["BENTARA_MODEL_BACKEND"] = backend
+    os.environ.pop("BENTARA_MODEL_BACKENDS", None)
+    # Images go through one at a time, so a micro-batcher would only add its window
+    os.environ["BENTARA_MAX_BATCH"] = "1"
+    import torch
+    import engine
+
+    models = [name for name in engine.model_registry if name in engine.MODEL_FILES]
+    if not models:
+        return {"backend": backend, "imgsz": imgsz, "skipped": f"no {backend} models in 'models'"}
+
+    engine.runner.imgsz = imgsz
+    load_start = time.perf_counter()
+    for name in models:
+        engine.warm_up_model(name, engine.model_registry.get(name))
+    load_seconds = time.perf_counter() - load_start
+    for path in paths[:WARMUP_IMAGES]:
+        engine.analyse_image(path)
+
+    stages = {}  # "stage" or "stage/model" -> [seconds per image]
+    wall = []
+    for path in paths:
+        start = time.perf_counter()
+        result = engine.analyse_image(path)
+        wall.append(time.perf_counter() - start)
+
+        per_image = {}
+        for stage, model, seconds in result["timings"]:
+            key = f"{stage}/{model}" if model else stage
+            per_image[key] = per_image.get(key, 0.0) + seconds
+        for key, seconds in per_image.items():
+            stages.setdefault(key, []).append(seconds)
+
+    return {
+        "backend": backend,
+        "imgsz": imgsz,
+        "inference_mode": engine.INFERENCE_MODE,
+        "models": {name: {"version": engine.model_registry.entry(name).label,
+                          "input_size": engine.runner.input_size(name)} for name in models},
+        "threads": torch.get_num_threads(),
+        "images": len(paths),
+        "load_and_warmup_s": round(load_seconds, 2),
+        "images_per_second": round(len(paths) / sum(wall), 2),
+        "per_image": stage_summary(wall),
+        "stages": {key: stage_summary(samples) for key, samples in sorted(stages.items())},
+        "peak_rss_mb": peak_rss_mb()
+    }
+
+
+def stage_total_ms(result, stage):
+    # Summed over models, per image
+    return round(sum(s["mean_ms"] for key, s in result["stages"].items() if key.split("/")[0] == stage), 2)
+
+
+def comparison_table(results):
+    header = f"| {'backend':<8} | {'imgsz':>5} | {'img/s':>6} | {'p50 ms':>8} | {'p95 ms':>8} | {'decode':>7} | " \
+             f"{'preproc':>7} | {'forward':>8} | {'postproc':>8} | {'fusion':>6} | {'peak RSS MB':>11} |"
+    lines = [header, "|" + "|".join("-" * len(cell) for cell in header.split("|")[1:-1]) + "|"]
+    for r in results:
+        if "skipped" in r:
+            lines.append(f"| {r['backend']:<8} | {r['imgsz']:>5} | skipped: {r['skipped']}")
+            continue
+        lines.append(
+            f"| {r['backend']:<8} | {r['imgsz']:>5} | {r['images_per_second']:>6} | {r['per_image']['p50_ms']:>8} | "
+            f"{r['per_image']['p95_ms']:>8} | {stage_total_ms(r, 'decode'):>7} | {stage_total_ms(r, 'preprocess'):>7} | "
+            f"{stage_total_ms(r, 'forward'):>8} | {stage_total_ms(r, 'postprocess'):>8} | "
+            f"{stage_total_ms(r, 'fusion'):>6} | {r['peak_rss_mb']:>11} |")
+    return "\n".join(lines)
+
+
+def run_benchmark():
+    paths = image_paths()
+    print(f"🧪 Benchmarking {len(paths)} images from {IMAGE_DIR}")
+
+    results = []
+    ctx = mp.get_context("spawn")
+    for backend in BACKENDS:
+        for imgsz in IMAGE_SIZES:
+            print(f"⏳ {backend} @ {imgsz}px...")
+            # A fresh process per configuration, so models and peak RSS don't carry over
+            with ctx.Pool(1) as pool:
+                try:
+                    result = pool.apply(bench_config, (backend, imgsz, paths))
+                except Exception as e:
+                    result = {"backend": backend, "imgsz": imgsz, "skipped": f"{type(e).__name__}: {e}"}
+            if "skipped" in result:
+                print(f"⚠️ Skipped {backend} @ {imgsz}px: {result['skipped']}")
+            results.append(result)
+
+    report = {"commit": git_commit(), "timestamp": datetime.now().isoformat(), "images": IMAGE_DIR,
+              "results": results}
+    table = comparison_table(results)
+
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    stem = os.path.join(OUTPUT_DIR, f"models_{report['commit'] or 'nogit'}_{datetime.now():%Y%m%d_%H%M%S}")
+    with open(stem + ".json", "w") as f:
+        json.dump(report, f, indent=2)
+    with open(stem + ".md", "w") as f:
+        f.write(table + "\n")
+
+    print("Per-image means in ms (preproc/forward/postproc summed over models):")
+    print(table)
+    print(f"✅ Results written to {stem}.json and {stem}.md")
+    return report
+
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,119 @@
+import asyncio
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# --- SQLITE SETTINGS ---
+# Milliseconds a writer waits for the lock before "database is locked"
+DB_BUSY_TIMEOUT_MS = int(os.environ.get("BENTARA_DB_BUSY_TIMEOUT_MS", "5000"))
+# Prepared statements kept per connection, keyed by SQL text
+DB_STATEMENT_CACHE = int(os.environ.get("BENTARA_DB_STATEMENT_CACHE", "256"))
+# NORMAL is durable in WAL mode except for the last commits before a power cut
+DB_SYNCHRONOUS = os.environ.get("BENTARA_DB_SYNCHRONOUS", "NORMAL")
+# Threads that run the async endpoints' queries (each keeps its own connection)
+DB_THREADS = int(os.environ.get("BENTARA_DB_THREADS", "4"))
+
+
+class PooledConnection:
+    # What ConnectionPool.connect() hands out. Behaves like the sqlite3 connection,
+    # except close() only ends an unfinished transaction: the connection stays open
+    # for the next request on this thread.
+    def __init__(self, conn):
+        self._conn = conn
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def close(self):
+        if self._conn.in_transaction:
+            self._conn.rollback()
+
+
+# --- CONNECTION POOL ---
+# One connection per thread (request threads, job workers, the event loop), opened
+# on first use and reused, so its prepared statements are reused too. In WAL mode
+# readers work from a snapshot and never wait for the report writer, and writers
+# queue on the busy timeout instead of failing straight away.
+class ConnectionPool:
+    def __init__(self, path, busy_timeout_ms=DB_BUSY_TIMEOUT_MS, statement_cache=DB_STATEMENT_CACHE,
+                 synchronous=DB_SYNCHRONOUS):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self.statement_cache = statement_cache
+        self.synchronous = synchronous
+        self.opened = 0
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+        # The journal mode is stored in the database file, so once is enough
+        conn = sqlite3.connect(path, timeout=busy_timeout_ms / 1000)
+        self.journal_mode = conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        conn.close()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000,
+                               cached_statements=self.statement_cache)
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        with self._lock:
+            self.opened += 1
+        return PooledConnection(conn)
+
+    def connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._open()
+        else:
+            # Left open by a request that raised before committing or closing
+            conn.close()
+        return conn
+
+    def stats(self):
+        return {"path": self.path, "journal_mode": self.journal_mode, "synchronous": self.synchronous,
+                "busy_timeout_ms": self.busy_timeout_ms, "connections_opened": self.opened}
+
+
+# --- ASYNC ACCESS ---
+# For async endpoints: queries run on a dedicated thread pool and are awaited, so a
+# lock wait or a slow write holds up that one request instead of the event loop and
+# every other request on it. Separate from the server's own threadpool, so queries
+# don't queue behind slow uploads.
+class AsyncDatabase:
+    def __init__(self, pool, threads=DB_THREADS):
+        self.pool = pool
+        self.threads = threads
+        self._executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix="db")
+        self._lock = threading.Lock()
+        self.pending = 0  # Submitted and not finished, queued or running
+
+    def _call(self, fn, args):
+        conn = self.pool.connect()
+        try:
+            return fn(conn, *args)
+        finally:
+            conn.close()  # Rolls back whatever fn didn't commit
+            with self._lock:
+                self.pending -= 1
+
+    async def run(self, fn, *args):
+        # fn(conn, *args) on a database thread; its result or exception comes back here
+        with self._lock:
+            self.pending += 1
+        return await asyncio.get_running_loop().run_in_executor(self._executor, self._call, fn, args)
+
+    async def fetchone(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql, params=()):
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql, params=()):
+        # One statement in its own transaction; returns the new row id for an INSERT
+        def execute(conn):
+            cursor = conn.execute(sql, params)
+            conn.commit()
+            return cursor.lastrowid
+        return await self.run(execute)
+
+    def stats(self):
+        return {"threads": self.threads, "pending": self.pending}
@@ -0,0 +1,160 @@
+import os
+
+import torch
+from ultralytics import YOLO
+
+from fusion import FUSION_IOU, fuse_detections
+from inference import CROP_IMGSZ, EnsembleRunner, PreparedImage, run_cascade, run_tiled
+from inference import MAX_IMAGE_PIXELS as DEFAULT_MAX_IMAGE_PIXELS
+from metrics import StageTimer
+from model_registry import ModelRegistry
+from onnx_engine import OnnxModel
+from postprocess import concat_detections, label_array, serialize_detections, summarize
+
+# --- MODEL + ANALYSIS CONFIGURATION ---
+# Shared by the API (main.py) and the pre-fork inference server (inference_server.py),
+# so both load the same models and analyse slides the same way.
+
+# "ensemble" runs every model on the full slide; "cascade" runs the blood-cell
+# detector once and only classifies the WBC crops with the subtype models;
+# "tiled" runs every model over overlapping native-resolution tiles of the slide
+INFERENCE_MODE = os.environ.get("BENTARA_INFERENCE_MODE", "ensemble")
+
+# Tiled mode settings (tile edge in px, fraction of overlap, tiles per forward pass)
+TILE_SIZE = int(os.environ.get("BENTARA_TILE_SIZE", "640"))
+TILE_OVERLAP = float(os.environ.get("BENTARA_TILE_OVERLAP", "0.2"))
+TILE_BATCH = int(os.environ.get("BENTARA_TILE_BATCH", "8"))
+
+# Largest slide accepted, in pixels (0 = no limit). Each slide is decoded whole, so
+# this bounds its memory: about 3 bytes per pixel, 300 MB at the default.
+MAX_IMAGE_PIXELS = int(os.environ.get("BENTARA_MAX_IMAGE_PIXELS", str(DEFAULT_MAX_IMAGE_PIXELS)))
+
+# Inference backend: "torch" (ultralytics/PyTorch), "onnx" (ONNX Runtime, CPU) or
+# "int8" (ONNX Runtime with the quantized weights published by quantize_models.py).
+# BENTARA_MODEL_BACKENDS overrides it per model, e.g. "blood_cell_best.pt=torch".
+# ONNX models come from export_onnx.py and sit next to the .pt files.
+MODEL_BACKEND = os.environ.get("BENTARA_MODEL_BACKEND", "torch")
+MODEL_BACKENDS = dict(item.split("=", 1) for item in os.environ.get("BENTARA_MODEL_BACKENDS", "").split(",") if item)
+# 0 = the same thread count torch has been given (see resources.py)
+ORT_INTRA_THREADS = int(os.environ.get("BENTARA_ORT_INTRA_THREADS", "0"))
+ORT_INTER_THREADS = int(os.environ.get("BENTARA_ORT_INTER_THREADS", "0"))
+ORT_OPTIMIZATION = os.environ.get("BENTARA_ORT_OPTIMIZATION", "all")
+
+# Pinned weight versions per model, e.g. "eosinophil_best.pt=v2" serves
+# models/eosinophil_best@v2.pt. Unpinned models use models/<name>.pt.
+MODEL_VERSIONS = dict(item.split("=", 1) for item in os.environ.get("BENTARA_MODEL_VERSIONS", "").split(",") if item)
+
+# Combined size of loaded models before the least recently used are evicted (0 = no limit)
+MODEL_MEMORY_MB = float(os.environ.get("BENTARA_MODEL_MEMORY_MB", "0"))
+
+# Models loading + warming up in parallel at startup (0 = load lazily on first use)
+WARMUP_WORKERS = int(os.environ.get("BENTARA_WARMUP_WORKERS", "4"))
+
+# Seconds between checks of the models folder for replaced weights (0 = only swap
+# through POST /models/{name}/swap)
+MODEL_WATCH_SECONDS = float(os.environ.get("BENTARA_MODEL_WATCH_SECONDS", "0"))
+
+# Concurrent slides arriving within the window share one batched forward pass per
+# model. A batch can never be bigger than the number of job workers feeding it.
+# Off (1) by default: batched slides are letterboxed to a square instead of the
+# minimal padding a lone slide gets, which can change detections, and every slide
+# waits out the window even on an idle server. Opt in for throughput under load.
+MAX_BATCH = int(os.environ.get("BENTARA_MAX_BATCH", "1"))
+BATCH_WINDOW_MS = float(os.environ.get("BENTARA_BATCH_WINDOW_MS", "20"))
+
+# --- LOAD MULTIPLE YOLO MODELS ---
+MODEL_FILES = [
+    "eosinophil_best.pt",
+    "lymphocyte_best.pt",
+    "monocyte_best.pt",
+    "neutrophil_best.pt",
+    "blood_cell_best.pt"
+]
+DETECTOR_MODEL = "blood_cell_best.pt"
+
+
+def load_model(path, backend):
+    if backend in ("onnx", "int8"):
+        return OnnxModel(path, intra_threads=ORT_INTRA_THREADS or torch.get_num_threads(),
+                         inter_threads=ORT_INTER_THREADS,
+                         optimization=ORT_OPTIMIZATION)
+    return YOLO(path)
+
+
+# Models are only registered here; each one loads on its first use and the least
+# recently used ones are evicted when MODEL_MEMORY_MB is exceeded
+model_registry = ModelRegistry(load_model, model_dir="models", default_backend=MODEL_BACKEND,
+                               memory_budget_mb=MODEL_MEMORY_MB)
+
+print("--- REGISTERING AI MODELS ---")
+for model_file in MODEL_FILES:
+    backend = MODEL_BACKENDS.get(model_file, MODEL_BACKEND)
+    version = MODEL_VERSIONS.get(model_file)
+
+    if model_registry.register(model_file, version=version, backend=backend):
+        print(f"✅ Registered: {model_file} ({backend}, version {version or 'default'})")
+    else:
+        print(f"⚠️ Warning: {model_file} not found in 'models' folder.")
+
+if not len(model_registry):
+    print("⚠️ No custom models found. Using generic 'yolov8n.pt' fallback.")
+    model_registry.register("yolov8n.pt", backend="torch", path="yolov8n.pt")
+
+if INFERENCE_MODE == "cascade" and DETECTOR_MODEL not in model_registry:
+    print(f"⚠️ Cascade mode needs {DETECTOR_MODEL}. Falling back to full ensemble.")
+    INFERENCE_MODE = "ensemble"
+
+# Every model shares one decoded image and one letterboxed tensor per input size
+runner = EnsembleRunner(model_registry, max_batch=MAX_BATCH, batch_window_ms=BATCH_WINDOW_MS)
+
+
+def warm_up_model(name, model):
+    # Warm each model at the size it will actually see: in cascade mode the subtype
+    # models only ever get WBC crops
+    sizes = [CROP_IMGSZ] if INFERENCE_MODE == "cascade" and name != DETECTOR_MODEL else None
+    runner.warmup(name, model, sizes)
+
+
+def analyse_image(file_path, progress=None):
+    # Runs the configured analysis on one slide image. Returns the report fields;
+    # progress(fraction) is called as each model finishes.
+    # The whole slide runs on the model versions live when it started, even if one
+    # is hot-swapped meanwhile. "timings" lists (stage, model, seconds) for /metrics.
+    timer = StageTimer()
+    models = model_registry.snapshot()
+    slide_runner = runner.with_models(models, timer)
+
+    # Image decoded once and shared by every model
+    with timer.stage("decode"):
+        prepared = PreparedImage.from_file(file_path, MAX_IMAGE_PIXELS)
+
+    if INFERENCE_MODE == "cascade":
+        xyxy, confs, labels = run_cascade(slide_runner, DETECTOR_MODEL, prepared)
+    else:
+        if INFERENCE_MODE == "tiled":
+            model_outputs = run_tiled(slide_runner, prepared, TILE_SIZE, TILE_OVERLAP, TILE_BATCH)
+        else:
+            model_outputs = slide_runner.run(prepared)
+
+        parts = []
+        for i, (model, xyxy, confs, classes) in enumerate(model_outputs):
+            parts.append((xyxy, confs, label_array(model.names, classes)))
+            if progress:
+                progress((i + 1) / len(models))
+
+        # The same cell is usually found by several models (e.g. "Neutrophil" and
+        # "WBC"), so fuse across models before counting
+        with timer.stage("fusion"):
+            xyxy, confs, labels = fuse_detections(*concat_detections(parts), FUSION_IOU)
+
+    with timer.stage("summarize"):
+        diagnosis, confidence = summarize(confs, labels)
+        detections = serialize_detections(xyxy, confs, labels, prepared.width, prepared.height,
+                                          models.label_sources())
+    return {
+        "diagnosis": diagnosis,
+        "confidence": confidence,
+        "detections": detections,
+        "model_versions": models.versions(),
+        "timings": timer.timings()
+    }
@@ -0,0 +1,37 @@
+import glob
+import os
+
+from ultralytics import YOLO
+
+# Backend weights (MODEL_FILES in main.py) plus every trained detector in the repo
+WEIGHT_PATTERNS = [
+    os.path.join("models", "*.pt"),
+    os.path.join("..", "Yolo Models", "detect", "*", "weights", "best.pt")
+]
+
+
+def export_all(imgsz=640, dynamic=True, simplify=True, opset=None):
+    # dynamic=True keeps batch and spatial dims free, so the ONNX models can take
+    # micro-batches, tile batches and WBC crop batches like the PyTorch ones
+    weights = sorted({path for pattern in WEIGHT_PATTERNS for path in glob.glob(pattern)})
+    if not weights:
+        print("⚠️ No .pt weights found to export.")
+        return []
+
+    exported = []
+    for path in weights:
+        print(f"📦 Exporting: {path}")
+        try:
+            onnx_path = YOLO(path).export(format="onnx", imgsz=imgsz, dynamic=dynamic,
+                                          simplify=simplify, opset=opset)
+            exported.append(onnx_path)
+            print(f"✅ Saved: {onnx_path}")
+        except Exception as e:
+            print(f"❌ Failed to export {path}: {e}")
+
+    print(f"✨ Exported {len(exported)}/{len(weights)} models to ONNX")
+    return exported
+
+
+if __name__ == "__main__":
+    export_all()
@@ -0,0 +1,162 @@
+import os
+
+import numpy as np
+
+
+# --- NON-MAXIMUM SUPPRESSION (NumPy) ---
+def nms(xyxy, scores, iou_threshold=0.5, classes=None):
+    # Greedy NMS, returns the indices to keep (highest score first).
+    # With classes given, boxes of different classes never suppress each other:
+    # each class is shifted into its own coordinate range, as torchvision does.
+    if len(xyxy) == 0:
+        return np.empty(0, dtype=int)
+
+    boxes = xyxy.astype(np.float32)
+    if classes is not None:
+        boxes = boxes + classes.astype(np.float32)[:, None] * (boxes.max() + 1)
+
+    x1, y1, x2, y2 = boxes.T
+    areas = (x2 - x1) * (y2 - y1)
+    order = scores.argsort()[::-1]
+    keep = []
+
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        rest = order[1:]
+
+        inter_w = (np.minimum(x2[i], x2[rest]) - np.maximum(x1[i], x1[rest])).clip(0)
+        inter_h = (np.minimum(y2[i], y2[rest]) - np.maximum(y1[i], y1[rest])).clip(0)
+        inter = inter_w * inter_h
+        iou = inter / (areas[i] + areas[rest] - inter + 1e-9)
+
+        order = rest[iou <= iou_threshold]
+
+    return np.array(keep, dtype=int)
+
+
+# --- CROSS-MODEL BOX FUSION ---
+# Labels that describe the same kind of cell at different levels of detail. A generic
+# "WBC" box from blood_cell_best.pt and a "Neutrophil" box from neutrophil_best.pt on
+# the same cell are one cell, so they fuse; a WBC overlapping an RBC does not.
+CELL_FAMILIES = {
+    "WBC": "WBC",
+    "Neutrophil": "WBC",
+    "Lymphocyte": "WBC",
+    "Monocyte": "WBC",
+    "Eosinophil": "WBC",
+    "Basophil": "WBC"
+}
+GENERIC_LABELS = {"WBC"}
+# Overlap above which boxes of the same cell from different models are fused into one
+FUSION_IOU = float(os.environ.get("BENTARA_FUSION_IOU", "0.55"))
+
+
+# Anchor boxes compared per step of the overlap sweep; bounds its temporaries
+PAIR_BLOCK = 1024
+
+
+def paired_iou(a, b):
+    # IoU of a[k] with b[k], row by row
+    inter_w = (np.minimum(a[:, 2], b[:, 2]) - np.maximum(a[:, 0], b[:, 0])).clip(0)
+    inter_h = (np.minimum(a[:, 3], b[:, 3]) - np.maximum(a[:, 1], b[:, 1])).clip(0)
+    inter = inter_w * inter_h
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / (area_a + area_b - inter + 1e-9)
+
+
+def overlapping_pairs(xyxy, iou_threshold, block=PAIR_BLOCK):
+    # Index pairs (i, j) with IoU above the threshold, each pair once, without an
+    # N x N matrix: with the boxes sorted by x1, a box is only compared with the
+    # boxes after it that start before it ends, so memory is O(N * neighbours).
+    n = len(xyxy)
+    order = np.argsort(xyxy[:, 0], kind="stable")
+    boxes = xyxy[order].astype(np.float32)
+    first = np.arange(1, n + 1)
+    counts = np.maximum(np.searchsorted(boxes[:, 0], boxes[:, 2], side="left") - first, 0)
+
+    pairs_i, pairs_j = [], []
+    for lo in range(0, n, block):
+        c = counts[lo:lo + block]
+        i = np.repeat(np.arange(lo, lo + len(c)), c)
+        j = first[i] + np.arange(len(i)) - np.repeat(np.cumsum(c) - c, c)
+        close = paired_iou(boxes[i], boxes[j]) > iou_threshold
+        pairs_i.append(order[i[close]])
+        pairs_j.append(order[j[close]])
+    return np.concatenate(pairs_i), np.concatenate(pairs_j)
+
+
+def greedy_clusters(confs, pairs_i, pairs_j):
+    # Same result as taking the most confident unassigned box, giving it every
+    # unassigned box it overlaps, and repeating: a box starts a cluster unless a
+    # more confident cluster start overlaps it, and then joins the most confident
+    # one that does. Resolved a wave at a time over the overlap pairs.
+    n = len(confs)
+    rank = np.empty(n, dtype=int)
+    rank[confs.argsort(kind="stable")[::-1]] = np.arange(n)
+    swap = rank[pairs_i] > rank[pairs_j]
+    higher = np.where(swap, pairs_j, pairs_i)  # The more confident box of each pair
+    lower = np.where(swap, pairs_i, pairs_j)
+
+    UNKNOWN, SEED, MEMBER = 0, 1, 2
+    state = np.zeros(n, dtype=np.int8)
+    while True:
+        unknown = state == UNKNOWN
+        if not unknown.any():
+            break
+        state[lower[(state[higher] == SEED) & (state[lower] == UNKNOWN)]] = MEMBER
+        # Still waiting on a more confident box that may yet start a cluster
+        blocked = np.zeros(n, dtype=bool)
+        blocked[lower[state[higher] == UNKNOWN]] = True
+        state[(state == UNKNOWN) & ~blocked] = SEED
+
+    # Each member joins its most confident overlapping seed
+    cluster = np.arange(n)
+    joins = (state[higher] == SEED) & (state[lower] == MEMBER)
+    best = np.full(n, n)
+    np.minimum.at(best, lower[joins], rank[higher[joins]])
+    by_rank = np.argsort(rank)
+    members = state == MEMBER
+    cluster[members] = by_rank[best[members]]
+    return cluster
+
+
+def fuse_detections(xyxy, confs, labels, iou_threshold=FUSION_IOU):
+    # xyxy (N, 4), confs (N,), labels (N,) object array of strings, from all models.
+    # Overlapping boxes of the same cell family are clustered around the most confident
+    # box; each cluster becomes one cell with a confidence-weighted average box and the
+    # most confident specific label (falling back to the generic one, e.g. "WBC").
+    n = len(xyxy)
+    if n == 0:
+        return xyxy, confs, labels
+
+    families = np.array([CELL_FAMILIES.get(label, label) for label in labels], dtype=object)
+    _, family_ids = np.unique(families, return_inverse=True)
+    specific = np.array([label not in GENERIC_LABELS for label in labels])
+
+    # Boxes only fuse within their family, so overlaps are found one family at a time
+    pairs_i, pairs_j = [np.empty(0, dtype=int)], [np.empty(0, dtype=int)]
+    for family in range(family_ids.max() + 1):
+        idx = np.flatnonzero(family_ids == family)
+        i, j = overlapping_pairs(xyxy[idx], iou_threshold)
+        pairs_i.append(idx[i])
+        pairs_j.append(idx[j])
+    cluster = greedy_clusters(confs, np.concatenate(pairs_i), np.concatenate(pairs_j))
+
+    _, cluster_ids = np.unique(cluster, return_inverse=True)
+    k = cluster_ids.max() + 1
+
+    # Weighted box fusion: average member boxes weighted by confidence
+    weights = confs.astype(np.float64)
+    fused = np.zeros((k, 4))
+    np.add.at(fused, cluster_ids, xyxy * weights[:, None])
+    fused /= np.bincount(cluster_ids, weights=weights, minlength=k)[:, None] + 1e-9
+
+    # Sorted by cluster, then specific before generic, then confidence; the last
+    # entry of each cluster is the label (and confidence) it resolves to
+    best = np.lexsort((confs, specific, cluster_ids))
+    is_last = np.r_[cluster_ids[best][1:] != cluster_ids[best][:-1], True]
+    chosen = best[is_last]
+
+    return fused.astype(np.float32), confs[chosen], labels[chosen]
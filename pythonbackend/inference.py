@@ -0,0 +1,363 @@
+import copy
+import math
+import threading
+import warnings
+from contextlib import nullcontext
+
+import cv2
+import numpy as np
+import torch
+from PIL import Image
+
+from batching import MicroBatcher
+from fusion import nms
+from postprocess import concat_detections, label_array, result_arrays
+
+# --- PREPROCESSING SETTINGS ---
+# Slides are decoded whole (tiled mode too), 3 bytes per pixel, so this caps the
+# memory one slide can take. Bigger ones are refused before any pixel is decoded.
+MAX_IMAGE_PIXELS = 100_000_000
+DEFAULT_IMGSZ = 640
+STRIDE = 32  # YOLOv8 inputs must be a multiple of the largest stride
+PAD_COLOR = (114, 114, 114)  # Same grey ultralytics uses for letterbox padding
+
+# --- CASCADE SETTINGS ---
+# Labels from the general blood-cell detector that get handed to the subtype models
+WBC_LABELS = {"WBC"}
+# Grow each WBC box a little so the subtype models see the cell edge and some background
+CROP_PADDING = 0.15
+# WBC crops are small, so the subtype models don't need the full 640px input
+CROP_IMGSZ = 224
+
+# --- TILING SETTINGS ---
+TILE_SIZE = 640  # Matches the training imgsz, so tiles are fed at native resolution
+TILE_OVERLAP = 0.2  # Fraction of a tile shared with its neighbour; should exceed a cell diameter
+TILE_BATCH = 8  # Tiles per forward pass; bounds peak tensor memory
+TILE_IOU = 0.5
+
+
+# --- DECODE + LETTERBOX ---
+class ImageTooLargeError(ValueError):
+    pass
+
+
+def check_image_size(file_path, max_pixels=MAX_IMAGE_PIXELS):
+    # Reads only the file header. Returns (width, height), or None for formats PIL
+    # can't read (left to OpenCV); raises ImageTooLargeError over max_pixels.
+    try:
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", Image.DecompressionBombWarning)
+            with Image.open(file_path) as img:
+                width, height = img.size
+    except Image.DecompressionBombError:
+        # PIL won't even open anything over twice its own limit
+        pil_limit = 2 * Image.MAX_IMAGE_PIXELS
+        if not max_pixels or max_pixels > pil_limit:
+            return None
+        raise ImageTooLargeError(f"Image is over {pil_limit / 1e6:.0f} megapixels, more than the "
+                                 f"{max_pixels / 1e6:.0f} megapixel limit (BENTARA_MAX_IMAGE_PIXELS)")
+    except (OSError, ValueError):
+        return None
+    if max_pixels and width * height > max_pixels:
+        raise ImageTooLargeError(f"Image is {width} x {height} pixels ({width * height / 1e6:.0f} megapixels), "
+                                 f"more than the {max_pixels / 1e6:.0f} megapixel limit (BENTARA_MAX_IMAGE_PIXELS)")
+    return width, height
+
+
+def decode_image(file_path, max_pixels=MAX_IMAGE_PIXELS):
+    check_image_size(file_path, max_pixels)
+    image = cv2.imread(file_path)
+    if image is None:
+        raise ValueError(f"Failed to read image: {file_path}")
+    return image
+
+
+def letterbox(image, imgsz, stride=STRIDE, auto=True):
+    # auto=True pads only up to the next stride multiple (smallest tensor, like
+    # ultralytics does for single images). auto=False pads to a full imgsz square
+    # so different images can be stacked into one batch.
+    img_h, img_w = image.shape[:2]
+    gain = min(imgsz / img_h, imgsz / img_w)
+    new_w, new_h = round(img_w * gain), round(img_h * gain)
+
+    if auto:
+        target_w = math.ceil(new_w / stride) * stride
+        target_h = math.ceil(new_h / stride) * stride
+    else:
+        target_w = target_h = imgsz
+
+    if (new_w, new_h) != (img_w, img_h):
+        image = cv2.resize(image, (new_w, new_h), interpolation=cv2.INTER_LINEAR)
+
+    left = (target_w - new_w) // 2
+    top = (target_h - new_h) // 2
+    canvas = cv2.copyMakeBorder(image, top, target_h - new_h - top, left, target_w - new_w - left,
+                                cv2.BORDER_CONSTANT, value=PAD_COLOR)
+    return canvas, gain, (left, top)
+
+
+def to_tensor(images):
+    # BGR HWC uint8 arrays (all the same shape) -> RGB BCHW float tensor in 0-1
+    batch = np.stack(images)[..., ::-1].transpose(0, 3, 1, 2)
+    return torch.from_numpy(np.ascontiguousarray(batch)).float().div_(255.0)
+
+
+def scale_boxes(xyxy, gain, pad, img_w, img_h):
+    # Letterboxed input coordinates -> original image pixels
+    boxes = (xyxy - np.array([pad[0], pad[1], pad[0], pad[1]], dtype=np.float32)) / gain
+    boxes[:, [0, 2]] = boxes[:, [0, 2]].clip(0, img_w)
+    boxes[:, [1, 3]] = boxes[:, [1, 3]].clip(0, img_h)
+    return boxes
+
+
+def crop_box(image, x1, y1, x2, y2, padding=CROP_PADDING):
+    img_h, img_w = image.shape[:2]
+    pad_x = (x2 - x1) * padding
+    pad_y = (y2 - y1) * padding
+    left = max(0, int(x1 - pad_x))
+    top = max(0, int(y1 - pad_y))
+    right = min(img_w, int(x2 + pad_x) + 1)
+    bottom = min(img_h, int(y2 + pad_y) + 1)
+    return image[top:bottom, left:right]
+
+
+class PreparedImage:
+    # A slide decoded once, with its letterboxed tensor built once per input size
+    # and shared by every model in the ensemble
+    def __init__(self, image):
+        self.image = image
+        self.height, self.width = image.shape[:2]
+        self._inputs = {}
+
+    @classmethod
+    def from_file(cls, file_path, max_pixels=MAX_IMAGE_PIXELS):
+        return cls(decode_image(file_path, max_pixels))
+
+    def input(self, imgsz, square=False):
+        # square=True pads to a full imgsz square so slides can be batched together
+        key = (imgsz, square)
+        if key not in self._inputs:
+            canvas, gain, pad = letterbox(self.image, imgsz, auto=not square)
+            self._inputs[key] = (to_tensor([canvas]), gain, pad)
+        return self._inputs[key]
+
+
+# --- ENSEMBLE RUNNER ---
+class EnsembleRunner:
+    def __init__(self, models, imgsz=DEFAULT_IMGSZ, conf=0.25, model_imgsz=None,
+                 max_batch=1, batch_window_ms=20):
+        # models: {name: YOLO}, a ModelRegistry or a ModelSet, always looked up by name
+        # so lazily loaded / evicted / swapped models are picked up. model_imgsz lets
+        # individual models use another input size. max_batch > 1 puts a MicroBatcher
+        # in front of each model so concurrent slides share one batched forward pass.
+        self.models = models
+        self.imgsz = imgsz
+        self.conf = conf
+        self.model_imgsz = model_imgsz or {}
+        self.max_batch = max_batch
+        self.batch_window_ms = batch_window_ms
+        # An ultralytics predictor is not safe to call from two threads at once
+        self._locks = {}
+        self.batchers = {}
+        self._setup_lock = threading.Lock()
+        self.timer = None  # metrics.StageTimer of the slide this view runs, if any
+
+    def _lock(self, name):
+        with self._setup_lock:
+            return self._locks.setdefault(name, threading.Lock())
+
+    def _batcher(self, name):
+        with self._setup_lock:
+            if name not in self.batchers:
+                # The model travels with each request, so a batch never mixes versions
+                self.batchers[name] = MicroBatcher(lambda batch, model, n=name: self.forward_model(n, model, batch),
+                                                   window_ms=self.batch_window_ms, max_batch=self.max_batch,
+                                                   name=name)
+            return self.batchers[name]
+
+    def with_models(self, models, timer=None):
+        # Same locks, batchers and settings over another model mapping, e.g. the
+        # ModelSet a slide is pinned to. timer collects per-model stage times.
+        view = copy.copy(self)
+        view.models = models
+        view.timer = timer
+        return view
+
+    def _stage(self, stage, name):
+        return self.timer.stage(stage, name) if self.timer else nullcontext()
+
+    def forward(self, name, tensor):
+        # Timed per model, including the wait for the model's lock
+        with self._stage("forward", name):
+            return self.forward_model(name, self.models[name], tensor)
+
+    def forward_model(self, name, model, tensor):
+        # Pre-letterboxed tensor input skips ultralytics' own decode/resize step.
+        # Returns (xyxy, conf, cls) numpy arrays per batch item, in tensor coordinates.
+        with self._lock(name):
+            if hasattr(model, "predict_arrays"):  # ONNX Runtime engine
+                return model.predict_arrays(tensor, conf=self.conf)
+            results = model(tensor, conf=self.conf, verbose=False)
+        return [result_arrays(result) for result in results]
+
+    def warmup(self, name, model, sizes=None):
+        # One dummy forward pass per input size, so lazy graph/allocator setup is paid
+        # before real traffic. sizes defaults to the size this model runs slides at.
+        fixed_shape = getattr(model, "fixed_shape", None)
+        if fixed_shape:
+            sizes = [fixed_shape[0]]
+        for imgsz in sizes or [self.model_imgsz.get(name, self.imgsz)]:
+            self.forward_model(name, model, torch.zeros((1, 3, imgsz, imgsz)))
+
+    def input_size(self, name):
+        # Models exported with a fixed input shape can only take that size
+        fixed_shape = getattr(self.models[name], "fixed_shape", None)
+        if fixed_shape:
+            return fixed_shape[0]
+        return self.model_imgsz.get(name, self.imgsz)
+
+    def predict(self, name, prepared):
+        imgsz = self.input_size(name)
+
+        if self.max_batch > 1:
+            with self._stage("preprocess", name):
+                tensor, gain, pad = prepared.input(imgsz, square=True)
+            # Includes the time spent waiting for the batch to fill
+            with self._stage("forward", name):
+                xyxy, conf, cls = self._batcher(name).submit(tensor, self.models[name]).result()
+        else:
+            square = getattr(self.models[name], "fixed_shape", None) is not None
+            with self._stage("preprocess", name):
+                tensor, gain, pad = prepared.input(imgsz, square=square)
+            xyxy, conf, cls = self.forward(name, tensor)[0]
+
+        with self._stage("postprocess", name):
+            return scale_boxes(xyxy, gain, pad, prepared.width, prepared.height), conf, cls
+
+    def run(self, prepared, names=None):
+        # Yields (model, xyxy, conf, cls) for each model, boxes in original image pixels
+        for name in (names or list(self.models)):
+            xyxy, conf, cls = self.predict(name, prepared)
+            yield self.models[name], xyxy, conf, cls
+
+
+# --- TWO-STAGE CASCADE ---
+# Stage 1: the general detector finds every cell on the full slide once.
+# Stage 2: only the WBC crops are batched through the subtype models, and each WBC
+# takes the most confident subtype. RBCs/platelets are reported straight from stage 1.
+# Returns (xyxy, confs, labels) arrays in slide pixels.
+def run_cascade(runner, detector_name, prepared):
+    detector = runner.models[detector_name]
+    subtype_names = [name for name in runner.models if name != detector_name]
+
+    xyxy, confs, classes = runner.predict(detector_name, prepared)
+    labels = label_array(detector.names, classes)
+    is_wbc = np.isin(labels, list(WBC_LABELS))
+
+    wbc_boxes = xyxy[is_wbc]
+    wbc_confs = confs[is_wbc].copy()
+    wbc_labels = labels[is_wbc].copy()
+
+    if len(wbc_boxes) and subtype_names:
+        # Square letterbox so every crop stacks into one batch tensor, built once per
+        # input size and reused by all subtype models
+        crops = [crop_box(prepared.image, *box) for box in wbc_boxes.tolist()]
+        batches = {}
+        best_conf = np.zeros(len(wbc_boxes), dtype=np.float32)
+
+        for name in subtype_names:
+            model = runner.models[name]
+            fixed_shape = getattr(model, "fixed_shape", None)
+            crop_imgsz = fixed_shape[0] if fixed_shape else CROP_IMGSZ
+            if crop_imgsz not in batches:
+                batches[crop_imgsz] = to_tensor([letterbox(crop, crop_imgsz, auto=False)[0] for crop in crops])
+            outputs = runner.forward(name, batches[crop_imgsz])
+
+            # Top box per crop for this model (0 confidence where it found nothing)
+            top_conf = np.array([c.max() if len(c) else 0.0 for _, c, _ in outputs], dtype=np.float32)
+            top_cls = np.array([k[c.argmax()] if len(c) else 0 for _, c, k in outputs], dtype=int)
+
+            better = top_conf > best_conf
+            best_conf[better] = top_conf[better]
+            wbc_confs[better] = top_conf[better]
+            wbc_labels[better] = label_array(model.names, top_cls[better])
+
+    # WBCs keep the detector's box (it is drawn on the full slide); a crop no subtype
+    # model recognises keeps the generic "WBC" label and the detector's confidence
+    return concat_detections([
+        (xyxy[~is_wbc], confs[~is_wbc], labels[~is_wbc]),
+        (wbc_boxes, wbc_confs, wbc_labels)
+    ])
+
+
+# --- TILED SLIDING-WINDOW INFERENCE ---
+def tile_origins(length, tile_size, step):
+    # Evenly stepped origins, with the last tile pulled back to end exactly on the edge
+    if length <= tile_size:
+        return [0]
+    origins = list(range(0, length - tile_size, step))
+    origins.append(length - tile_size)
+    return origins
+
+
+def iter_tiles(image, tile_size, overlap):
+    img_h, img_w = image.shape[:2]
+    step = max(1, int(tile_size * (1 - overlap)))
+    for y0 in tile_origins(img_h, tile_size, step):
+        for x0 in tile_origins(img_w, tile_size, step):
+            yield x0, y0, image[y0:y0 + tile_size, x0:x0 + tile_size]
+
+
+def run_tiled(runner, prepared, tile_size=TILE_SIZE, overlap=TILE_OVERLAP, batch_size=TILE_BATCH,
+              iou_threshold=TILE_IOU, names=None):
+    # Yields (model, xyxy, conf, cls) per model exactly like EnsembleRunner.run, but
+    # the slide is cut into overlapping tiles at native resolution instead of being
+    # shrunk to one 640px input. Only batch_size tiles are ever held as tensors; the
+    # decoded slide itself is bounded by MAX_IMAGE_PIXELS.
+    img_h, img_w = prepared.height, prepared.width
+    # Boxes this close to an inner tile edge are cut off; the overlapping tile sees them whole
+    edge_margin = max(2, int(tile_size * overlap * 0.1))
+
+    for name in (names or list(runner.models)):
+        model = runner.models[name]
+        imgsz = runner.input_size(name)
+        all_boxes, all_confs, all_classes = [], [], []
+        batch = []
+
+        def flush():
+            outputs = runner.forward(name, to_tensor([b[0] for b in batch]))
+            for (_, gain, pad, x0, y0, tile_w, tile_h), (xyxy, confs, classes) in zip(batch, outputs):
+                boxes = scale_boxes(xyxy, gain, pad, tile_w, tile_h)
+
+                # Drop boxes clipped by a tile border that is not also the slide border
+                cut = np.zeros(len(boxes), dtype=bool)
+                if x0 > 0:
+                    cut |= boxes[:, 0] < edge_margin
+                if y0 > 0:
+                    cut |= boxes[:, 1] < edge_margin
+                if x0 + tile_w < img_w:
+                    cut |= boxes[:, 2] > tile_w - edge_margin
+                if y0 + tile_h < img_h:
+                    cut |= boxes[:, 3] > tile_h - edge_margin
+
+                keep = ~cut
+                all_boxes.append(boxes[keep] + np.array([x0, y0, x0, y0], dtype=np.float32))
+                all_confs.append(confs[keep])
+                all_classes.append(classes[keep])
+            batch.clear()
+
+        for x0, y0, tile in iter_tiles(prepared.image, tile_size, overlap):
+            canvas, gain, pad = letterbox(tile, imgsz, auto=False)
+            batch.append((canvas, gain, pad, x0, y0, tile.shape[1], tile.shape[0]))
+            if len(batch) == batch_size:
+                flush()
+        if batch:
+            flush()
+
+        xyxy = np.concatenate(all_boxes) if all_boxes else np.zeros((0, 4), dtype=np.float32)
+        confs = np.concatenate(all_confs) if all_confs else np.zeros(0, dtype=np.float32)
+        classes = np.concatenate(all_classes) if all_classes else np.zeros(0, dtype=int)
+
+        # Global NMS merges the duplicates found in the overlap between tiles
+        keep = nms(xyxy, confs, iou_threshold, classes=classes)
+        yield model, xyxy[keep], confs[keep], classes[keep]
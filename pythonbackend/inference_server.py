@@ -0,0 +1,476 @@
+import gc
+import itertools
+import multiprocessing as mp
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Listener
+
+import engine
+from auth import load_secret
+from model_registry import ModelWatcher
+from resources import PIN_CORES, RESOURCE_PROFILE, WORKER_THREADS, ResourceManager
+
+# --- PRE-FORK INFERENCE SERVER ---
+# python inference_server.py
+#
+# A model process loads and warms the PyTorch models once, then forks
+# BENTARA_INFERENCE_PROCESSES workers. The weights sit in pages the workers share
+# copy-on-write with it, so each extra worker adds its activations and thread
+# pools, not another copy of all five models. Every uvicorn process of the API
+# (BENTARA_INFERENCE_SERVER set) hands its slides to the same local job queue.
+#
+# ONNX Runtime sessions are not fork-safe, so models on the onnx/int8 backends are
+# loaded separately inside each worker.
+
+# A unix socket by default, so only local users with access to the file can connect
+INFERENCE_SERVER = os.environ.get("BENTARA_INFERENCE_SERVER", "inference.sock")
+# Worker processes (0 = as many as BENTARA_RESOURCE_PROFILE fits on the cores)
+INFERENCE_PROCESSES = int(os.environ.get("BENTARA_INFERENCE_PROCESSES", "0"))
+# Shared by the server and the API. The server unpickles whatever an authenticated
+# client sends, so there is no fixed default: without BENTARA_INFERENCE_AUTHKEY a
+# random key is generated once into a 0600 file both sides read.
+INFERENCE_AUTHKEY = os.environ.get("BENTARA_INFERENCE_AUTHKEY", "")
+INFERENCE_AUTHKEY_FILE = os.environ.get("BENTARA_INFERENCE_AUTHKEY_FILE", ".inference_key")
+# Seconds the API waits for one slide before giving up on it
+INFERENCE_TIMEOUT = float(os.environ.get("BENTARA_INFERENCE_TIMEOUT", "300"))
+
+
+def parse_address(value):
+    # "host:port" for TCP, anything else is a unix socket path
+    host, sep, port = value.rpartition(":")
+    if sep and port.isdigit():
+        return host or "127.0.0.1", int(port)
+    return value
+
+
+def process_memory(pid):
+    # RSS and PSS (shared pages split between the processes sharing them) in MB.
+    # PSS is what shows the copy-on-write saving; Linux only.
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line and not line.startswith(" "))
+        return {key.lower() + "_mb": round(int(fields[key].split()[0]) / 1024, 1) for key in ("Rss", "Pss")}
+    except (OSError, KeyError, ValueError):
+        return {}
+
+
+def preload():
+    print("--- PRELOADING AI MODELS (shared with workers) ---")
+    for name in engine.model_registry:
+        if engine.model_registry.entry(name).backend == "torch":
+            # Warming up here also fuses conv+bn, so the fused weights are shared too
+            engine.warm_up_model(name, engine.model_registry.get(name))
+    # Keep the garbage collector from touching (and so copying) every object page
+    gc.collect()
+    gc.freeze()
+
+
+def worker_main(index, generation, address, authkey, resources, slot, inherited=()):
+    # Pipe ends the fork copied in that must not stay open here (see model_process_main)
+    for conn in inherited:
+        conn.close()
+    # Fixed thread count (and cores, when pinning) before any model runs
+    resources.apply(slot)
+    # One slide at a time per process, so there is nothing to micro-batch
+    engine.runner.max_batch = 1
+
+    # PyTorch models arrive already loaded and warm from the model process; this
+    # only sets up this process's thread pools (and loads any ONNX models)
+    for name in engine.model_registry:
+        engine.warm_up_model(name, engine.model_registry.get(name))
+
+    # The server hands this worker one slide at a time over its own connection, and
+    # None when the worker is retired
+    with Client(address, authkey=authkey) as conn:
+        conn.send(("ready", index, os.getpid()))
+        while True:
+            try:
+                file_path = conn.recv()
+            except EOFError:
+                return
+            if file_path is None:
+                return
+            try:
+                result = engine.analyse_image(file_path)
+                result["generation"] = generation  # Lets the API tell results of swapped-out weights apart
+                conn.send((True, result))
+            except Exception as e:
+                conn.send((False, f"{type(e).__name__}: {e}"))
+
+
+# --- MODEL PROCESS ---
+# Forked from the server before the server starts any thread, and never starts one
+# itself. It loads, warms and hot-swaps the PyTorch models and forks every worker,
+# at startup and on each restart, so workers share its current weights and are
+# always forked from a single-threaded process: a fork copies only the calling
+# thread, and any lock another thread held at that moment (allocator, logging,
+# torch) would stay locked in the child forever. Talks to the server over one pipe.
+def model_process_main(conn, server_end, worker_address, authkey, resources):
+    server_end.close()  # Or the server exiting would not close the pipe for us
+    engine.runner.max_batch = 1  # No batcher threads in this process
+    preload()
+    swapped = []
+    watcher = None
+    if engine.MODEL_WATCH_SECONDS > 0:
+        watcher = ModelWatcher(engine.model_registry, interval=engine.MODEL_WATCH_SECONDS,
+                               warmup=engine.warm_up_model, on_swap=swapped.append, thread=False)
+    conn.send(("models", engine.model_registry.stats()))
+
+    ctx = mp.get_context("fork")
+    workers = {}  # index -> Process
+    next_check = time.monotonic() + engine.MODEL_WATCH_SECONDS
+    while True:
+        if conn.poll(0.5):
+            try:
+                command, *args = conn.recv()
+            except EOFError:
+                return  # The server is gone; the daemonic workers are stopped on exit
+            if command == "spawn":
+                index, generation, slot_index = args
+                process = ctx.Process(target=worker_main, name=f"inference-{index}", daemon=True,
+                                      args=(index, generation, worker_address, authkey, resources,
+                                            resources.slots[slot_index], (conn,)))
+                process.start()
+                workers[index] = process
+                conn.send(("spawned", index, process.pid))
+            elif command == "swap":
+                call_id, name, version, backend = args
+                try:
+                    entry = engine.model_registry.swap(name, version, backend, warmup=engine.warm_up_model)
+                    reply = (True, entry.label)
+                except Exception as e:
+                    reply = (False, f"{type(e).__name__}: {e}")
+                gc.freeze()
+                conn.send(("models", engine.model_registry.stats()))
+                conn.send(("reply", call_id, *reply))
+
+        for index, process in list(workers.items()):
+            if process.exitcode is not None:  # Also reaps it
+                del workers[index]
+                conn.send(("exited", index, process.exitcode))
+
+        # Weights replaced on disk: swapped here, then the server restarts its workers
+        if watcher and time.monotonic() >= next_check:
+            next_check = time.monotonic() + engine.MODEL_WATCH_SECONDS
+            watcher.poll()
+            if swapped:
+                gc.freeze()
+                conn.send(("models", engine.model_registry.stats()))
+                conn.send(("swapped", list(swapped)))
+                swapped.clear()
+
+
+class InferenceServer:
+    def __init__(self, address, resources, authkey=b""):
+        self.address = address
+        self.resources = resources  # One worker per slot
+        self.processes = len(resources.slots)
+        self.authkey = authkey
+
+        self.ctx = mp.get_context("fork")
+        self.model_process = None
+        self.model_stats = {}  # Registry stats, sent by the model process after every change
+        self.workers = {}  # index -> {"slot", "generation", "pid", "ready", "request", "draining"}
+        self.backlog = deque()  # (request id, file path, attempts) waiting for a worker
+        self.pending = {}  # request id -> Future
+        self.generation = 0  # Bumped by every swap; workers of older generations drain and exit
+        self.completed = 0
+        self._indexes = itertools.count()
+        self._request_ids = itertools.count()
+        self._call_ids = itertools.count()
+        self._calls = {}  # call id -> Future of a request to the model process
+        self._cond = threading.Condition()
+        self._pipe = None
+        self._pipe_lock = threading.Lock()  # One sender at a time on the model process pipe
+
+    # --- Model process ---
+    def _send(self, message):
+        with self._pipe_lock:
+            self._pipe.send(message)
+
+    def _call(self, command, *args):
+        future = Future()
+        call_id = next(self._call_ids)
+        with self._cond:
+            self._calls[call_id] = future
+        self._send((command, call_id, *args))
+        return future.result()
+
+    def _model_events(self):
+        while True:
+            try:
+                kind, *payload = self._pipe.recv()
+            except (EOFError, OSError):
+                # Nothing can fork workers or swap models any more: exit and let the
+                # supervisor restart the whole server
+                print(f"❌ Model process exited (code {self.model_process.exitcode}), stopping the server")
+                os._exit(1)
+
+            if kind == "models":
+                self.model_stats = payload[0]
+            elif kind == "reply":
+                call_id, ok, value = payload
+                with self._cond:
+                    future = self._calls.pop(call_id)
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(RuntimeError(value))
+            elif kind == "spawned":
+                index, pid = payload
+                with self._cond:
+                    worker = self.workers.get(index)
+                    if worker:
+                        worker["pid"] = worker["slot"].pid = pid
+                if worker:
+                    cores = f", cores {worker['slot'].cores}" if self.resources.pin else ""
+                    print(f"👷 Inference worker {index} started (pid {pid}, {worker['slot'].threads} threads{cores})")
+            elif kind == "exited":
+                self._worker_exited(*payload)
+            elif kind == "swapped":
+                print(f"🔁 Models replaced on disk: {', '.join(payload[0])}, restarting workers")
+                threading.Thread(target=self.restart_workers, daemon=True).start()
+
+    # --- Workers ---
+    def _spawn(self, slot, generation):
+        index = next(self._indexes)
+        with self._cond:
+            self.workers[index] = {"slot": slot, "generation": generation, "pid": None, "ready": False,
+                                   "request": None, "draining": False}
+        self._send(("spawn", index, generation, slot.index))
+
+    def restart_workers(self):
+        # Rolling restart after a swap. From the moment the generation changes no
+        # slide goes to an old worker: idle ones exit now, busy ones after the slide
+        # they have (on the old weights). New slides wait for the new workers.
+        with self._cond:
+            self.generation += 1
+            generation = self.generation
+            for worker in self.workers.values():
+                worker["draining"] = True
+            self._cond.notify_all()
+        for slot in self.resources.slots:
+            self._spawn(slot, generation)
+        return generation
+
+    def _generation_ready(self, generation):
+        # Called with self._cond held
+        current = [w for w in self.workers.values() if w["generation"] == generation]
+        return len(current) == self.processes and all(w["ready"] for w in current)
+
+    def _worker_exited(self, index, exitcode):
+        with self._cond:
+            worker = self.workers.pop(index, None)
+            self._cond.notify_all()
+            restart = worker is not None and not worker["draining"]
+        if restart:
+            print(f"⚠️ Inference worker {index} exited with code {exitcode}, restarting")
+            self._spawn(worker["slot"], worker["generation"])
+
+    def _accept_workers(self, listener):
+        while True:
+            try:
+                conn = listener.accept()
+            except Exception as e:
+                print(f"⚠️ Rejected inference worker connection: {e}")
+                continue
+            threading.Thread(target=self._serve_worker, args=(conn,), daemon=True).start()
+
+    def _serve_worker(self, conn):
+        # Feeds one worker process one slide at a time, for as long as it belongs to
+        # the current generation and has not exited
+        with conn:
+            try:
+                _, index, pid = conn.recv()
+            except (EOFError, OSError):
+                return
+            with self._cond:
+                worker = self.workers.get(index)
+                if worker is None:
+                    return
+                worker.update(pid=pid, ready=True)
+                self._cond.notify_all()
+
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self.backlog or worker["draining"]
+                                        or self.workers.get(index) is not worker)
+                    if worker["draining"] or self.workers.get(index) is not worker:
+                        break
+                    request_id, file_path, attempts = self.backlog.popleft()
+                    worker["request"] = request_id
+
+                try:
+                    conn.send(file_path)
+                    ok, value = conn.recv()
+                except (EOFError, OSError):
+                    # The worker died (the model process reports it and a new one is
+                    # forked). The slide gets one more try on another worker, in case
+                    # it was only sent to an idle worker that had just died.
+                    with self._cond:
+                        if attempts == 0:
+                            self.backlog.appendleft((request_id, file_path, 1))
+                            self._cond.notify_all()
+                            future = None
+                        else:
+                            future = self.pending.pop(request_id, None)
+                    if future:
+                        future.set_exception(RuntimeError(f"Inference worker {index} died"))
+                    return
+
+                with self._cond:
+                    worker["request"] = None
+                    future = self.pending.pop(request_id, None)
+                    self.completed += 1
+                if future is None:
+                    continue
+                if ok:
+                    future.set_result(value)
+                else:
+                    future.set_exception(RuntimeError(value))
+
+            try:
+                conn.send(None)  # Retired: exit
+            except OSError:
+                pass
+
+    # --- Requests ---
+    def analyse(self, file_path):
+        future = Future()
+        request_id = next(self._request_ids)
+        with self._cond:
+            self.pending[request_id] = future
+            self.backlog.append((request_id, file_path, 0))
+            self._cond.notify_all()
+        return future.result()
+
+    def swap(self, name, version=None, backend=None):
+        # The model process loads and warms the new weights, then forks the new
+        # workers from them. Returns once they are ready (or INFERENCE_TIMEOUT passed).
+        label = self._call("swap", name, version, backend)
+        generation = self.restart_workers()
+        with self._cond:
+            self._cond.wait_for(lambda: self._generation_ready(generation) or self.generation != generation,
+                                timeout=INFERENCE_TIMEOUT)
+        return label
+
+    def stats(self):
+        with self._cond:
+            workers = [
+                {"index": index, "pid": w["pid"], "generation": w["generation"], "draining": w["draining"],
+                 "ready": w["ready"], "request": w["request"], "slot": w["slot"].index, "threads": w["slot"].threads,
+                 **(process_memory(w["pid"]) if w["pid"] else {})}
+                for index, w in self.workers.items()
+            ]
+            return {"ready": self._generation_ready(self.generation), "generation": self.generation,
+                    "workers": workers, "queued": len(self.backlog), "pending": len(self.pending),
+                    "completed": self.completed,
+                    "parent": {"pid": os.getpid(), **process_memory(os.getpid())},
+                    "model_process": {"pid": self.model_process.pid, **process_memory(self.model_process.pid)},
+                    "models": self.model_stats}
+
+    def _handle(self, conn):
+        commands = {"analyse": self.analyse, "swap": self.swap, "stats": self.stats,
+                    "resources": self.resources.stats}
+        with conn:
+            while True:
+                try:
+                    command, *args = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    reply = (True, commands[command](*args))
+                except Exception as e:
+                    reply = (False, f"{type(e).__name__}: {e}")
+                try:
+                    conn.send(reply)
+                except (EOFError, OSError):
+                    return
+
+    def run(self):
+        # The only fork in this process, before it starts any thread; the model
+        # process forks the workers from then on. Workers connect back to a private
+        # unix socket for their slides.
+        workers_listener = Listener(family="AF_UNIX", authkey=self.authkey)
+        self._pipe, child_end = self.ctx.Pipe()
+        self.model_process = self.ctx.Process(target=model_process_main, name="inference-models",
+                                              args=(child_end, self._pipe, workers_listener.address,
+                                                    self.authkey, self.resources))
+        self.model_process.start()
+        child_end.close()
+
+        threading.Thread(target=self._model_events, name="model-events", daemon=True).start()
+        threading.Thread(target=self._accept_workers, args=(workers_listener,), name="workers",
+                         daemon=True).start()
+        for slot in self.resources.slots:
+            self._spawn(slot, self.generation)
+
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)  # Stale socket from a previous run
+        try:
+            with Listener(self.address, authkey=self.authkey) as listener:
+                if isinstance(self.address, str):
+                    os.chmod(self.address, 0o600)
+                print(f"🚀 Inference server listening on {self.address} with {self.processes} workers")
+                while True:
+                    try:
+                        conn = listener.accept()
+                    except Exception as e:  # Failed handshake (e.g. wrong authkey)
+                        print(f"⚠️ Rejected inference connection: {e}")
+                        continue
+                    threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+        finally:
+            self._pipe.close()  # The model process exits, taking its workers with it
+            self.model_process.join(5)
+
+
+# --- CLIENT (used by the API) ---
+# One connection per calling thread, reopened after any error.
+class InferenceClient:
+    def __init__(self, address, authkey=b"", timeout=300.0):
+        self.address = address
+        self.authkey = authkey
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def call(self, command, *args, timeout=None):
+        conn = getattr(self._local, "conn", None)
+        try:
+            if conn is None:
+                conn = self._local.conn = Client(self.address, authkey=self.authkey)
+            conn.send((command, *args))
+            if not conn.poll(timeout or self.timeout):
+                raise TimeoutError(f"Inference server did not answer '{command}' in time")
+            ok, value = conn.recv()
+        except (OSError, EOFError, TimeoutError):
+            # The reply may still arrive later, so this connection is out of step
+            if conn is not None:
+                conn.close()
+            self._local.conn = None
+            raise
+
+        if not ok:
+            raise RuntimeError(value)
+        return value
+
+    def analyse(self, file_path):
+        return self.call("analyse", os.path.abspath(file_path))
+
+    def swap(self, name, version=None, backend=None):
+        return self.call("swap", name, version, backend)
+
+    def stats(self):
+        return self.call("stats", timeout=5)
+
+    def resources(self):
+        return self.call("resources", timeout=5)
+
+
+if __name__ == "__main__":
+    resources = ResourceManager(RESOURCE_PROFILE, workers=INFERENCE_PROCESSES, threads=WORKER_THREADS,
+                                pin=PIN_CORES)
+    InferenceServer(parse_address(INFERENCE_SERVER), resources,
+                    authkey=load_secret(INFERENCE_AUTHKEY, INFERENCE_AUTHKEY_FILE)).run()
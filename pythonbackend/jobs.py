@@ -0,0 +1,104 @@
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+
+class QueueFullError(Exception):
+    pass
+
+
+class Job:
+    def __init__(self, func, args, report_id=None, job_id=None):
+        self.id = job_id or str(uuid.uuid4())
+        self.report_id = report_id
+        self.func = func
+        self.args = args
+        self.status = "queued"  # queued -> running -> done / failed
+        self.progress = 0.0
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+
+    def set_progress(self, fraction):
+        self.progress = round(min(max(fraction, 0.0), 1.0), 3)
+
+    def to_dict(self):
+        return {
+            "job_id": self.id,
+            "report_id": self.report_id,
+            "status": self.status,
+            "progress": self.progress,
+            "error": self.error,
+            "queued_seconds": round((self.started_at or time.time()) - self.created_at, 3),
+            "run_seconds": round((self.finished_at or time.time()) - self.started_at, 3) if self.started_at else None
+        }
+
+
+# --- BOUNDED IN-PROCESS JOB QUEUE ---
+# Slide analysis is CPU-bound and blocking, so it runs on a small pool of worker
+# threads instead of on the uvicorn event loop. The queue is bounded so a burst of
+# uploads is refused (503) instead of piling up unbounded work and memory.
+class JobQueue:
+    def __init__(self, workers=2, max_pending=16, keep_finished=500):
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._keep_finished = keep_finished
+        self.running = 0
+
+        for i in range(workers):
+            threading.Thread(target=self._worker, name=f"analysis-worker-{i}", daemon=True).start()
+
+    # func is called as func(job, *args) so it can report progress through the job.
+    # job_id lets the caller store the id (e.g. on the report) before submitting.
+    def submit(self, func, *args, report_id=None, job_id=None):
+        job = Job(func, args, report_id=report_id, job_id=job_id)
+        with self._lock:
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                del self._jobs[job.id]
+            raise QueueFullError("Analysis queue is full")
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def depth(self):
+        return self._queue.qsize()
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            job.status = "running"
+            job.started_at = time.time()
+            with self._lock:
+                self.running += 1
+            try:
+                job.result = job.func(job, *job.args)
+                job.progress = 1.0
+                job.status = "done"
+            except Exception as e:
+                print(f"❌ Job {job.id} failed: {e}")
+                job.error = str(e)
+                job.status = "failed"
+            finally:
+                job.finished_at = time.time()
+                with self._lock:
+                    self.running -= 1
+                self._prune()
+                self._queue.task_done()
+
+    def _prune(self):
+        # Forget the oldest finished jobs so the table doesn't grow forever
+        with self._lock:
+            finished = [j.id for j in self._jobs.values() if j.status in ("done", "failed")]
+            for job_id in finished[:max(0, len(finished) - self._keep_finished)]:
+                del self._jobs[job_id]
@@ -1,20 +1,37 @@
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, status
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends, BackgroundTasks, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 import sqlite3
-import shutil
 import os
 import uuid
 import json
+import asyncio
+import base64
+import hashlib
+import threading
+import time
 from datetime import datetime
 from typing import Optional
-from ultralytics import YOLO
+from contextlib import asynccontextmanager
 from PIL import Image  # Added for JPEG conversion
-from collections import Counter
-
-app = FastAPI()
+from auth import TokenError, UserCache, check_token_version, create_token, load_secret, verify_token
+from database import AsyncDatabase, ConnectionPool
+from jobs import JobQueue, QueueFullError
+from migrations import check_query_plans, migrate, reconcile_dashboard_stats
+from postprocess import score_percent
+from metrics import REGISTRY, STAGE_SECONDS, LoopLagMonitor, record_timings, timed
+from result_cache import ResultCache, model_fingerprint
+from model_registry import MODEL_SUFFIXES, ModelWarmup, ModelWatcher
+from engine import (INFERENCE_MODE, FUSION_IOU, TILE_SIZE, TILE_OVERLAP, WARMUP_WORKERS, MODEL_WATCH_SECONDS,
+                    MAX_IMAGE_PIXELS, model_registry, runner, warm_up_model, analyse_image)
+from inference import ImageTooLargeError, check_image_size
+from inference_server import (INFERENCE_AUTHKEY, INFERENCE_AUTHKEY_FILE, INFERENCE_TIMEOUT, InferenceClient,
+                              parse_address)
+from resources import RESOURCE_PROFILE, WORKER_THREADS, ResourceManager
 
 # --- CONFIGURATION ---
 UPLOAD_DIR = "uploads"
@@ -23,6 +40,43 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 os.makedirs(os.path.join(DATASET_DIR, "images"), exist_ok=True)
 os.makedirs(os.path.join(DATASET_DIR, "labels"), exist_ok=True)
 DB_NAME = "bentara.db"
+# One reused WAL-mode connection per thread (see database.py)
+db = ConnectionPool(DB_NAME)
+# Async endpoints await their queries on the database thread pool instead
+adb = AsyncDatabase(db)
+
+# Signs the access tokens (see auth.py); profile lookups go through a TTL cache
+TOKEN_KEY = load_secret()
+user_cache = UserCache()
+
+# Slide analysis runs on a worker pool behind a bounded queue, off the event loop
+JOB_WORKERS = int(os.environ.get("BENTARA_JOB_WORKERS", "2"))
+JOB_QUEUE_SIZE = int(os.environ.get("BENTARA_JOB_QUEUE_SIZE", "16"))
+
+# Hand slides to the pre-fork inference server (inference_server.py) at this
+# address instead of running the models in this process, e.g. "inference.sock".
+# BENTARA_JOB_WORKERS should then be at least the server's worker count.
+INFERENCE_SERVER = os.environ.get("BENTARA_INFERENCE_SERVER", "")
+
+# Repeat uploads of the same image bytes reuse the stored detections (LRU bounded)
+RESULT_CACHE_SIZE = int(os.environ.get("BENTARA_RESULT_CACHE_SIZE", "512"))
+
+# Rows per page of /patients, /reports/pending and /research/gallery when a client
+# pages with ?cursor= but no ?limit=, and the most a client may ask for. Without
+# either, the endpoints return the whole list as they always have.
+PAGE_SIZE = int(os.environ.get("BENTARA_PAGE_SIZE", "100"))
+MAX_PAGE_SIZE = int(os.environ.get("BENTARA_MAX_PAGE_SIZE", "500"))
+
+# Usernames allowed to hot-swap model weights (comma separated). Unset, any
+# Consultant or Pathologist may; roles are self-declared, so set this in production.
+MODEL_ADMINS = {name.strip() for name in os.environ.get("BENTARA_MODEL_ADMINS", "").split(",") if name.strip()}
+
+# Seconds between full recounts of the trigger-maintained dashboard counters (0 = never)
+STATS_RECONCILE_SECONDS = float(os.environ.get("BENTARA_STATS_RECONCILE_SECONDS", "3600"))
+
+# How often the event loop lag is sampled for /metrics, in seconds (0 = off)
+LOOP_LAG_INTERVAL = float(os.environ.get("BENTARA_LOOP_LAG_INTERVAL", "0.5"))
+loop_lag = LoopLagMonitor(LOOP_LAG_INTERVAL)
 
 # --- YOLO CLASS MAPPING (For Dataset Generation) ---
 # This ensures "Neutrophil" becomes Class ID 0, etc. based on standard ML mapping
@@ -37,32 +91,57 @@ CLASS_MAP = {
     "Platelet": 7
 }
 
-# --- LOAD MULTIPLE YOLO MODELS ---
-MODEL_FILES = [
-    "eosinophil_best.pt",
-    "lymphocyte_best.pt",
-    "monocyte_best.pt",
-    "neutrophil_best.pt",
-    "blood_cell_best.pt"
-]
-
-loaded_models = []
-
-print("--- LOADING AI MODELS ---")
-for model_file in MODEL_FILES:
-    path = os.path.join("models", model_file)
-    if os.path.exists(path):
-        print(f"✅ Loading: {model_file}")
-        try:
-            loaded_models.append(YOLO(path))
-        except Exception as e:
-            print(f"❌ Failed to load {model_file}: {e}")
-    else:
-        print(f"⚠️ Warning: {model_file} not found in 'models' folder.")
+job_queue = JobQueue(workers=JOB_WORKERS, max_pending=JOB_QUEUE_SIZE)
 
-if not loaded_models:
-    print("⚠️ No custom models found. Loading generic 'yolov8n.pt' fallback.")
-    loaded_models.append(YOLO("yolov8n.pt"))
+# Without an inference server the job workers are the inference workers: each one
+# gets an equal share of the cores instead of every inference using all of them
+resources = ResourceManager(RESOURCE_PROFILE, workers=JOB_WORKERS, threads=WORKER_THREADS)
+if not INFERENCE_SERVER:
+    resources.apply_in_process()
+
+# Cached results are only valid for these weights and these analysis settings
+result_cache = ResultCache(max_entries=RESULT_CACHE_SIZE, version=model_fingerprint(model_registry.paths()))
+# (micro-batching letterboxes differently, so it can change detections too)
+ANALYSIS_SETTINGS = (INFERENCE_MODE, runner.imgsz, runner.conf, FUSION_IOU, TILE_SIZE, TILE_OVERLAP,
+                     runner.max_batch > 1)
+
+
+def models_changed(name):
+    # A swapped model makes every cached result stale
+    result_cache.set_version(model_fingerprint(model_registry.paths()))
+
+
+# Models only load in this process when there is no inference server; with one,
+# the server loads, warms, watches and swaps them
+inference_client = None
+inference_generation = 0  # Newest weights generation seen from the server
+if INFERENCE_SERVER:
+    inference_client = InferenceClient(parse_address(INFERENCE_SERVER),
+                                       authkey=load_secret(INFERENCE_AUTHKEY, INFERENCE_AUTHKEY_FILE),
+                                       timeout=INFERENCE_TIMEOUT)
+    WARMUP_WORKERS = 0
+elif MODEL_WATCH_SECONDS > 0:
+    model_watcher = ModelWatcher(model_registry, interval=MODEL_WATCH_SECONDS, warmup=warm_up_model,
+                                 on_swap=models_changed)
+
+model_warmup = ModelWarmup(model_registry, warm_up_model, workers=max(1, WARMUP_WORKERS))
+
+
+@asynccontextmanager
+async def lifespan(app):
+    # Loading runs in the background: the server starts answering right away and
+    # /health/ready says 503 until every model is warm
+    if WARMUP_WORKERS > 0:
+        model_warmup.start()
+    if STATS_RECONCILE_SECONDS > 0:
+        threading.Thread(target=reconcile_stats_loop, name="stats-reconcile", daemon=True).start()
+    lag_task = asyncio.create_task(loop_lag.run()) if LOOP_LAG_INTERVAL > 0 else None
+    yield
+    if lag_task:
+        lag_task.cancel()
+
+
+app = FastAPI(lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -70,6 +149,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],  # Lets the frontend read the next page's cursor
 )
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
@@ -77,81 +157,11 @@ oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # --- DATABASE SETUP ---
 def init_db():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    # 1. Users
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            username TEXT UNIQUE NOT NULL,
-            email TEXT,
-            password TEXT NOT NULL,
-            full_name TEXT,
-            role TEXT,
-            license_id TEXT
-        )
-    ''')
-
-    # 2. Patients
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS patients (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL,
-            mrn TEXT UNIQUE NOT NULL,
-            nhs_number TEXT NOT NULL,
-            dob TEXT NOT NULL,
-            gender TEXT NOT NULL,
-            history TEXT
-        )
-    ''')
-
-    # 3. Reports
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS reports (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            patient_id INTEGER,
-            date TEXT,
-            image_url TEXT,
-            diagnosis TEXT,
-            confidence TEXT,
-            status TEXT DEFAULT 'Pending',
-            assigned_to TEXT, 
-            sample_type TEXT,
-            sample_date TEXT,
-            notes TEXT,
-            detections TEXT,
-            FOREIGN KEY(patient_id) REFERENCES patients(id)
-        )
-    ''')
-
-    # 4. Audit Logs
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS audit_logs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            report_id INTEGER,
-            action TEXT,
-            performed_by TEXT,
-            timestamp TEXT,
-            details TEXT
-        )
-    ''')
-
-    # 5. Research Samples
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS research_samples (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            contributor_id INTEGER,
-            sample_type TEXT,
-            image_url TEXT,
-            annotations TEXT,
-            notes TEXT,
-            date TEXT,
-            status TEXT DEFAULT 'Unverified'
-        )
-    ''')
-
-    conn.commit()
+    # Tables and indexes come from the versioned migrations in migrations.py
+    conn = db.connect()
+    migrate(conn)
+    for name, issues in check_query_plans(conn).items():
+        print(f"⚠️ Slow query plan for {name}: {'; '.join(issues)}")
     conn.close()
 
 
@@ -188,17 +198,35 @@ class ChangePasswordRequest(BaseModel):
     current_password: str
     new_password: str
 
+class ModelSwapRequest(BaseModel):
+    version: Optional[str] = None  # None = the unversioned file in 'models'
+    backend: Optional[str] = None
+
 
 # --- DEPENDENCIES ---
 async def get_current_user(token: str = Depends(oauth2_scheme)):
-    conn = sqlite3.connect(DB_NAME)
+    # Checked from the signed token, plus the user's token version from the cached
+    # profile (the database only on a miss). A password change revokes older tokens
+    # here at once, and in other worker processes once their cached entry expires.
+    try:
+        claims = verify_token(TOKEN_KEY, token)
+        user = await cached_user(claims["sub"])
+        check_token_version(claims, user and user["token_version"])
+    except TokenError as e:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=str(e),
+                            headers={"WWW-Authenticate": "Bearer"})
+    return {"username": claims["sub"], "id": claims["uid"], "role": claims["role"],
+            "token_version": claims.get("ver", 0)}
+
+
+def load_user(conn, username):
     cursor = conn.cursor()
-    cursor.execute("SELECT username, full_name, email, role, license_id, id FROM users WHERE username = ?", (token,))
+    cursor.execute("SELECT username, full_name, email, role, license_id, id, token_version FROM users "
+                   "WHERE username = ?", (username,))
     user = cursor.fetchone()
-    conn.close()
 
     if not user:
-        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid auth")
+        return None
 
     return {
         "username": user[0],
@@ -206,10 +234,31 @@ async def get_current_user(token: str = Depends(oauth2_scheme)):
         "email": user[2],
         "role": user[3],
         "license_id": user[4],
-        "id": user[5]
+        "id": user[5],
+        "token_version": user[6]
     }
 
 
+def is_consultant(user):
+    return "Consultant" in user['role'] or "Pathologist" in user['role']
+
+
+async def cached_user(username):
+    user = user_cache.get(username)
+    if not user:
+        user = await adb.run(load_user, username)
+        user_cache.put(username, user)
+    return user
+
+
+async def get_user_profile(current_user: dict = Depends(get_current_user)):
+    # For the endpoints that need more than the token carries (name, email, licence)
+    user = await cached_user(current_user["username"])
+    if not user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid auth")
+    return user
+
+
 # --- HELPER: YOLO COORDINATE CONVERSION ---
 def save_yolo_label(base_filename, annotations_json):
     label_path = os.path.join(DATASET_DIR, "labels", f"{base_filename}.txt")
@@ -236,132 +285,275 @@ def save_yolo_label(base_filename, annotations_json):
         print(f"❌ Failed to generate YOLO label: {e}")
 
 
+# --- DETECTIONS (one row per cell, see migrations.py) ---
+def save_detections(conn, report_id, detections):
+    # Bulk insert; the caller commits it together with the report
+    labels = {d["label"] for d in detections}
+    if not labels:
+        return
+    conn.executemany("INSERT OR IGNORE INTO cell_classes (name) VALUES (?)", [(label,) for label in labels])
+    class_ids = dict(conn.execute(f"SELECT name, id FROM cell_classes WHERE name IN ({','.join('?' * len(labels))})",
+                                  tuple(labels)).fetchall())
+    conn.executemany("""
+        INSERT INTO detections (report_id, class_id, x, y, w, h, confidence, model_version)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    """, [(report_id, class_ids[d["label"]], d["x"], d["y"], d["w"], d["h"], d["confidence"], d.get("model"))
+          for d in detections])
+
+
+def load_detections(cursor, report_id):
+    # Same dicts serialize_detections builds, for the frontend overlay
+    cursor.execute("""
+        SELECT c.name, d.x, d.y, d.w, d.h, d.confidence, d.model_version
+        FROM detections d
+        JOIN cell_classes c ON d.class_id = c.id
+        WHERE d.report_id = ? ORDER BY d.id
+    """, (report_id,))
+    return [{"x": x, "y": y, "w": w, "h": h, "label": label, "score": f"{score_percent(confidence)}%",
+             "confidence": confidence, "model": model}
+            for label, x, y, w, h, confidence, model in cursor.fetchall()]
+
+
+# --- SLIDE ANALYSIS (runs on the job queue workers) ---
+def analyse_slide(job, report_id, file_path, cache_key=None):
+    global inference_generation
+    STAGE_SECONDS.observe(job.started_at - job.created_at, path="upload", stage="queue_wait")
+
+    try:
+        with timed("upload", "analysis"):
+            if inference_client:
+                result = inference_client.analyse(file_path)
+            else:
+                result = analyse_image(file_path, progress=job.set_progress)
+        # The server swapped weights (and restarted its workers) since the last slide
+        if inference_client and result["generation"] > inference_generation:
+            inference_generation = result["generation"]
+            models_changed(None)
+    except Exception:
+        conn = db.connect()
+        conn.execute("UPDATE reports SET status = 'Failed', diagnosis = 'Analysis Failed' "
+                     "WHERE id = ? AND status = 'Analysing'", (report_id,))
+        conn.commit()
+        conn.close()
+        raise
+
+    diagnosis, confidence = result["diagnosis"], result["confidence"]
+    detected_objects, model_versions = result["detections"], result["model_versions"]
+    # Decode, per-model preprocess/forward/postprocess, fusion and summary times
+    record_timings("upload", result["timings"])
+
+    with timed("upload", "db_update"):
+        conn = db.connect()
+        # Only a report still waiting for this analysis takes the result
+        updated = conn.execute("""
+            UPDATE reports SET diagnosis = ?, confidence = ?, model_versions = ?, status = 'Pending'
+            WHERE id = ? AND status = 'Analysing'
+        """, (diagnosis, confidence, json.dumps(model_versions), report_id)).rowcount
+        if updated:
+            save_detections(conn, report_id, detected_objects)
+        else:
+            print(f"⚠️ Report {report_id} is no longer being analysed, result not stored")
+        conn.commit()
+        conn.close()
+
+    if cache_key:
+        result_cache.put(cache_key, {"diagnosis": diagnosis, "confidence": confidence,
+                                     "detections": detected_objects, "model_versions": model_versions})
+
+    return {
+        "report_id": report_id,
+        "diagnosis": diagnosis,
+        "confidence": confidence,
+        "detections": detected_objects
+    }
+
+
+# --- LIST PAGINATION ---
+# Keyset pagination: each page continues after the sort key of the last row sent,
+# so page 500 costs the same index seek as page 1 (no OFFSET). The body stays a plain
+# list; the cursor for the next page comes back in the X-Next-Cursor header and is
+# absent on the last page. ?fields=a,b returns only those fields of each item.
+# Paging is opt-in: a request with neither ?limit= nor ?cursor= gets every row.
+def encode_cursor(values):
+    return base64.urlsafe_b64encode(json.dumps(list(values)).encode()).decode()
+
+
+def decode_cursor(cursor, size):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except ValueError:
+        values = None
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return values
+
+
+def page_fields(fields, columns):
+    # columns: {field: SQL expression}; returns the requested field names in order
+    if not fields:
+        return list(columns)
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in columns]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(unknown)} "
+                                                    f"(choose from {', '.join(columns)})")
+    return names
+
+
+def page_limit(limit, cursor):
+    # None (no paging) when the client asked for neither a page size nor a page
+    if limit is None and not cursor:
+        return None
+    return min(max(limit or PAGE_SIZE, 1), MAX_PAGE_SIZE)
+
+
+def fetch_page(conn, sql, params, keys, names, limit):
+    # sql selects the sort key columns first, then the fields in names, and ends
+    # with its ORDER BY. One extra row tells whether there is a next page.
+    if limit is None:
+        return [dict(zip(names, row[keys:])) for row in conn.execute(sql, params).fetchall()], None
+    rows = conn.execute(f"{sql} LIMIT ?", (*params, limit + 1)).fetchall()
+    items = [dict(zip(names, row[keys:])) for row in rows[:limit]]
+    next_cursor = encode_cursor(rows[limit - 1][:keys]) if len(rows) > limit else None
+    return items, next_cursor
+
+
+def page_response(items, next_cursor):
+    if next_cursor:
+        return JSONResponse(content=items, headers={"X-Next-Cursor": next_cursor})
+    return items
+
+
 # --- ENDPOINTS ---
 
 @app.post("/register")
-def register_user(user: RegisterRequest):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+async def register_user(user: RegisterRequest):
     try:
-        cursor.execute(
+        await adb.execute(
             "INSERT INTO users (username, password, full_name, email, role, license_id) VALUES (?, ?, ?, ?, ?, ?)",
             (user.username, user.password, user.full_name, user.email, user.role, user.license_id))
-        conn.commit()
     except sqlite3.IntegrityError:
-        conn.close()
         raise HTTPException(status_code=400, detail="Username already exists")
-    conn.close()
     return {"message": "User registered", "username": user.username}
 
 
 @app.post("/token")
-def login(username: str = Form(...), password: str = Form(...)):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM users WHERE (username = ? OR email = ?) AND password = ?",
-                   (username, username, password))
-    user = cursor.fetchone()
-    conn.close()
+async def login(username: str = Form(...), password: str = Form(...)):
+    user = await adb.fetchone("SELECT * FROM users WHERE (username = ? OR email = ?) AND password = ?",
+                              (username, username, password))
 
     if user:
-        return {"access_token": user[1], "token_type": "bearer",
+        return {"access_token": create_token(TOKEN_KEY, user[0], user[1], user[5], user[7]), "token_type": "bearer",
                 "user": {"username": user[1], "full_name": user[4], "role": user[5]}}
     else:
         raise HTTPException(status_code=400, detail="Invalid credentials")
 
 
 @app.get("/users/me")
-def read_users_me(current_user: dict = Depends(get_current_user)):
-    return current_user
+async def read_users_me(current_user: dict = Depends(get_user_profile)):
+    return {key: value for key, value in current_user.items() if key != "token_version"}
 
 
 @app.put("/users/update")
-def update_user_profile(profile: UpdateProfileRequest, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    cursor.execute("""
+async def update_user_profile(profile: UpdateProfileRequest, current_user: dict = Depends(get_current_user)):
+    await adb.execute("""
         UPDATE users 
         SET full_name = ?, email = ?, role = ?, license_id = ?
         WHERE username = ?
     """, (profile.full_name, profile.email, profile.role, profile.license_id, current_user['username']))
-
+    user_cache.invalidate(current_user['username'])
+    # The old token still carries the old role until it expires
+    return {"message": "Profile updated successfully",
+            "access_token": create_token(TOKEN_KEY, current_user['id'], current_user['username'], profile.role,
+                                         current_user['token_version'])}
+
+
+def set_password(conn, username, password):
+    # Returns the new token version
+    conn.execute("UPDATE users SET password = ?, token_version = token_version + 1 WHERE username = ?",
+                 (password, username))
+    version = conn.execute("SELECT token_version FROM users WHERE username = ?", (username,)).fetchone()[0]
     conn.commit()
-    conn.close()
-    return {"message": "Profile updated successfully"}
+    return version
 
 
 @app.post("/users/change-password")
-def change_password(payload: ChangePasswordRequest, current_user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT password FROM users WHERE username = ?", (current_user['username'],))
-    stored_password = cursor.fetchone()[0]
+async def change_password(payload: ChangePasswordRequest, current_user: dict = Depends(get_current_user)):
+    stored_password = (await adb.fetchone("SELECT password FROM users WHERE username = ?",
+                                          (current_user['username'],)))[0]
 
     if stored_password != payload.current_password:
-        conn.close()
         raise HTTPException(status_code=400, detail="Current password is incorrect.")
 
-    cursor.execute("UPDATE users SET password = ? WHERE username = ?", (payload.new_password, current_user['username']))
-    conn.commit()
-    conn.close()
+    version = await adb.run(set_password, current_user['username'], payload.new_password)
+    user_cache.invalidate(current_user['username'])
+
+    # Every token issued before this one stops working, on every device
+    return {"message": "Password updated successfully.",
+            "access_token": create_token(TOKEN_KEY, current_user['id'], current_user['username'], current_user['role'],
+                                         version)}
+
 
-    return {"message": "Password updated successfully."}
+# --- DASHBOARD COUNTERS ---
+# dashboard_stats is kept current by triggers (see migrations.py); a periodic full
+# recount corrects any drift, e.g. from rows edited outside the app
+def reconcile_stats_loop():
+    while True:
+        time.sleep(STATS_RECONCILE_SECONDS)
+        try:
+            drift = reconcile_dashboard_stats(db.connect())
+            if drift:
+                print(f"⚠️ Dashboard counters had drifted, corrected: {drift}")
+        except Exception as e:
+            print(f"❌ Dashboard counter reconciliation failed: {e}")
 
 
 @app.get("/dashboard/stats")
-def get_stats():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM patients")
-    total_patients = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM reports WHERE status='Pending'")
-    pending = cursor.fetchone()[0]
-    cursor.execute("SELECT COUNT(*) FROM reports WHERE diagnosis LIKE '%Acute%'")
-    critical = cursor.fetchone()[0]
-    conn.close()
+async def get_stats():
+    total_patients, pending, critical = await adb.fetchone(
+        "SELECT total_patients, pending_reports, critical_alerts FROM dashboard_stats WHERE id = 1")
     return {"total_patients": total_patients, "pending_reports": pending, "critical_alerts": critical}
 
 
 @app.post("/patients/register")
-def register_patient(patient: PatientRequest):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+async def register_patient(patient: PatientRequest):
     try:
-        cursor.execute("INSERT INTO patients (name, mrn, nhs_number, dob, gender, history) VALUES (?, ?, ?, ?, ?, ?)",
-                       (patient.name, patient.mrn, patient.nhs_number, patient.dob, patient.gender, patient.history))
-        conn.commit()
-        pid = cursor.lastrowid
+        pid = await adb.execute(
+            "INSERT INTO patients (name, mrn, nhs_number, dob, gender, history) VALUES (?, ?, ?, ?, ?, ?)",
+            (patient.name, patient.mrn, patient.nhs_number, patient.dob, patient.gender, patient.history))
     except sqlite3.IntegrityError as e:
-        conn.close()
         if "UNIQUE constraint failed" in str(e): raise HTTPException(status_code=400, detail="MRN already exists")
         raise HTTPException(status_code=500, detail=f"Database Error: {e}")
-    conn.close()
     return {"id": pid}
 
 
+PATIENT_FIELDS = {"id": "id", "name": "name", "mrn": "mrn", "nhs_number": "nhs_number", "dob": "dob",
+                  "gender": "gender", "history": "history"}
+
+
 @app.get("/patients")
-def get_patients():
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM patients ORDER BY id DESC")
-    rows = cursor.fetchall()
-    conn.close()
-    patients = []
-    for row in rows:
-        patients.append(
-            {
-                "id": row[0],
-                "name": row[1],
-                "mrn": row[2],
-                "nhs_number": row[3],
-                "dob": row[4],
-                "gender": row[5],
-                "history": row[6]
-            }
-        )
-    return patients
+async def get_patients(limit: Optional[int] = None, cursor: Optional[str] = None, fields: Optional[str] = None):
+    # Newest first, paged on id
+    names = page_fields(fields, PATIENT_FIELDS)
+    where, params = "", ()
+    if cursor:
+        where, params = "WHERE id < ?", tuple(decode_cursor(cursor, 1))
+
+    patients, next_cursor = await adb.run(fetch_page, f"""
+        SELECT id, {', '.join(PATIENT_FIELDS[n] for n in names)}
+        FROM patients {where} ORDER BY id DESC
+    """, params, 1, names, page_limit(limit, cursor))
+    return page_response(patients, next_cursor)
+
+
+def save_upload(source, file_path):
+    # Streams the upload to disk (on a worker thread), hashing it for the result cache
+    hasher = hashlib.sha256()
+    with open(file_path, "wb") as buffer:
+        while chunk := source.read(1024 * 1024):
+            hasher.update(chunk)
+            buffer.write(chunk)
+    return hasher.hexdigest()
 
 
 @app.post("/upload")
@@ -374,155 +566,297 @@ async def upload_slide(
         assigned_to_id: str = Form(...),
         user: dict = Depends(get_current_user)
 ):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
     # 1. Verify Consultant
-    cursor.execute("SELECT username FROM users WHERE username = ? OR license_id = ?", (assigned_to_id, assigned_to_id))
-    consultant = cursor.fetchone()
+    with timed("upload", "consultant_lookup"):
+        consultant = await adb.fetchone("SELECT username FROM users WHERE username = ? OR license_id = ?",
+                                        (assigned_to_id, assigned_to_id))
 
     if not consultant:
-        conn.close()
         raise HTTPException(status_code=400, detail="Consultant ID not found in system")
 
     consultant_username = consultant[0]
 
-    # 2. Save File
+    # 2. Save File (hashed as it streams in, for the result cache)
     file_extension = file.filename.split(".")[-1]
     filename = f"{uuid.uuid4()}.{file_extension}"
     file_path = os.path.join(UPLOAD_DIR, filename)
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
-
-    # 3. RUN INFERENCE ON ALL MODELS
-    detected_objects = []
-    class_names = []
-    highest_conf = 0.0
-
-    for model in loaded_models:
-        results = model(file_path)
-
-        for result in results:
-            img_h, img_w = result.orig_shape
-
-            for box in result.boxes:
-                x1, y1, x2, y2 = box.xyxy[0].tolist()
-                conf = float(box.conf[0])
-                cls = int(box.cls[0])
-                label = model.names[cls]
-
-                x_pct = (x1 / img_w) * 100
-                y_pct = (y1 / img_h) * 100
-                w_pct = ((x2 - x1) / img_w) * 100
-                h_pct = ((y2 - y1) / img_h) * 100
-
-                detected_objects.append({
-                    "x": x_pct,
-                    "y": y_pct,
-                    "w": w_pct,
-                    "h": h_pct,
-                    "label": label,
-                    "score": f"{int(conf * 100)}%"
-                })
-
-                class_names.append(label)
-                if conf > highest_conf:
-                    highest_conf = conf
-
-    if class_names:
-        most_common = Counter(class_names).most_common(1)
-        diagnosis = most_common[0][0]
-        confidence = f"{int(highest_conf * 100)}%"
-    else:
-        diagnosis = "No Abnormalities Detected"
-        confidence = "100%"
-
-    detections_json = json.dumps(detected_objects)
+    with timed("upload", "file_write"):
+        content_hash = await run_in_threadpool(save_upload, file.file, file_path)
 
-    cursor.execute("""
-        INSERT INTO reports (patient_id, date, image_url, diagnosis, confidence, assigned_to, notes, sample_type, sample_date, detections) 
-        VALUES (?, datetime('now'), ?, ?, ?, ?, ?, ?, ?, ?)
-    """, (patient_id, f"/uploads/{filename}", diagnosis, confidence, consultant_username, notes, sample_type,
-          sample_date, detections_json))
+    # Refused from the header alone, before anything tries to decode it
+    try:
+        await run_in_threadpool(check_image_size, file_path, MAX_IMAGE_PIXELS)
+    except ImageTooLargeError as e:
+        os.remove(file_path)
+        raise HTTPException(status_code=413, detail=str(e))
+
+    with timed("upload", "cache_lookup"):
+        cache_key = result_cache.key(content_hash, ANALYSIS_SETTINGS)
+        cached = result_cache.get(cache_key)
+
+    # 3a. Same image already analysed with these weights: reuse its detections
+    if cached:
+        def insert_cached_report(conn):
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO reports (patient_id, date, image_url, diagnosis, confidence, assigned_to, notes, sample_type, sample_date, model_versions, uploaded_by) 
+                VALUES (?, datetime('now'), ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """, (patient_id, f"/uploads/{filename}", cached["diagnosis"], cached["confidence"], consultant_username,
+                  notes, sample_type, sample_date, json.dumps(cached["model_versions"]), user['username']))
+            save_detections(conn, cursor.lastrowid, cached["detections"])
+            conn.commit()
+            return cursor.lastrowid
+
+        with timed("upload", "db_insert"):
+            report_id = await adb.run(insert_cached_report)
+
+        return {
+            "report_id": report_id,
+            "job_id": None,
+            "status": "Pending",
+            "cached": True,
+            "diagnosis": cached["diagnosis"],
+            "confidence": cached["confidence"],
+            "image_url": f"/uploads/{filename}",
+            "assigned_to": consultant_username
+        }
+
+    # 3b. Create the report now and analyse it in the background
+    job_id = str(uuid.uuid4())
+    with timed("upload", "db_insert"):
+        report_id = await adb.execute("""
+            INSERT INTO reports (patient_id, date, image_url, diagnosis, status, assigned_to, notes, sample_type, sample_date, job_id, uploaded_by) 
+            VALUES (?, datetime('now'), ?, ?, 'Analysing', ?, ?, ?, ?, ?, ?)
+        """, (patient_id, f"/uploads/{filename}", "Analysing", consultant_username, notes, sample_type, sample_date,
+              job_id, user['username']))
 
-    conn.commit()
-    report_id = cursor.lastrowid
-    conn.close()
+    try:
+        job = job_queue.submit(analyse_slide, report_id, file_path, cache_key, report_id=report_id, job_id=job_id)
+    except QueueFullError:
+        await adb.execute("DELETE FROM reports WHERE id = ?", (report_id,))
+        os.remove(file_path)
+        raise HTTPException(status_code=503, detail="Analysis queue is full, please retry shortly")
 
     return {
         "report_id": report_id,
-        "diagnosis": diagnosis,
-        "confidence": confidence,
+        "job_id": job.id,
+        "status": "Analysing",
+        "cached": False,
         "image_url": f"/uploads/{filename}",
         "assigned_to": consultant_username
     }
 
 
+# --- JOB STATUS ---
+# A job's status is its report's status, so any worker process can answer, also
+# after a restart. The JobQueue of the process running the job only adds detail
+# (queued or running, progress, timings) while it is in flight.
+JOB_STATUS = {"Analysing": "running", "Failed": "failed"}  # Anything else: done
+
+
+async def load_job(job_id, user):
+    row = await adb.fetchone("SELECT id, status, diagnosis, confidence, uploaded_by, assigned_to "
+                             "FROM reports WHERE job_id = ?", (job_id,))
+    if not row:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if user['username'] not in (row[4], row[5]):
+        raise HTTPException(status_code=403,
+                            detail="Unauthorized: Only the uploader or the assigned consultant can view this job.")
+    return row
+
+
+def job_state(job_id, row):
+    job = job_queue.get(job_id)
+    if job and row[1] == "Analysing":
+        return job.to_dict()
+    state = job.to_dict() if job else {"job_id": job_id, "report_id": row[0], "progress": 0.0, "error": None,
+                                       "queued_seconds": None, "run_seconds": None}
+    state["status"] = JOB_STATUS.get(row[1], "done")
+    if state["status"] == "done":
+        state["progress"] = 1.0
+    elif state["status"] == "failed":
+        state["error"] = state["error"] or row[2]
+    return state
+
+
+@app.get("/jobs/{job_id}")
+async def get_job_status(job_id: str, user: dict = Depends(get_current_user)):
+    return job_state(job_id, await load_job(job_id, user))
+
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str, user: dict = Depends(get_current_user)):
+    row = await load_job(job_id, user)
+    state = job_state(job_id, row)
+    if state["status"] == "failed":
+        raise HTTPException(status_code=500, detail=f"Analysis failed: {state['error']}")
+    if state["status"] != "done":
+        raise HTTPException(status_code=409, detail=f"Job is still {state['status']}")
+    detections = await adb.run(lambda conn: load_detections(conn.cursor(), row[0]))
+    return {"report_id": row[0], "diagnosis": row[2], "confidence": row[3], "detections": detections}
+
+
+@app.get("/health/ready")
+def health_ready():
+    # For the load balancer: 200 only once every model is loaded and warmed up.
+    # With lazy loading (BENTARA_WARMUP_WORKERS=0) models warm on first use instead.
+    if inference_client:
+        try:
+            stats = inference_client.stats()
+        except Exception as e:
+            return JSONResponse(status_code=503, content={"ready": False, "error": f"Inference server: {e}"})
+        return stats if stats["ready"] else JSONResponse(status_code=503, content=stats)
+
+    if WARMUP_WORKERS > 0 and not model_warmup.ready:
+        return JSONResponse(status_code=503, content=model_warmup.stats())
+    return model_warmup.stats() if WARMUP_WORKERS > 0 else {"ready": True, "models": {}}
+
+
+@app.get("/models")
+def get_models(user: dict = Depends(get_current_user)):
+    # Registered models, which are resident, their memory and load/eviction counts
+    if inference_client:
+        return inference_client.stats()
+    return model_registry.stats()
+
+
+@app.get("/resources")
+def get_resources(user: dict = Depends(get_current_user)):
+    # Threads/cores given to each inference worker and how busy they are
+    if inference_client:
+        return inference_client.resources()
+    return resources.stats()
+
+
+# --- METRICS ---
+# Read on every /metrics scrape, next to the stage latency histograms
+def model_stats():
+    return inference_client.stats()["models"] if inference_client else model_registry.stats()
+
+
+REGISTRY.gauge("bentara_queue_depth", "Slides waiting for a job worker", job_queue.depth)
+REGISTRY.gauge("bentara_jobs_in_flight", "Slides being analysed right now", lambda: job_queue.running)
+REGISTRY.gauge("bentara_model_memory_bytes", "Weight memory of each resident model",
+               lambda: [((name, m["backend"]), m["memory_mb"] * 1e6) for name, m in model_stats()["models"].items()],
+               labels=("model", "backend"))
+REGISTRY.gauge("bentara_db_pending_queries", "Queries waiting for or running on the database threads",
+               lambda: adb.pending)
+REGISTRY.gauge("bentara_event_loop_lag_max_seconds", "Longest event loop stall since the last scrape",
+               loop_lag.take_worst)
+REGISTRY.gauge("bentara_model_process_rss_bytes", "Resident memory of the process holding the models",
+               lambda: model_stats()["process_rss_mb"] * 1e6)
+
+
+@app.get("/metrics")
+def get_metrics():
+    # Prometheus text format, for the scraper (no auth, like /health/ready)
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+def swap_model(name, version, backend):
+    if inference_client:
+        # The server swaps in its parent process, then rolls its workers over to it
+        model_registry.swaps[name] = {"status": "loading", "version": version or "default"}
+        try:
+            label = inference_client.swap(name, version, backend)
+        except Exception as e:
+            model_registry.swaps[name].update(status="failed", error=str(e))
+            print(f"❌ Inference server could not swap {name}: {e}")
+            return
+        # Mirror the new version here so the result cache fingerprint follows it
+        model_registry.register(name, version, backend or model_registry.entry(name).backend)
+        model_registry.swaps[name].update(status="live", version=label)
+        models_changed(name)
+        return
+
+    try:
+        model_registry.swap(name, version, backend, warmup=warm_up_model)
+    except Exception:
+        return  # Logged by the registry; the old version keeps serving
+    models_changed(name)
+
+
+@app.post("/models/{name}/swap", status_code=202)
+def request_model_swap(name: str, swap: ModelSwapRequest, background_tasks: BackgroundTasks,
+                       user: dict = Depends(get_user_profile)):
+    # Loads and warms up the new weights in the background; GET /models shows progress
+    if not (user['username'] in MODEL_ADMINS if MODEL_ADMINS else is_consultant(user)):
+        raise HTTPException(status_code=403, detail="Unauthorized: Only model administrators can swap models.")
+    if name not in model_registry:
+        raise HTTPException(status_code=404, detail="Model not registered")
+    if model_registry.swaps.get(name, {}).get("status") in ("loading", "warming up"):
+        raise HTTPException(status_code=409, detail="A swap of this model is already in progress")
+    if swap.backend and swap.backend not in MODEL_SUFFIXES:
+        raise HTTPException(status_code=400, detail=f"Unknown backend '{swap.backend}'")
+
+    background_tasks.add_task(swap_model, name, swap.version, swap.backend)
+    return {"model": name, "version": swap.version or "default", "status": "loading",
+            "current": model_registry.entry(name).label}
+
+
+PENDING_REPORT_FIELDS = {
+    "id": "r.id", "patient_name": "p.name", "patient_mrn": "p.mrn", "date": "r.date", "diagnosis": "r.diagnosis",
+    "confidence": "r.confidence", "assigned_to": "r.assigned_to", "image_url": "r.image_url",
+    "patient_id": "r.patient_id", "sample_type": "r.sample_type", "sample_date": "r.sample_date"
+}
+
+
 @app.get("/reports/pending")
-def get_pending_reports(user: dict = Depends(get_current_user)):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT r.id, p.name, p.mrn, r.date, r.diagnosis, r.confidence, r.assigned_to, r.image_url, r.patient_id, r.sample_type, r.sample_date
+async def get_pending_reports(limit: Optional[int] = None, cursor: Optional[str] = None, fields: Optional[str] = None,
+                              user: dict = Depends(get_current_user)):
+    # This consultant's worklist, oldest first, paged on report id
+    names = page_fields(fields, PENDING_REPORT_FIELDS)
+    after = decode_cursor(cursor, 1)[0] if cursor else 0
+
+    reports, next_cursor = await adb.run(fetch_page, f"""
+        SELECT r.id, {', '.join(PENDING_REPORT_FIELDS[n] for n in names)}
         FROM reports r
         JOIN patients p ON r.patient_id = p.id
-        WHERE r.status = 'Pending' AND r.assigned_to = ?
-    """, (user['username'],))
-    rows = cursor.fetchall()
-    conn.close()
-
-    reports = []
-    for row in rows:
-        reports.append({
-            "id": row[0],
-            "patient_name": row[1],
-            "patient_mrn": row[2],
-            "date": row[3],
-            "diagnosis": row[4],
-            "confidence": row[5],
-            "assigned_to": row[6],
-            "image_url": row[7],
-            "patient_id": row[8],
-            "sample_type": row[9],
-            "sample_date": row[10]
-        })
-    return reports
+        WHERE r.status = 'Pending' AND r.assigned_to = ? AND r.id > ?
+        ORDER BY r.id
+    """, (user['username'], after), 1, names, page_limit(limit, cursor))
+    return page_response(reports, next_cursor)
 
 
 @app.post("/reports/{report_id}/signoff")
-def sign_off_report(report_id: int, user: dict = Depends(get_current_user)):
-    if "Consultant" not in user['role'] and "Pathologist" not in user['role']:
+async def sign_off_report(report_id: int, user: dict = Depends(get_user_profile)):
+    if not is_consultant(user):
         raise HTTPException(status_code=403, detail="Unauthorized: Only Consultants can sign off reports.")
 
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("UPDATE reports SET status = 'Authorized' WHERE id = ?", (report_id,))
-
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     details = f"Authorized by {user['full_name']} ({user['role']})"
-    cursor.execute(
-        "INSERT INTO audit_logs (report_id, action, performed_by, timestamp, details) VALUES (?, ?, ?, ?, ?)",
-        (report_id, "AUTHORIZED", user['username'], timestamp, details))
 
-    conn.commit()
-    conn.close()
+    def authorize(conn):
+        # Status change and its audit entry in one transaction. Only a Pending report
+        # can be signed off: not one still being analysed, failed or already signed.
+        cursor = conn.cursor()
+        cursor.execute("UPDATE reports SET status = 'Authorized' WHERE id = ? AND status = 'Pending'", (report_id,))
+        if not cursor.rowcount:
+            row = cursor.execute("SELECT status FROM reports WHERE id = ?", (report_id,)).fetchone()
+            return row[0] if row else None
+        cursor.execute(
+            "INSERT INTO audit_logs (report_id, action, performed_by, timestamp, details) VALUES (?, ?, ?, ?, ?)",
+            (report_id, "AUTHORIZED", user['username'], timestamp, details))
+        conn.commit()
+        return "Pending"
+
+    previous_status = await adb.run(authorize)
+    if previous_status is None:
+        raise HTTPException(status_code=404, detail="Report not found")
+    if previous_status != "Pending":
+        raise HTTPException(status_code=409, detail=f"Report is {previous_status}, only Pending reports can be signed off.")
     return {"message": "Report authorized and audited."}
 
 
 @app.get("/patients/{patient_id}")
-def get_patient_details(patient_id: int):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM patients WHERE id = ?", (patient_id,))
-    patient = cursor.fetchone()
+async def get_patient_details(patient_id: int):
+    patient = await adb.fetchone("SELECT * FROM patients WHERE id = ?", (patient_id,))
     if not patient: raise HTTPException(status_code=404)
 
-    cursor.execute("""
+    reports_rows = await adb.fetchall("""
         SELECT id, date, diagnosis, confidence, status, image_url, assigned_to, sample_type, sample_date 
         FROM reports WHERE patient_id = ? ORDER BY id DESC
     """, (patient_id,))
-    reports_rows = cursor.fetchall()
-    conn.close()
 
     reports = []
     for r in reports_rows:
@@ -538,33 +872,36 @@ def get_patient_details(patient_id: int):
 
 
 @app.get("/reports/{report_id}")
-def get_single_report(report_id: int):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT r.id, r.date, r.diagnosis, r.confidence, r.status, r.image_url, r.notes, r.sample_type, r.sample_date, 
-               p.name, p.mrn, p.nhs_number, p.dob, p.gender, u.full_name, u.role, r.detections
-        FROM reports r
-        JOIN patients p ON r.patient_id = p.id
-        LEFT JOIN users u ON r.assigned_to = u.username
-        WHERE r.id = ?
-    """, (report_id,))
-    row = cursor.fetchone()
+async def get_single_report(report_id: int):
+    with timed("report", "report_query"):
+        row = await adb.fetchone("""
+            SELECT r.id, r.date, r.diagnosis, r.confidence, r.status, r.image_url, r.notes, r.sample_type, r.sample_date, 
+                   p.name, p.mrn, p.nhs_number, p.dob, p.gender, u.full_name, u.role, r.model_versions
+            FROM reports r
+            JOIN patients p ON r.patient_id = p.id
+            LEFT JOIN users u ON r.assigned_to = u.username
+            WHERE r.id = ?
+        """, (report_id,))
 
     if not row:
-        conn.close()
         raise HTTPException(status_code=404, detail="Report not found")
 
-    cursor.execute("SELECT action, performed_by, timestamp, details FROM audit_logs WHERE report_id = ?", (report_id,))
-    logs = cursor.fetchall()
+    with timed("report", "audit_query"):
+        logs = await adb.fetchall("SELECT action, performed_by, timestamp, details FROM audit_logs WHERE report_id = ?",
+                                  (report_id,))
     audit_trail = [{"action": l[0], "user": l[1], "time": l[2], "details": l[3]} for l in logs]
 
-    conn.close()
+    def detections_and_counts(conn):
+        cursor = conn.cursor()
+        detections = load_detections(cursor, report_id)
+        cursor.execute("""
+            SELECT c.name, COUNT(*) FROM detections d JOIN cell_classes c ON d.class_id = c.id
+            WHERE d.report_id = ? GROUP BY c.name
+        """, (report_id,))
+        return detections, dict(cursor.fetchall())
 
-    try:
-        detections = json.loads(row[16]) if row[16] else []
-    except:
-        detections = []
+    with timed("report", "detections_query"):
+        detections, cell_counts = await adb.run(detections_and_counts)
 
     return {
         "id": row[0], "date": row[1], "diagnosis": row[2], "confidence": row[3], "status": row[4],
@@ -572,11 +909,71 @@ def get_single_report(report_id: int):
         "patient": {"name": row[9], "mrn": row[10], "nhs_number": row[11], "dob": row[12], "gender": row[13]},
         "consultant": {"name": row[14], "role": row[15]},
         "detections": detections,
+        "cell_counts": cell_counts,
+        "model_versions": json.loads(row[16]) if row[16] else {},
         "audit_trail": audit_trail
     }
 
 
+# --- ANALYTICS ---
+@app.get("/analytics/cells")
+async def get_cell_analytics(patient_id: Optional[int] = None, start: Optional[str] = None,
+                             end: Optional[str] = None, user: dict = Depends(get_current_user)):
+    # Cell counts per class and per day, aggregated in SQL from the detections table.
+    # Optional filters: one patient, and report dates from start to end (YYYY-MM-DD, inclusive).
+    where, params = ["r.status != 'Failed'"], []
+    if patient_id is not None:
+        where.append("r.patient_id = ?")
+        params.append(patient_id)
+    if start:
+        where.append("r.date >= ?")
+        params.append(start)
+    if end:
+        where.append("r.date < date(?, '+1 day')")
+        params.append(end)
+    where = " AND ".join(where)
+
+    reports = (await adb.fetchone(f"SELECT COUNT(*) FROM reports r WHERE {where}", params))[0]
+
+    rows = await adb.fetchall(f"""
+        SELECT c.name, COUNT(*), COUNT(DISTINCT d.report_id), AVG(d.confidence)
+        FROM detections d
+        JOIN reports r ON d.report_id = r.id
+        JOIN cell_classes c ON d.class_id = c.id
+        WHERE {where}
+        GROUP BY c.name ORDER BY COUNT(*) DESC
+    """, params)
+    classes = [{"label": label, "cells": cells, "reports": n, "mean_confidence": round(conf, 4)}
+               for label, cells, n, conf in rows]
+
+    rows = await adb.fetchall(f"""
+        SELECT date(r.date), c.name, COUNT(*)
+        FROM detections d
+        JOIN reports r ON d.report_id = r.id
+        JOIN cell_classes c ON d.class_id = c.id
+        WHERE {where}
+        GROUP BY date(r.date), c.name ORDER BY date(r.date)
+    """, params)
+    daily = [{"date": day, "label": label, "cells": cells} for day, label, cells in rows]
+
+    return {"reports": reports, "classes": classes, "daily": daily}
+
+
 # --- RESEARCH ENDPOINTS ---
+# File writes and the JPEG conversion run on worker threads, off the event loop
+def write_file(path, contents):
+    with open(path, "wb") as f:
+        f.write(contents)
+
+
+def convert_research_image(temp_path, jpg_filename):
+    with Image.open(temp_path) as img:
+        rgb_img = img.convert('RGB')
+        # Save for Training Dataset
+        rgb_img.save(os.path.join(DATASET_DIR, "images", jpg_filename), "JPEG", quality=95)
+        # Save for App UI Gallery preview
+        rgb_img.save(os.path.join(UPLOAD_DIR, jpg_filename), "JPEG")
+
 
 @app.post("/research/upload")
 async def upload_research_sample(
@@ -596,85 +993,64 @@ async def upload_research_sample(
         contents = await file.read()
         # Save temp file
         temp_path = os.path.join(UPLOAD_DIR, file.filename)
-        with open(temp_path, "wb") as f:
-            f.write(contents)
+        with timed("research_upload", "file_write"):
+            await run_in_threadpool(write_file, temp_path, contents)
 
-        with Image.open(temp_path) as img:
-            rgb_img = img.convert('RGB')
-            # Save for Training Dataset
-            rgb_img.save(os.path.join(DATASET_DIR, "images", jpg_filename), "JPEG", quality=95)
-            # Save for App UI Gallery preview
-            rgb_img.save(os.path.join(UPLOAD_DIR, jpg_filename), "JPEG")
+        with timed("research_upload", "jpeg_convert"):
+            await run_in_threadpool(convert_research_image, temp_path, jpg_filename)
 
         os.remove(temp_path)  # Cleanup temp original file
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Image processing failed: {e}")
 
     # 3. Create YOLO formatted label file (.txt)
-    save_yolo_label(base_name, annotations)
+    with timed("research_upload", "label_write"):
+        await run_in_threadpool(save_yolo_label, base_name, annotations)
 
     # 4. Save metadata to Database
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
-
     user_id = user['id']
 
-    cursor.execute("""
-        INSERT INTO research_samples (contributor_id, sample_type, image_url, annotations, notes, date)
-        VALUES (?, ?, ?, ?, ?, datetime('now'))
-    """, (user_id, sample_type, f"/uploads/{jpg_filename}", annotations, notes))
-
-    conn.commit()
-    conn.close()
+    with timed("research_upload", "db_insert"):
+        await adb.execute("""
+            INSERT INTO research_samples (contributor_id, sample_type, image_url, annotations, notes, date)
+            VALUES (?, ?, ?, ?, ?, datetime('now'))
+        """, (user_id, sample_type, f"/uploads/{jpg_filename}", annotations, notes))
 
     return {"message": "Contribution saved and processed for training dataset"}
 
 
-@app.get("/research/gallery")
-def get_research_gallery(sample_type: Optional[str] = None):
-    conn = sqlite3.connect(DB_NAME)
-    cursor = conn.cursor()
+# box_count handles both the old list-only annotations and the {"cells": [...]} format
+GALLERY_FIELDS = {
+    "id": "r.id", "type": "r.sample_type", "image_url": "r.image_url", "annotations": "r.annotations",
+    "contributor": "COALESCE(u.full_name, 'Anonymous')", "date": "r.date",
+    "box_count": """CASE WHEN NOT json_valid(r.annotations) THEN 0
+                         WHEN json_type(r.annotations, '$.cells') IS NOT NULL THEN json_array_length(r.annotations, '$.cells')
+                         ELSE json_array_length(r.annotations) END"""
+}
 
-    query = "SELECT r.id, r.sample_type, r.image_url, r.annotations, u.full_name, r.date FROM research_samples r LEFT JOIN users u ON r.contributor_id = u.id"
-    params = []
 
+@app.get("/research/gallery")
+async def get_research_gallery(sample_type: Optional[str] = None, limit: Optional[int] = None,
+                               cursor: Optional[str] = None, fields: Optional[str] = None):
+    # Newest first, paged on (date, id). List views can leave out the heavy
+    # annotations JSON with e.g. ?fields=id,type,image_url,contributor,date,box_count
+    names = page_fields(fields, GALLERY_FIELDS)
+    where, params = [], []
     if sample_type:
-        query += " WHERE r.sample_type = ?"
+        where.append("r.sample_type = ?")
         params.append(sample_type)
-
-    # Default sort newest first
-    query += " ORDER BY r.date DESC"
-
-    cursor.execute(query, tuple(params))
-    rows = cursor.fetchall()
-    conn.close()
-
-    gallery = []
-    for r in rows:
-        try:
-            # Parse the JSON annotation string
-            parsed_ann = json.loads(r[3])
-
-            # Handle both old list-only format and new nested dictionary format
-            if isinstance(parsed_ann, dict) and 'cells' in parsed_ann:
-                box_count = len(parsed_ann['cells'])
-            else:
-                box_count = len(parsed_ann)
-        except Exception as e:
-            print(f"Error parsing sample {r[0]}: {e}")
-            box_count = 0
-
-        gallery.append({
-            "id": r[0],
-            "type": r[1],
-            "image_url": r[2],
-            "annotations": r[3],
-            "contributor": r[4] if r[4] else "Anonymous",
-            "date": r[5],
-            "box_count": box_count
-        })
-
-    return gallery
+    if cursor:
+        where.append("(r.date, r.id) < (?, ?)")
+        params += decode_cursor(cursor, 2)
+    where = f"WHERE {' AND '.join(where)}" if where else ""
+
+    gallery, next_cursor = await adb.run(fetch_page, f"""
+        SELECT r.date, r.id, {', '.join(GALLERY_FIELDS[n] for n in names)}
+        FROM research_samples r LEFT JOIN users u ON r.contributor_id = u.id
+        {where}
+        ORDER BY r.date DESC, r.id DESC
+    """, params, 2, names, page_limit(limit, cursor))
+    return page_response(gallery, next_cursor)
 
 
 app.mount("/uploads", StaticFiles(directory="uploads"), name="uploads")
@@ -0,0 +1,183 @@
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+
+# --- LATENCY METRICS ---
+# Small in-process histograms rendered in the Prometheus text format at /metrics.
+# Every stage of a request (file write, consultant lookup, each model's forward pass,
+# post-processing, SQLite writes, ...) is one series of bentara_stage_seconds,
+# labelled by request path, stage and model.
+
+# Upper bounds in seconds; from a fast SQLite query up to a slow tiled slide
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def format_labels(names, values, extra=""):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}  # label values -> [count per bucket..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labels)
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        with self._lock:
+            series = {key: list(values) for key, values in self._series.items()}
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, values in sorted(series.items()):
+            for bound, count in zip(self.buckets + (float("inf"),), values[:len(self.buckets)] + [values[-1]]):
+                labels = format_labels(self.labels, key, f'le="{format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {count}")
+            labels = format_labels(self.labels, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(values[-2])}")
+            lines.append(f"{self.name}_count{labels} {values[-1]}")
+        return lines
+
+
+class Gauge:
+    # Read when /metrics is scraped: collect() returns a number, or a list of
+    # (label values, number) for several series
+    def __init__(self, name, help_text, collect, labels=()):
+        self.name = name
+        self.help = help_text
+        self.collect = collect
+        self.labels = tuple(labels)
+
+    def render(self):
+        try:
+            values = self.collect()
+        except Exception as e:
+            return [f"# {self.name} unavailable: {escape(e)}"]
+        if not isinstance(values, list):
+            values = [((), values)]
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        for key, value in values:
+            if value is not None:
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {format_value(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics = {}
+
+    def histogram(self, name, help_text, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.metrics.setdefault(name, Histogram(name, help_text, labels, buckets))
+
+    def gauge(self, name, help_text, collect, labels=()):
+        self.metrics[name] = Gauge(name, help_text, collect, labels)
+        return self.metrics[name]
+
+    def render(self):
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+STAGE_SECONDS = REGISTRY.histogram("bentara_stage_seconds", "Time spent in each stage of a request",
+                                   ("path", "stage", "model"))
+
+
+@contextmanager
+def timed(path, stage, model=""):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, path=path, stage=stage, model=model)
+
+
+def record_timings(path, timings):
+    # timings: [(stage, model, seconds)] from a StageTimer, e.g. one that came back
+    # from an inference worker process with the analysis
+    for stage, model, seconds in timings:
+        STAGE_SECONDS.observe(seconds, path=path, stage=stage, model=model)
+
+
+# --- PER-SLIDE STAGE TIMER ---
+# Collects stage times while a slide is analysed, possibly in another process.
+# A stage hit several times (e.g. a model run on every tile) is summed into one time.
+class StageTimer:
+    def __init__(self):
+        self.totals = {}  # (stage, model) -> seconds
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, stage, model=""):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.totals[(stage, model)] = self.totals.get((stage, model), 0.0) + elapsed
+
+    def timings(self):
+        with self._lock:
+            return [(stage, model, seconds) for (stage, model), seconds in self.totals.items()]
+
+
+# --- EVENT LOOP LAG ---
+# A task on the event loop asks to wake up every interval and records how late it
+# woke. Anything run on the loop without awaiting (a sync query, a big file write)
+# delays it, so this is how long the loop was blocked for every other request.
+EVENT_LOOP_LAG = REGISTRY.histogram("bentara_event_loop_lag_seconds", "How late the event loop ran a timer",
+                                    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                                             2.5, 5.0))
+
+
+class LoopLagMonitor:
+    def __init__(self, interval):
+        self.interval = interval
+        self.worst = 0.0  # Since the last scrape
+        self._lock = threading.Lock()
+
+    async def run(self):
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, time.perf_counter() - start - self.interval)
+            EVENT_LOOP_LAG.observe(lag)
+            with self._lock:
+                self.worst = max(self.worst, lag)
+
+    def take_worst(self):
+        with self._lock:
+            worst, self.worst = self.worst, 0.0
+        return worst
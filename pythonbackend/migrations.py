@@ -0,0 +1,344 @@
+import json
+import sqlite3
+import sys
+
+# --- SCHEMA MIGRATIONS ---
+# The schema version lives in the database itself (PRAGMA user_version). Each
+# migration runs once, in order, inside its own write transaction, so a failed
+# migration leaves the database on the previous version. Never edit a migration that
+# has shipped: add a new one at the end.
+
+
+def add_model_versions(conn):
+    # Databases from before versioned migrations may already have the column
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(reports)")]
+    if "model_versions" not in columns:
+        conn.execute("ALTER TABLE reports ADD COLUMN model_versions TEXT")
+
+
+def normalize_detections(conn):
+    # One row per detected cell instead of a JSON blob on each report. Boxes are
+    # percentages of the image (what the frontend draws), confidence is 0-1.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS cell_classes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT UNIQUE NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS detections (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            report_id INTEGER NOT NULL,
+            class_id INTEGER NOT NULL,
+            x REAL, y REAL, w REAL, h REAL,
+            confidence REAL NOT NULL,
+            model_version TEXT,
+            FOREIGN KEY(report_id) REFERENCES reports(id),
+            FOREIGN KEY(class_id) REFERENCES cell_classes(id)
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_detections_report ON detections(report_id)")
+    # Analytics filter reports by date
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reports_date ON reports(date)")
+
+    # Move the existing JSON detections over; their model is not known
+    rows = []
+    for report_id, blob in conn.execute("SELECT id, detections FROM reports WHERE detections IS NOT NULL").fetchall():
+        try:
+            boxes = json.loads(blob)
+        except ValueError:
+            continue
+        for box in boxes:
+            if not isinstance(box, dict) or "label" not in box:
+                continue
+            try:
+                confidence = float(str(box.get("score", "0")).rstrip("%")) / 100  # "87%" -> 0.87
+            except ValueError:
+                confidence = 0.0
+            rows.append((report_id, box["label"], box.get("x"), box.get("y"), box.get("w"), box.get("h"), confidence))
+
+    conn.executemany("INSERT OR IGNORE INTO cell_classes (name) VALUES (?)", {(row[1],) for row in rows})
+    class_ids = dict(conn.execute("SELECT name, id FROM cell_classes").fetchall())
+    conn.executemany("INSERT INTO detections (report_id, class_id, x, y, w, h, confidence) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     [(row[0], class_ids[row[1]], *row[2:]) for row in rows])
+    # reports.detections is left as it was: nothing reads it any more, and clearing
+    # it is for a later migration once the converted rows have been checked
+
+
+# --- DASHBOARD COUNTERS ---
+# /dashboard/stats reads one row kept current by triggers on every write path
+# (patients registered, reports inserted / updated / deleted). The same predicates
+# drive the triggers and the full recount that reconciles any drift.
+PENDING = "status = 'Pending'"
+CRITICAL = "diagnosis LIKE '%Acute%'"
+DASHBOARD_COUNTS_SQL = f"""
+    SELECT (SELECT COUNT(*) FROM patients),
+           (SELECT COUNT(*) FROM reports WHERE {PENDING}),
+           (SELECT COUNT(*) FROM reports WHERE {CRITICAL})
+"""
+
+
+def counter_delta(row):
+    # "+ (pending?) , + (critical?)" of a NEW or OLD report row, NULL counted as 0
+    return (f"COALESCE({row}.{PENDING}, 0)", f"COALESCE({row}.{CRITICAL}, 0)")
+
+
+def dashboard_counters(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS dashboard_stats (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_patients INTEGER NOT NULL DEFAULT 0,
+            pending_reports INTEGER NOT NULL DEFAULT 0,
+            critical_alerts INTEGER NOT NULL DEFAULT 0,
+            reconciled_at TEXT
+        )
+    """)
+    conn.execute(f"INSERT OR REPLACE INTO dashboard_stats (id, total_patients, pending_reports, critical_alerts, "
+                 f"reconciled_at) SELECT 1, *, datetime('now') FROM ({DASHBOARD_COUNTS_SQL})")
+
+    new_pending, new_critical = counter_delta("NEW")
+    old_pending, old_critical = counter_delta("OLD")
+    triggers = {
+        "patients_insert_stats": ("AFTER INSERT ON patients", "total_patients = total_patients + 1"),
+        "patients_delete_stats": ("AFTER DELETE ON patients", "total_patients = total_patients - 1"),
+        "reports_insert_stats": ("AFTER INSERT ON reports",
+                                 f"pending_reports = pending_reports + {new_pending}, "
+                                 f"critical_alerts = critical_alerts + {new_critical}"),
+        "reports_delete_stats": ("AFTER DELETE ON reports",
+                                 f"pending_reports = pending_reports - {old_pending}, "
+                                 f"critical_alerts = critical_alerts - {old_critical}"),
+        "reports_update_stats": ("AFTER UPDATE OF status, diagnosis ON reports",
+                                 f"pending_reports = pending_reports + {new_pending} - {old_pending}, "
+                                 f"critical_alerts = critical_alerts + {new_critical} - {old_critical}")
+    }
+    for name, (event, change) in triggers.items():
+        conn.execute(f"CREATE TRIGGER IF NOT EXISTS {name} {event} BEGIN "
+                     f"UPDATE dashboard_stats SET {change} WHERE id = 1; END")
+
+
+def reconcile_dashboard_stats(conn):
+    # Full recount under the write lock (so no insert lands between the count and
+    # the fix). Returns {counter: drift} for the counters that were off.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        actual = conn.execute(DASHBOARD_COUNTS_SQL).fetchone()
+        stored = conn.execute("SELECT total_patients, pending_reports, critical_alerts FROM dashboard_stats "
+                              "WHERE id = 1").fetchone() or (0, 0, 0)
+        conn.execute("INSERT OR REPLACE INTO dashboard_stats (id, total_patients, pending_reports, critical_alerts, "
+                     "reconciled_at) VALUES (1, ?, ?, ?, datetime('now'))", actual)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    names = ("total_patients", "pending_reports", "critical_alerts")
+    return {name: s - a for name, s, a in zip(names, stored, actual) if s != a}
+
+
+# (version, description, SQL statements or a function taking the connection)
+MIGRATIONS = [
+    (1, "baseline schema", [
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            username TEXT UNIQUE NOT NULL,
+            email TEXT,
+            password TEXT NOT NULL,
+            full_name TEXT,
+            role TEXT,
+            license_id TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS patients (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL,
+            mrn TEXT UNIQUE NOT NULL,
+            nhs_number TEXT NOT NULL,
+            dob TEXT NOT NULL,
+            gender TEXT NOT NULL,
+            history TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS reports (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            patient_id INTEGER,
+            date TEXT,
+            image_url TEXT,
+            diagnosis TEXT,
+            confidence TEXT,
+            status TEXT DEFAULT 'Pending',
+            assigned_to TEXT,
+            sample_type TEXT,
+            sample_date TEXT,
+            notes TEXT,
+            detections TEXT,
+            FOREIGN KEY(patient_id) REFERENCES patients(id)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS audit_logs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            report_id INTEGER,
+            action TEXT,
+            performed_by TEXT,
+            timestamp TEXT,
+            details TEXT
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS research_samples (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            contributor_id INTEGER,
+            sample_type TEXT,
+            image_url TEXT,
+            annotations TEXT,
+            notes TEXT,
+            date TEXT,
+            status TEXT DEFAULT 'Unverified'
+        )
+        '''
+    ]),
+    (2, "model versions used for each report", add_model_versions),
+    (3, "indexes for the hot queries", [
+        # /reports/pending: WHERE assigned_to = ? AND status = 'Pending'
+        "CREATE INDEX IF NOT EXISTS idx_reports_assigned_status ON reports(assigned_to, status)",
+        # /patients/{id}: WHERE patient_id = ? ORDER BY id DESC (the rowid rides along in the index)
+        "CREATE INDEX IF NOT EXISTS idx_reports_patient ON reports(patient_id)",
+        # /reports/{id}: the audit trail
+        "CREATE INDEX IF NOT EXISTS idx_audit_logs_report ON audit_logs(report_id)",
+        # /research/gallery: optional sample_type filter, newest first
+        "CREATE INDEX IF NOT EXISTS idx_research_type_date ON research_samples(sample_type, date)",
+        "CREATE INDEX IF NOT EXISTS idx_research_date ON research_samples(date)",
+        # Consultant lookup on upload (username OR license_id) and login (username OR email)
+        "CREATE INDEX IF NOT EXISTS idx_users_license ON users(license_id)",
+        "CREATE INDEX IF NOT EXISTS idx_users_email ON users(email)"
+    ]),
+    (4, "detections table instead of the reports.detections JSON", normalize_detections),
+    (5, "dashboard counters maintained by triggers", dashboard_counters),
+    (6, "analysis job and uploader on each report", [
+        # /jobs/{id} reads the job's status from its report, so any worker (or a
+        # restarted one) can answer, and only the uploader or consultant may read it
+        "ALTER TABLE reports ADD COLUMN job_id TEXT",
+        "ALTER TABLE reports ADD COLUMN uploaded_by TEXT",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_reports_job ON reports(job_id)"
+    ]),
+    (7, "token version on each user", [
+        # Bumped on a password change; tokens carrying an older version are refused
+        "ALTER TABLE users ADD COLUMN token_version INTEGER NOT NULL DEFAULT 0"
+    ])
+]
+
+
+def schema_version(conn):
+    return conn.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(conn):
+    # Returns the versions applied. Safe to run from several processes at once:
+    # BEGIN IMMEDIATE serialises them and each re-checks the version under the lock.
+    applied = []
+    for version, description, step in MIGRATIONS:
+        if schema_version(conn) >= version:
+            continue
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if schema_version(conn) >= version:
+                conn.rollback()
+                continue
+            if callable(step):
+                step(conn)
+            else:
+                for sql in step:
+                    conn.execute(sql)
+            conn.execute(f"PRAGMA user_version = {version}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        print(f"🗄️ Migrated database to version {version}: {description}")
+        applied.append(version)
+    return applied
+
+
+# --- QUERY PLAN CHECK ---
+# The queries behind the busiest endpoints, with sample parameters. Keep these in
+# step with main.py: each one must be answered from an index, never a full scan.
+HOT_QUERIES = {
+    "dashboard": ("SELECT total_patients, pending_reports, critical_alerts FROM dashboard_stats WHERE id = 1", ()),
+    "consultant lookup": ("SELECT username FROM users WHERE username = ? OR license_id = ?", ("x", "x")),
+    "login": ("SELECT * FROM users WHERE (username = ? OR email = ?) AND password = ?", ("x", "x", "x")),
+    "current user": ("SELECT username, full_name, email, role, license_id, id, token_version FROM users "
+                     "WHERE username = ?", ("x",)),
+    "patients page": ("SELECT id, name, mrn FROM patients WHERE id < ? ORDER BY id DESC LIMIT ?", (1, 100)),
+    "pending reports": ("""
+        SELECT r.id, p.name, p.mrn, r.date, r.diagnosis, r.confidence, r.assigned_to, r.image_url, r.patient_id, r.sample_type, r.sample_date
+        FROM reports r
+        JOIN patients p ON r.patient_id = p.id
+        WHERE r.status = 'Pending' AND r.assigned_to = ? AND r.id > ?
+        ORDER BY r.id LIMIT ?
+    """, ("x", 0, 100)),
+    "patient reports": ("""
+        SELECT id, date, diagnosis, confidence, status, image_url, assigned_to, sample_type, sample_date
+        FROM reports WHERE patient_id = ? ORDER BY id DESC
+    """, (1,)),
+    "report": ("""
+        SELECT r.id, r.date, r.diagnosis, r.confidence, r.status, r.image_url, r.notes, r.sample_type, r.sample_date,
+               p.name, p.mrn, p.nhs_number, p.dob, p.gender, u.full_name, u.role, r.model_versions
+        FROM reports r
+        JOIN patients p ON r.patient_id = p.id
+        LEFT JOIN users u ON r.assigned_to = u.username
+        WHERE r.id = ?
+    """, (1,)),
+    "report detections": ("""
+        SELECT c.name, d.x, d.y, d.w, d.h, d.confidence, d.model_version
+        FROM detections d
+        JOIN cell_classes c ON d.class_id = c.id
+        WHERE d.report_id = ? ORDER BY d.id
+    """, (1,)),
+    "job": ("SELECT id, status, diagnosis, confidence, uploaded_by, assigned_to FROM reports WHERE job_id = ?",
+            ("x",)),
+    "audit trail": ("SELECT action, performed_by, timestamp, details FROM audit_logs WHERE report_id = ?", (1,)),
+    "gallery by type": ("SELECT r.date, r.id, r.sample_type, r.image_url, u.full_name "
+                        "FROM research_samples r LEFT JOIN users u ON r.contributor_id = u.id "
+                        "WHERE r.sample_type = ? AND (r.date, r.id) < (?, ?) ORDER BY r.date DESC, r.id DESC LIMIT ?",
+                        ("x", "x", 1, 100)),
+    "gallery": ("SELECT r.date, r.id, r.sample_type, r.image_url, u.full_name "
+                "FROM research_samples r LEFT JOIN users u ON r.contributor_id = u.id "
+                "ORDER BY r.date DESC, r.id DESC LIMIT ?", (100,))
+}
+
+
+def plan_problems(detail):
+    # "SCAN reports" is a full table scan; "SCAN x USING INDEX" walks an index in
+    # order, which is fine for a sorted listing. A temp b-tree means sorting in memory.
+    if detail.startswith("SCAN ") and " USING " not in detail:
+        return f"full table scan ({detail})"
+    if detail.startswith("USE TEMP B-TREE"):
+        return f"sort without an index ({detail})"
+    return None
+
+
+def check_query_plans(conn, queries=HOT_QUERIES):
+    # Returns {query name: [problems]} for every hot query that lost its index
+    problems = {}
+    for name, (sql, params) in queries.items():
+        for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params):
+            problem = plan_problems(row[3])
+            if problem:
+                problems.setdefault(name, []).append(problem)
+    return problems
+
+
+if __name__ == "__main__":
+    # python migrations.py [database]: migrate, then exit 1 if a hot query scans
+    conn = sqlite3.connect(sys.argv[1] if len(sys.argv) > 1 else "bentara.db")
+    migrate(conn)
+    print(f"🗄️ Schema version {schema_version(conn)}")
+    problems = check_query_plans(conn)
+    for name, issues in problems.items():
+        print(f"❌ {name}: {'; '.join(issues)}")
+    conn.close()
+    if problems:
+        sys.exit(1)
+    print(f"✅ All {len(HOT_QUERIES)} hot queries use an index")
@@ -0,0 +1,437 @@
+import glob
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from result_cache import model_fingerprint
+
+# Weight file for each backend: "<stem><suffix>", or "<stem>@<version><suffix>" for a pinned version
+MODEL_SUFFIXES = {"torch": ".pt", "onnx": ".onnx", "int8": ".int8.onnx"}
+VERSION_SEP = "@"
+
+
+def model_bytes(model, path):
+    # Resident size of the weights: parameters + buffers for PyTorch, the ONNX file
+    # (initializers dominate) for ONNX Runtime sessions
+    module = getattr(model, "model", None)
+    if hasattr(module, "parameters"):
+        tensors = list(module.parameters()) + list(module.buffers())
+        return sum(t.numel() * t.element_size() for t in tensors)
+    return os.path.getsize(path)
+
+
+def process_rss():
+    # Resident set size of this process in bytes (Linux only, 0 elsewhere)
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+class ModelEntry:
+    def __init__(self, name, backend, version=None, path=None):
+        self.name = name
+        self.backend = backend
+        self.version = version  # None = the unversioned "<stem><suffix>" file
+        self.path = path  # Explicit path, bypasses resolution in model_dir
+        self.fingerprint = None  # Identity of the weights file, set at registration
+        self.model = None
+        self.bytes = 0
+        self.loads = 0
+        self.evictions = 0
+        self.last_used = None
+        self.load_seconds = None
+        self.load_lock = threading.Lock()
+
+    @property
+    def label(self):
+        # What reports record, e.g. "v2#3fa2c1d0e5b6a7f8" or "default#..."
+        return f"{self.version or 'default'}#{self.fingerprint}"
+
+
+# --- MODEL REGISTRY ---
+# Models are registered by name (the .pt file name the rest of the backend uses) and
+# only loaded the first time someone asks for one. Loaded models are kept in LRU
+# order; when their combined size goes over memory_budget_mb the least recently used
+# ones are dropped and simply reloaded on their next use. Acts as a read-only
+# {name: model} mapping, so EnsembleRunner can use it in place of a dict.
+class ModelRegistry:
+    def __init__(self, loader, model_dir="models", default_backend="torch", memory_budget_mb=0):
+        # loader(path, backend) -> model object
+        self.loader = loader
+        self.model_dir = model_dir
+        self.default_backend = default_backend
+        self.memory_budget = int(memory_budget_mb * 1e6)  # 0 = no limit
+        self._entries = {}
+        self._resident = OrderedDict()  # name -> entry, least recently used first
+        self._lock = threading.Lock()
+        self.swaps = {}  # name -> state of the latest hot swap
+
+    # --- Resolution ---
+    def resolve(self, name, version=None, backend=None):
+        stem = os.path.splitext(name)[0]
+        if version:
+            stem = f"{stem}{VERSION_SEP}{version}"
+        return os.path.join(self.model_dir, stem + MODEL_SUFFIXES[backend or self.default_backend])
+
+    def versions(self, name, backend=None):
+        # Pinned versions available on disk for this model, e.g. ["2024-06", "v2"]
+        stem = os.path.splitext(name)[0]
+        suffix = MODEL_SUFFIXES[backend or self.default_backend]
+        pattern = os.path.join(self.model_dir, f"{glob.escape(stem)}{VERSION_SEP}*{suffix}")
+        found = [os.path.basename(p)[len(stem) + 1:-len(suffix)] for p in glob.glob(pattern)]
+        # "*.onnx" also matches "x@v2.int8.onnx", which belongs to the int8 backend
+        others = tuple(s[:-len(suffix)] for s in MODEL_SUFFIXES.values() if s != suffix and s.endswith(suffix))
+        return sorted(v for v in found if not v.endswith(others))
+
+    def path(self, name):
+        entry = self._entries[name]
+        return entry.path or self.resolve(name, entry.version, entry.backend)
+
+    def _new_entry(self, name, version, backend, path):
+        # None when the weights are not in model_dir. An explicit path is trusted
+        # as is (ultralytics downloads its stock weights).
+        entry = ModelEntry(name, backend or self.default_backend, version, path)
+        resolved = path or self.resolve(name, version, entry.backend)
+        if not os.path.exists(resolved):
+            return None if path is None else entry
+        entry.fingerprint = model_fingerprint([resolved])
+        return entry
+
+    def register(self, name, version=None, backend=None, path=None):
+        # Returns False (and registers nothing) when the weights are not on disk
+        entry = self._new_entry(name, version, backend, path)
+        if entry is None:
+            return False
+        with self._lock:
+            self._entries[name] = entry
+        return True
+
+    def paths(self):
+        # Weight files currently on disk (a fallback may not be downloaded yet)
+        return [path for path in map(self.path, self) if os.path.exists(path)]
+
+    def entry(self, name):
+        return self._entries[name]
+
+    # --- Loading / eviction ---
+    def get(self, name):
+        return self.load(self._entries[name])
+
+    def _load(self, entry):
+        path = entry.path or self.resolve(entry.name, entry.version, entry.backend)
+        print(f"✅ Loading: {entry.name} ({entry.backend}, {os.path.basename(path)})")
+        started = time.perf_counter()
+        model = self.loader(path, entry.backend)
+        entry.load_seconds = time.perf_counter() - started
+        entry.bytes = model_bytes(model, path)
+        entry.loads += 1
+        return model
+
+    def load(self, entry):
+        if self._entries.get(entry.name) is not entry:
+            # Swapped out after a slide pinned it: that slide finishes on these weights,
+            # but they are not kept resident any more
+            return entry.model or self._load(entry)
+
+        with self._lock:
+            if entry.model is not None:
+                self._touch(entry)
+                return entry.model
+
+        # One load per model at a time; other models keep serving meanwhile
+        with entry.load_lock:
+            with self._lock:
+                if entry.model is not None:  # Loaded by another thread while we waited
+                    self._touch(entry)
+                    return entry.model
+
+            model = self._load(entry)
+            with self._lock:
+                entry.model = model
+                self._touch(entry)
+                self._enforce_budget(keep=entry.name)
+            return model
+
+    def snapshot(self):
+        # The model versions a slide starts with, whatever gets swapped meanwhile
+        with self._lock:
+            return ModelSet(self, dict(self._entries))
+
+    # --- Hot swap ---
+    def swap(self, name, version=None, backend=None, path=None, warmup=None):
+        # Loads (and warms up) the new weights while the current ones keep serving,
+        # then replaces them in one step. Slides already running keep the old model
+        # through their ModelSet; it is freed once the last of them finishes.
+        current = self._entries.get(name)
+        backend = backend or (current.backend if current else None)
+        self.swaps[name] = {"status": "loading", "version": version or "default", "started": time.time()}
+        try:
+            entry = self._new_entry(name, version, backend, path)
+            if entry is None:
+                raise FileNotFoundError(f"No weights for {name} version {version or 'default'} "
+                                        f"in '{self.model_dir}'")
+            model = self._load(entry)
+            if warmup:
+                self.swaps[name]["status"] = "warming up"
+                warmup(name, model)
+        except Exception as e:
+            self.swaps[name].update(status="failed", error=str(e), finished=time.time())
+            print(f"❌ Swap of {name} failed, still serving {current.label if current else 'nothing'}: {e}")
+            raise
+
+        with self._lock:
+            self._entries[name] = entry
+            if name in self._resident:
+                self._resident.pop(name).model = None
+            entry.model = model
+            self._touch(entry)
+            self._enforce_budget(keep=name)
+
+        self.swaps[name].update(status="live", version=entry.label, finished=time.time())
+        print(f"🔁 Swapped {name}: {current.label if current else 'none'} -> {entry.label}")
+        return entry
+
+    __getitem__ = get
+
+    def _touch(self, entry):
+        entry.last_used = time.time()
+        self._resident[entry.name] = entry
+        self._resident.move_to_end(entry.name)
+
+    def _enforce_budget(self, keep):
+        # Called with self._lock held. A model still running a forward pass stays
+        # alive until it finishes (the caller holds a reference); it is just no
+        # longer handed out.
+        if not self.memory_budget:
+            return
+        while self.resident_bytes() > self.memory_budget:
+            victim = next((n for n in self._resident if n != keep), None)
+            if victim is None:
+                break
+            self._evict(victim)
+
+    def _evict(self, name):
+        entry = self._resident.pop(name)
+        entry.model = None
+        entry.evictions += 1
+        print(f"♻️ Evicted {name} ({entry.bytes / 1e6:.1f} MB) to stay within the model memory budget")
+
+    def evict(self, name):
+        with self._lock:
+            if name in self._resident:
+                self._evict(name)
+
+    def resident_bytes(self):
+        return sum(entry.bytes for entry in self._resident.values())
+
+    # --- Mapping interface ---
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        # (name, model) pairs, each model loaded as it is reached
+        for name in self:
+            yield name, self.get(name)
+
+    def stats(self):
+        with self._lock:
+            models = {
+                name: {"backend": e.backend, "version": e.label,
+                       "path": e.path or self.resolve(name, e.version, e.backend),
+                       "loaded": e.model is not None, "memory_mb": round(e.bytes / 1e6, 1),
+                       "loads": e.loads, "evictions": e.evictions, "last_used": e.last_used,
+                       "load_seconds": None if e.load_seconds is None else round(e.load_seconds, 3)}
+                for name, e in self._entries.items()
+            }
+            return {"models": models, "swaps": self.swaps, "resident_mb": round(self.resident_bytes() / 1e6, 1),
+                    "budget_mb": round(self.memory_budget / 1e6, 1) if self.memory_budget else None,
+                    "process_rss_mb": round(process_rss() / 1e6, 1)}
+
+
+# --- PINNED MODEL SET ---
+# A read-only {name: model} view of the registry as it was when snapshot() was called.
+# Each model is resolved once on first use and then held, so one slide never mixes
+# weight versions, even if a swap lands halfway through it.
+class ModelSet:
+    def __init__(self, registry, entries):
+        self.registry = registry
+        self._entries = entries
+        self._models = {}
+
+    def __getitem__(self, name):
+        if name not in self._models:
+            self._models[name] = self.registry.load(self._entries[name])
+        return self._models[name]
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __iter__(self):
+        return iter(list(self._entries))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def versions(self):
+        # {name: version label} of the models this slide actually ran
+        return {name: self._entries[name].label for name in self._models}
+
+    def label_sources(self):
+        # {class label: "model@version"} over the models this slide ran; a label more
+        # than one model can output is credited to the first of them
+        sources = {}
+        for name, model in self._models.items():
+            for label in model.names.values():
+                sources.setdefault(label, f"{name}{VERSION_SEP}{self._entries[name].label}")
+        return sources
+
+
+# --- MODELS FOLDER WATCHER ---
+# Polls the weight file behind every registered model and hot-swaps it when it has
+# been replaced on disk. A change has to look the same on two polls in a row, so a
+# file that is still being copied in is not picked up half-written.
+class ModelWatcher:
+    def __init__(self, registry, interval=10.0, warmup=None, on_swap=None, thread=True):
+        # thread=False: no polling thread, the owner calls poll() every interval itself
+        self.registry = registry
+        self.interval = interval
+        self.warmup = warmup
+        self.on_swap = on_swap  # Called after every successful swap
+        self._seen = {}
+        self._failed = {}  # name -> fingerprint that failed to load, not retried
+
+        if thread:
+            threading.Thread(target=self._loop, name="model-watcher", daemon=True).start()
+
+    def _loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.poll()
+
+    def poll(self):
+        for name in self.registry:
+            try:
+                self.check(name)
+            except Exception as e:
+                print(f"⚠️ Model watcher: {name}: {e}")
+
+    def check(self, name):
+        entry = self.registry.entry(name)
+        path = self.registry.path(name)
+        if entry.fingerprint is None or not os.path.exists(path):
+            return
+        fingerprint = model_fingerprint([path])
+        if fingerprint in (entry.fingerprint, self._failed.get(name)):
+            self._seen.pop(name, None)
+            return
+        if self._seen.get(name) != fingerprint:
+            self._seen[name] = fingerprint  # Seen once; swap if it is unchanged next poll
+            return
+
+        self._seen.pop(name, None)
+        try:
+            self.registry.swap(name, entry.version, entry.backend, entry.path, warmup=self.warmup)
+        except Exception:
+            self._failed[name] = fingerprint
+            raise
+        if self.on_swap:
+            self.on_swap(name)
+
+
+# --- STARTUP LOADING + WARMUP ---
+# Loads every registered model on a small thread pool and runs its warmup, in the
+# background so the API can already answer health checks. ready only turns True once
+# every model is loaded and warm.
+class ModelWarmup:
+    def __init__(self, registry, warmup, workers=4):
+        # warmup(name, model) runs the dummy forward passes for one model
+        self.registry = registry
+        self.warmup = warmup
+        self.workers = workers
+        self.models = {}  # name -> load/warmup timings and status
+        self.started = None
+        self.finished = None
+
+    def start(self):
+        self.started = time.perf_counter()
+        self.models = {name: {"status": "pending"} for name in self.registry}
+        threading.Thread(target=self._run, name="model-warmup", daemon=True).start()
+
+    def _run(self):
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="warmup") as pool:
+            list(pool.map(self._warm, list(self.models)))
+        self.finished = time.perf_counter()
+
+        if self.ready:
+            print(f"🚀 All {len(self.models)} models warm after {self.finished - self.started:.1f}s")
+        else:
+            failed = [name for name, state in self.models.items() if state["status"] != "ready"]
+            print(f"❌ Not ready, models failed to load: {', '.join(failed)}")
+
+    def _warm(self, name):
+        state = self.models[name]
+        try:
+            state["status"] = "loading"
+            started = time.perf_counter()
+            model = self.registry.get(name)
+            state["load_seconds"] = round(time.perf_counter() - started, 3)
+
+            state["status"] = "warming up"
+            started = time.perf_counter()
+            self.warmup(name, model)
+            state["warmup_seconds"] = round(time.perf_counter() - started, 3)
+            state["status"] = "ready"
+        except Exception as e:
+            state.update(status="failed", error=str(e))
+            print(f"❌ Failed to load {name}: {e}")
+        # Time-to-ready, counted from the start of startup loading
+        state["ready_after_seconds"] = round(time.perf_counter() - self.started, 3)
+
+    @property
+    def ready(self):
+        return self.finished is not None and all(s["status"] == "ready" for s in self.models.values())
+
+    def stats(self):
+        elapsed = None
+        if self.started is not None:
+            elapsed = round((self.finished or time.perf_counter()) - self.started, 3)
+        models = {name: dict(state) for name, state in self.models.items()}  # Still being updated
+        return {"ready": self.ready, "seconds": elapsed, "models": models}
+
+
+# --- OTHER ENTRY POINTS ---
+def load_yolo(path, backend):
+    # ultralytics runs an exported .onnx file through ONNX Runtime itself
+    from ultralytics import YOLO
+    return YOLO(path, task="detect")
+
+
+def registry_from_paths(paths, backend=None, memory_budget_mb=None, loader=load_yolo):
+    # For the entry points outside the API (the Streamlit app, analyse.py,
+    # scripts/app.py, the desktop CellDetector), whose weights live in their own
+    # folders: paths is {name: .pt file}, and the onnx/int8 backends use the file
+    # exported next to it. BENTARA_MODEL_BACKEND / BENTARA_MODEL_MEMORY_MB apply as in the API.
+    backend = backend or os.environ.get("BENTARA_MODEL_BACKEND", "torch")
+    if memory_budget_mb is None:
+        memory_budget_mb = float(os.environ.get("BENTARA_MODEL_MEMORY_MB", "0"))
+    registry = ModelRegistry(loader, default_backend=backend, memory_budget_mb=memory_budget_mb)
+    for name, path in paths.items():
+        path = path and os.path.splitext(path)[0] + MODEL_SUFFIXES[backend]
+        if path and os.path.exists(path):
+            registry.register(name, backend=backend, path=path)
+        else:
+            print(f"⚠️ Model file missing for {name}: {path}")
+    return registry
@@ -0,0 +1,76 @@
+import ast
+
+import numpy as np
+
+from fusion import nms
+
+try:
+    import onnxruntime as ort
+except ImportError:  # Only needed when a model is served with the "onnx" backend
+    ort = None
+
+OPTIMIZATION_LEVELS = {
+    "disable": "ORT_DISABLE_ALL",
+    "basic": "ORT_ENABLE_BASIC",
+    "extended": "ORT_ENABLE_EXTENDED",
+    "all": "ORT_ENABLE_ALL"
+}
+
+
+# --- ONNX RUNTIME CPU MODEL ---
+# Serves a YOLOv8 detector exported by export_onnx.py. It exposes the same .names
+# mapping as an ultralytics YOLO object and returns the same (xyxy, conf, cls) arrays
+# EnsembleRunner gets from PyTorch, so everything downstream is unchanged.
+class OnnxModel:
+    def __init__(self, path, intra_threads=0, inter_threads=0, optimization="all", iou=0.7, max_det=300):
+        if ort is None:
+            raise RuntimeError("onnxruntime is not installed (pip install onnxruntime)")
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_threads  # 0 lets onnxruntime pick
+        options.inter_op_num_threads = inter_threads
+        options.graph_optimization_level = getattr(ort.GraphOptimizationLevel, OPTIMIZATION_LEVELS[optimization])
+
+        self.path = path
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+        self.iou = iou
+        self.max_det = max_det
+
+        # ultralytics writes the class names and input size into the model metadata
+        meta = self.session.get_modelmeta().custom_metadata_map
+        self.names = ast.literal_eval(meta["names"]) if "names" in meta else {}
+
+        batch, _, height, width = self.session.get_inputs()[0].shape
+        self.fixed_batch = isinstance(batch, int)
+        # Exported without dynamic=True: inputs must be exactly this size
+        self.fixed_shape = (height, width) if isinstance(height, int) and isinstance(width, int) else None
+
+    def predict_arrays(self, tensor, conf=0.25):
+        batch = tensor.numpy() if hasattr(tensor, "numpy") else tensor
+        batch = np.ascontiguousarray(batch, dtype=np.float32)
+
+        if self.fixed_batch and len(batch) > 1:
+            outputs = [self.session.run(None, {self.input_name: batch[i:i + 1]})[0] for i in range(len(batch))]
+            raw = np.concatenate(outputs)
+        else:
+            raw = self.session.run(None, {self.input_name: batch})[0]
+
+        return [self._decode(pred, conf) for pred in raw]
+
+    def _decode(self, pred, conf):
+        # YOLOv8 head: (4 + num_classes, anchors) with cx, cy, w, h then class scores
+        pred = pred.T
+        scores = pred[:, 4:]
+        classes = scores.argmax(axis=1)
+        confs = scores[np.arange(len(scores)), classes]
+
+        keep = confs > conf
+        boxes, confs, classes = pred[keep, :4], confs[keep], classes[keep]
+
+        xyxy = np.empty_like(boxes)
+        xyxy[:, :2] = boxes[:, :2] - boxes[:, 2:] / 2
+        xyxy[:, 2:] = boxes[:, :2] + boxes[:, 2:] / 2
+
+        keep = nms(xyxy, confs, self.iou, classes=classes)[:self.max_det]
+        return xyxy[keep], confs[keep].astype(np.float32), classes[keep].astype(int)
@@ -0,0 +1,74 @@
+import numpy as np
+
+
+# --- ARRAY POST-PROCESSING ---
+# Boxes stay as whole NumPy arrays (xyxy, confs, labels) from the model output right
+# up to the JSON boundary, instead of one tensor -> Python conversion per box.
+
+def result_arrays(result):
+    # ultralytics Results -> (xyxy float32 (N, 4), conf float32 (N,), cls int (N,))
+    boxes = result.boxes
+    return (boxes.xyxy.cpu().numpy(), boxes.conf.cpu().numpy(),
+            boxes.cls.cpu().numpy().astype(int))
+
+
+def label_array(names, classes):
+    # model.names is {class_id: name}; index it with the whole class array at once
+    lookup = np.array([names[c] for c in range(len(names))], dtype=object)
+    return lookup[classes]
+
+
+def empty_detections():
+    return np.zeros((0, 4), dtype=np.float32), np.zeros(0, dtype=np.float32), np.array([], dtype=object)
+
+
+def concat_detections(parts):
+    # parts: list of (xyxy, confs, labels) -> one (xyxy, confs, labels)
+    if not parts:
+        return empty_detections()
+    return (np.concatenate([p[0] for p in parts]), np.concatenate([p[1] for p in parts]),
+            np.concatenate([p[2] for p in parts]))
+
+
+def to_percent(xyxy, img_w, img_h):
+    # Pixel xyxy -> frontend top-left x/y and width/height as 0-100 percentages
+    scale = np.array([img_w, img_h, img_w, img_h], dtype=np.float64)
+    pct = xyxy.astype(np.float64) / scale * 100
+    pct[:, 2:] -= pct[:, :2]
+    return pct
+
+
+def count_labels(labels):
+    unique, counts = np.unique(labels.astype(str), return_counts=True)
+    return dict(zip(unique.tolist(), counts.tolist()))
+
+
+def summarize(confs, labels):
+    # Most frequent label (ties go to the one seen first) and the top confidence,
+    # formatted the way reports store them
+    if len(labels) == 0:
+        return "No Abnormalities Detected", "100%"
+
+    unique, first_seen, counts = np.unique(labels.astype(str), return_index=True, return_counts=True)
+    top = np.lexsort((first_seen, -counts))[0]
+    return str(unique[top]), f"{int(confs.max() * 100)}%"
+
+
+def score_percent(confidence):
+    # 0-1 confidence -> whole percent shown to the user, truncated after rounding off
+    # float error (0.29 * 100 is 28.999..., which must still show as 29%)
+    return int(round(confidence * 100, 4))
+
+
+def serialize_detections(xyxy, confs, labels, img_w, img_h, sources=None):
+    # The only place per-box dicts are built. "score" is the display string the
+    # frontend shows, "confidence" the raw 0-1 value stored in the detections table.
+    # sources maps a label to the model version that produces it.
+    pct = to_percent(xyxy, img_w, img_h).tolist()
+    confidences = confs.astype(np.float64)
+    sources = sources or {}
+    return [
+        {"x": x, "y": y, "w": w, "h": h, "label": label, "score": f"{score_percent(confidence)}%",
+         "confidence": confidence, "model": sources.get(label)}
+        for (x, y, w, h), label, confidence in zip(pct, labels.tolist(), confidences.tolist())
+    ]
@@ -0,0 +1,204 @@
+import glob
+import json
+import os
+import random
+import shutil
+from datetime import datetime
+
+import numpy as np
+from ultralytics import YOLO
+from ultralytics.data.utils import check_det_dataset
+
+from inference import decode_image, letterbox
+from onnx_engine import OnnxModel
+
+try:
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat, QuantType,
+                                          quantize_static)
+except ImportError:
+    CalibrationDataReader = object
+    quantize_static = None
+
+# --- QUANTIZATION JOBS ---
+# Backend weights and the dataset yaml each was trained on (same as evaluate_yolo.py / args.yaml)
+QUANTIZE_JOBS = {
+    "blood_cell_best.pt": os.path.join("..", "configs", "blood_cells.yaml"),
+    "neutrophil_best.pt": os.path.join("..", "Datasets", "Raabin_split", "Neutrophil", "Neutrophil.yaml"),
+    "lymphocyte_best.pt": os.path.join("..", "Datasets", "Raabin_split", "Lymphocyte", "Lymphocyte.yaml"),
+    "monocyte_best.pt": os.path.join("..", "Datasets", "Raabin_split", "Monocyte", "Monocyte.yaml"),
+    "eosinophil_best.pt": os.path.join("..", "Datasets", "Raabin_split", "Eosinophil", "Eosinophil.yaml")
+}
+
+IMGSZ = 640
+CALIBRATION_IMAGES = 200  # Random sample of the train split, never of the images scored
+COUNT_SAMPLE_IMAGES = 100
+
+# --- ACCURACY GATE ---
+MAX_MAP_DROP = 0.01  # Absolute mAP50-95 the INT8 model may lose vs FP32
+MAX_COUNT_DRIFT = 0.05  # Relative change allowed in the per-class detection counts
+
+# The backend loads "<name>.int8.onnx" from here when BENTARA_MODEL_BACKEND=int8.
+# Everything is built in WORK_DIR first so a model that fails the gate never lands there.
+PUBLISH_DIR = "models"
+WORK_DIR = "quantization"
+IMAGE_EXTS = (".jpg", ".jpeg", ".png", ".bmp")
+
+# Box decoding in the detection head is numerically sensitive, so those ops stay FP32
+HEAD_FLOAT_OPS = {"Concat", "Split", "Sigmoid", "Softmax", "Mul", "Add", "Sub", "Div", "Reshape", "Transpose"}
+
+
+def split_images(data_yaml, split="val", limit=None, seed=0):
+    data = check_det_dataset(data_yaml)
+    folders = data[split] if isinstance(data[split], list) else [data[split]]
+    images = sorted(p for folder in folders for p in glob.glob(os.path.join(folder, "*"))
+                    if p.lower().endswith(IMAGE_EXTS))
+    random.Random(seed).shuffle(images)
+    return images[:limit]
+
+
+def calibration_images(data_yaml, limit):
+    # From the train split, minus anything in val: the INT8 mAP is measured on val,
+    # and calibrating on those same images would flatter it (some dataset yamls
+    # point train and val at the same folder)
+    scored = {os.path.realpath(p) for p in split_images(data_yaml, "val")}
+    images = [p for p in split_images(data_yaml, "train") if os.path.realpath(p) not in scored]
+    return images[:limit]
+
+
+def to_input(image_path, imgsz=IMGSZ):
+    # Same preprocessing the backend uses at inference time
+    canvas, _, _ = letterbox(decode_image(image_path), imgsz, auto=False)
+    return np.ascontiguousarray(canvas[..., ::-1].transpose(2, 0, 1)[None], dtype=np.float32) / 255.0
+
+
+class ImageCalibrationReader(CalibrationDataReader):
+    def __init__(self, input_name, images):
+        self.input_name = input_name
+        self.images = iter(images)
+
+    def get_next(self):
+        path = next(self.images, None)
+        return None if path is None else {self.input_name: to_input(path)}
+
+
+def head_nodes(onnx_path, head_index):
+    import onnx
+    graph = onnx.load(onnx_path).graph
+    prefix = f"/model.{head_index}/"
+    # The head's conv branches (cv2 = box, cv3 = class) still get quantized; only the
+    # DFL/anchor decoding after them is kept in FP32
+    return [n.name for n in graph.node
+            if n.name.startswith(prefix) and n.op_type in HEAD_FLOAT_OPS
+            and "/cv2." not in n.name and "/cv3." not in n.name]
+
+
+def class_counts(onnx_path, images):
+    model = OnnxModel(onnx_path)
+    counts = {}
+    for path in images:
+        for _, _, classes in model.predict_arrays(to_input(path)):
+            for cls in classes.tolist():
+                label = model.names.get(cls, str(cls))
+                counts[label] = counts.get(label, 0) + 1
+    return counts
+
+
+def count_drift(fp32_counts, int8_counts):
+    drift = {}
+    for label in set(fp32_counts) | set(int8_counts):
+        base = fp32_counts.get(label, 0)
+        drift[label] = abs(int8_counts.get(label, 0) - base) / max(base, 1)
+    return drift
+
+
+def quantize_model(weights_path, data_yaml):
+    if quantize_static is None:
+        raise RuntimeError("onnxruntime is not installed (pip install onnxruntime)")
+
+    stem = os.path.splitext(os.path.basename(weights_path))[0]
+    work_dir = os.path.join(WORK_DIR, stem)
+    os.makedirs(work_dir, exist_ok=True)
+    staged_weights = os.path.join(work_dir, os.path.basename(weights_path))
+    shutil.copy(weights_path, staged_weights)
+    yolo = YOLO(staged_weights)
+
+    # 1. FP32 ONNX with a fixed input shape (static quantization calibrates per tensor shape)
+    print(f"📦 Exporting FP32 ONNX for {stem}...")
+    fp32_path = yolo.export(format="onnx", imgsz=IMGSZ, dynamic=False, simplify=True)
+    int8_path = os.path.join(work_dir, f"{stem}.int8.onnx")
+
+    # 2. Calibrate on training images and write the INT8 model
+    calibration = calibration_images(data_yaml, CALIBRATION_IMAGES)
+    if not calibration:
+        raise RuntimeError(f"No training images outside the validation split found for {data_yaml}")
+    print(f"🎯 Calibrating on {len(calibration)} training images...")
+
+    input_name = OnnxModel(fp32_path).input_name
+    quantize_static(fp32_path, int8_path, ImageCalibrationReader(input_name, calibration),
+                    quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                    nodes_to_exclude=head_nodes(fp32_path, len(yolo.model.model) - 1))
+
+    # 3. Same evaluation as evaluate_yolo.py, for both models
+    print("📊 Evaluating FP32 and INT8 models...")
+    fp32_metrics = YOLO(fp32_path, task="detect").val(data=data_yaml, imgsz=IMGSZ, batch=1, verbose=False)
+    int8_metrics = YOLO(int8_path, task="detect").val(data=data_yaml, imgsz=IMGSZ, batch=1, verbose=False)
+
+    sample = split_images(data_yaml, "val", COUNT_SAMPLE_IMAGES, seed=1)
+    fp32_counts = class_counts(fp32_path, sample)
+    int8_counts = class_counts(int8_path, sample)
+    drift = count_drift(fp32_counts, int8_counts)
+
+    report = {
+        "model": stem,
+        "timestamp": datetime.now().isoformat(),
+        "fp32": {"map50_95": float(fp32_metrics.box.map), "map50": float(fp32_metrics.box.map50),
+                 "counts": fp32_counts, "size_mb": round(os.path.getsize(fp32_path) / 1e6, 2)},
+        "int8": {"map50_95": float(int8_metrics.box.map), "map50": float(int8_metrics.box.map50),
+                 "counts": int8_counts, "size_mb": round(os.path.getsize(int8_path) / 1e6, 2)},
+        "count_drift": drift,
+        "thresholds": {"max_map_drop": MAX_MAP_DROP, "max_count_drift": MAX_COUNT_DRIFT}
+    }
+
+    # 4. Accuracy gate: only publish when INT8 stays within the thresholds
+    map_drop = report["fp32"]["map50_95"] - report["int8"]["map50_95"]
+    failures = []
+    if map_drop > MAX_MAP_DROP:
+        failures.append(f"mAP50-95 dropped by {map_drop:.4f}")
+    failures += [f"{label} count drifted {d:.1%}" for label, d in drift.items() if d > MAX_COUNT_DRIFT]
+
+    report["published"] = not failures
+    report["failures"] = failures
+
+    if failures:
+        print(f"❌ Not publishing {stem}: " + "; ".join(failures))
+    else:
+        os.makedirs(PUBLISH_DIR, exist_ok=True)
+        shutil.copy(int8_path, os.path.join(PUBLISH_DIR, f"{stem}.int8.onnx"))
+        print(f"✅ Published {stem}.int8.onnx (mAP50-95 drop {map_drop:.4f})")
+
+    with open(os.path.join(work_dir, "report.json"), "w") as f:
+        json.dump(report, f, indent=2)
+
+    return report
+
+
+def quantize_all():
+    results = {}
+    for model_file, data_yaml in QUANTIZE_JOBS.items():
+        weights_path = os.path.join("models", model_file)
+        if not os.path.exists(weights_path):
+            print(f"⚠️ Skipping {model_file}: not found in 'models' folder.")
+            continue
+        try:
+            results[model_file] = quantize_model(weights_path, data_yaml)
+        except Exception as e:
+            print(f"❌ Quantization failed for {model_file}: {e}")
+
+    published = sum(1 for r in results.values() if r["published"])
+    print(f"✨ Published {published}/{len(results)} INT8 models")
+    return results
+
+
+if __name__ == "__main__":
+    quantize_all()
@@ -0,0 +1,137 @@
+import os
+import time
+
+import torch
+
+# --- DEPLOYMENT PROFILES ---
+# Threads each inference worker gets. "latency" runs few workers with many threads
+# (one slide finishes fast), "throughput" many single-thread workers (most slides per
+# second, each one slower). The worker count follows from the cores available.
+PROFILES = {"latency": 8, "balanced": 4, "throughput": 1}
+
+RESOURCE_PROFILE = os.environ.get("BENTARA_RESOURCE_PROFILE", "balanced")
+# Explicit threads per worker, overrides the profile (0 = from the profile)
+WORKER_THREADS = int(os.environ.get("BENTARA_WORKER_THREADS", "0"))
+# Pin each inference worker process to its own block of cores (Linux only)
+PIN_CORES = os.environ.get("BENTARA_PIN_CORES", "0") == "1"
+
+
+def available_cores():
+    # Cores this process may run on (respects taskset / container cpusets)
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def cpu_seconds(pid):
+    # user + system CPU time of a process (Linux only, None elsewhere)
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def core_times():
+    # {core: (busy, total)} jiffies from /proc/stat (Linux only, empty elsewhere)
+    times = {}
+    try:
+        with open("/proc/stat") as f:
+            for line in f:
+                name, *values = line.split()
+                if name.startswith("cpu") and name != "cpu":
+                    values = [int(v) for v in values]
+                    idle = values[3] + values[4]  # idle + iowait
+                    times[int(name[3:])] = (sum(values) - idle, sum(values))
+    except (OSError, ValueError):
+        pass
+    return times
+
+
+class WorkerSlot:
+    def __init__(self, index, threads, cores):
+        self.index = index
+        self.threads = threads
+        self.cores = cores
+        self.pid = None
+        self._last = None  # (wall time, cpu seconds) at the previous sample
+
+    def utilisation(self):
+        # Share of this slot's threads kept busy since the previous sample
+        cpu = cpu_seconds(self.pid) if self.pid else None
+        if cpu is None:
+            return None
+        now = time.monotonic()
+        last, self._last = self._last, (now, cpu)
+        if last is None or now <= last[0]:
+            return None
+        return round((cpu - last[1]) / (now - last[0]) / self.threads, 3)
+
+
+# --- INFERENCE RESOURCE MANAGER ---
+# Splits the available cores into one slot per inference worker, each with a fixed
+# thread count (and, with pinning, its own cores), so concurrent slides stop
+# fighting over torch's default all-cores thread pool.
+class ResourceManager:
+    def __init__(self, profile="balanced", workers=0, threads=0, pin=False, cores=None):
+        if profile not in PROFILES:
+            raise ValueError(f"Unknown resource profile '{profile}' (choose from {', '.join(PROFILES)})")
+        self.profile = profile
+        self.cores = cores or available_cores()
+        self.pin = pin and hasattr(os, "sched_setaffinity")
+
+        per_worker = threads or PROFILES[profile]
+        self.workers = workers or max(1, len(self.cores) // per_worker)
+        self.threads = threads or max(1, len(self.cores) // self.workers)
+
+        # Consecutive blocks of cores; with more workers than cores they wrap around
+        self.slots = []
+        for i in range(self.workers):
+            start = (i * self.threads) % len(self.cores)
+            block = [self.cores[(start + j) % len(self.cores)] for j in range(min(self.threads, len(self.cores)))]
+            self.slots.append(WorkerSlot(i, self.threads, block))
+        self.in_process = False
+        self._last_core_times = core_times()
+
+    def apply(self, slot):
+        # Called inside a worker process before any model runs. ONNX Runtime sessions
+        # created afterwards take the same thread count.
+        torch.set_num_threads(slot.threads)
+        if self.pin:
+            os.sched_setaffinity(0, slot.cores)
+
+    def apply_in_process(self):
+        # No worker processes: the job threads of this process are the workers. Each
+        # inference gets its share of threads; utilisation is for the whole process.
+        torch.set_num_threads(self.threads)
+        slot = WorkerSlot(0, len(self.cores), self.cores)
+        slot.pid = os.getpid()
+        self.slots = [slot]
+        self.in_process = True
+
+    def stats(self):
+        now_times = core_times()
+        cores = {}
+        for core in self.cores:
+            if core in now_times and core in self._last_core_times:
+                busy = now_times[core][0] - self._last_core_times[core][0]
+                total = now_times[core][1] - self._last_core_times[core][1]
+                cores[core] = round(busy / total, 3) if total else 0.0
+        self._last_core_times = now_times
+
+        return {
+            "profile": self.profile,
+            "mode": "in-process" if self.in_process else "worker processes",
+            "cores": len(self.cores),
+            "concurrent_inferences": self.workers,
+            "threads_per_inference": self.threads,
+            "pinned": self.pin,
+            "workers": [
+                {"slot": s.index, "pid": s.pid, "threads": s.threads, "cores": s.cores,
+                 "utilisation": s.utilisation()}
+                for s in self.slots
+            ],
+            # Busy fraction of each core since the previous call
+            "core_utilisation": cores
+        }
@@ -0,0 +1,62 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+
+# --- WEIGHTS FINGERPRINT ---
+def model_fingerprint(paths):
+    # Cheap identity for a set of weight files: name, size and mtime of each.
+    # Any retrained or replaced file gives a new fingerprint.
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        stat = os.stat(path)
+        digest.update(f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+    return digest.hexdigest()[:16]
+
+
+# --- LRU RESULT CACHE ---
+# Inference results keyed by (image sha256, model set version, thresholds), so a
+# re-uploaded field image reuses its detections instead of re-running every model.
+class ResultCache:
+    def __init__(self, max_entries=512, version=""):
+        self.max_entries = max_entries
+        self.version = version
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, content_hash, settings):
+        return (content_hash, self.version, settings)
+
+    def set_version(self, version):
+        # New weights make every stored result stale
+        with self._lock:
+            if version != self.version:
+                self._entries.clear()
+                self.version = version
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            # Results computed under an older model version are not worth keeping
+            if key[1] != self.version:
+                return
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "max_entries": self.max_entries,
+                    "hits": self.hits, "misses": self.misses, "version": self.version}
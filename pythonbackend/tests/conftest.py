@@ -0,0 +1,25 @@
+import importlib
+import os
+import sys
+
+import pytest
+from fastapi.testclient import TestClient
+
+# The backend modules import each other by plain name, as when run from pythonbackend/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture(scope="session")
+def main(tmp_path_factory):
+    # main.py opens bentara.db, uploads/ and the token secret relative to the working
+    # directory, so the tests that import it run in a scratch one
+    with pytest.MonkeyPatch.context() as mp:
+        mp.chdir(tmp_path_factory.mktemp("backend"))
+        mp.setenv("BENTARA_INFERENCE_SERVER", "")
+        yield importlib.import_module("main")
+
+
+@pytest.fixture(scope="session")
+def client(main):
+    # No lifespan: nothing here needs the models warmed
+    return TestClient(main.app)
@@ -0,0 +1,169 @@
+import base64
+import hashlib
+import hmac
+import json
+import multiprocessing as mp
+import os
+import time
+
+import pytest
+
+import auth
+from auth import TokenError, check_token_version, create_token, load_secret, verify_token
+
+SECRET = b"test-secret"
+
+
+def b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def sign(signing_input):
+    return b64(hmac.new(SECRET, signing_input.encode(), hashlib.sha256).digest())
+
+
+def segments(token):
+    return token.split(".")
+
+
+def test_round_trip():
+    claims = verify_token(SECRET, create_token(SECRET, 7, "doc", "Consultant"))
+    assert (claims["uid"], claims["sub"], claims["role"]) == (7, "doc", "Consultant")
+    assert claims["exp"] > time.time()
+
+
+def test_tampered_payload():
+    header, payload, signature = segments(create_token(SECRET, 7, "tech", "Lab Technician"))
+    claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+    claims["role"] = "Consultant"
+    forged = b64(json.dumps(claims, separators=(",", ":")).encode())
+    with pytest.raises(TokenError):
+        verify_token(SECRET, f"{header}.{forged}.{signature}")
+
+
+def test_tampered_signature():
+    header, payload, signature = segments(create_token(SECRET, 7, "doc", "Consultant"))
+    flipped = "A" if signature[0] != "A" else "B"
+    with pytest.raises(TokenError):
+        verify_token(SECRET, f"{header}.{payload}.{flipped}{signature[1:]}")
+
+
+def test_wrong_secret():
+    with pytest.raises(TokenError):
+        verify_token(b"other-secret", create_token(SECRET, 7, "doc", "Consultant"))
+
+
+@pytest.mark.parametrize("header", [
+    {"alg": "none", "typ": "JWT"},
+    {"alg": "HS512", "typ": "JWT"},
+    {"alg": "RS256", "typ": "JWT"},
+])
+def test_wrong_alg_header(header):
+    # Re-signed over the new header with the right key: only the header is wrong
+    _, payload, _ = segments(create_token(SECRET, 7, "doc", "Consultant"))
+    signing_input = f"{b64(json.dumps(header, separators=(',', ':')).encode())}.{payload}"
+    with pytest.raises(TokenError):
+        verify_token(SECRET, f"{signing_input}.{sign(signing_input)}")
+    with pytest.raises(TokenError):
+        verify_token(SECRET, f"{signing_input}.")
+
+
+def test_expired():
+    with pytest.raises(TokenError, match="expired"):
+        verify_token(SECRET, create_token(SECRET, 7, "doc", "Consultant", ttl=-1))
+
+
+@pytest.mark.parametrize("token", [
+    "",
+    "doc",  # The old username-as-token format
+    "a.b",
+    "a.b.c.d",
+    "...",
+    "!!!.@@@.###",
+    "eyJhbGciOiJIUzI1NiIsInR5cCI6IkpXVCJ9.e.x",
+    "é.é.é",
+])
+def test_malformed(token):
+    # TokenError is what get_current_user turns into a 401; anything else would be a 500
+    with pytest.raises(TokenError):
+        verify_token(SECRET, token)
+
+
+def test_malformed_claims_signed_with_the_right_key():
+    header = segments(create_token(SECRET, 7, "doc", "Consultant"))[0]
+    for claims in (b"[1, 2]", b"not json", json.dumps({"sub": "doc", "exp": "never"}).encode(), b"{}"):
+        signing_input = f"{header}.{b64(claims)}"
+        with pytest.raises(TokenError):
+            verify_token(SECRET, f"{signing_input}.{sign(signing_input)}")
+
+
+def test_token_version():
+    claims = verify_token(SECRET, create_token(SECRET, 7, "doc", "Consultant", 3))
+    assert claims["ver"] == 3
+    check_token_version(claims, 3)
+    for current in (4, 0, None):  # Password changed since, or the user is gone
+        with pytest.raises(TokenError, match="revoked"):
+            check_token_version(claims, current)
+
+
+def test_token_from_before_versions():
+    claims = verify_token(SECRET, create_token(SECRET, 7, "doc", "Consultant"))
+    del claims["ver"]
+    check_token_version(claims, 0)
+    with pytest.raises(TokenError):
+        check_token_version(claims, 1)
+
+
+# --- load_secret ---
+def test_secret_from_environment_wins(tmp_path):
+    path = tmp_path / "secret"
+    assert load_secret("configured", str(path)) == b"configured"
+    assert not path.exists()
+
+
+def test_secret_generated_once(tmp_path):
+    path = str(tmp_path / "secret")
+    first = load_secret("", path)
+    assert len(first) == 64
+    assert load_secret("", path) == first
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert os.listdir(tmp_path) == ["secret"]  # No temp files left behind
+
+
+def test_secret_race_lost(tmp_path, monkeypatch):
+    # Another worker creates the file between our read attempt and our write: we
+    # must use its secret, not overwrite it with ours
+    path = tmp_path / "secret"
+    real_token_hex = auth.secrets.token_hex
+
+    def competitor_wins(n):
+        if not path.exists():
+            path.write_bytes(b"winner")
+        return real_token_hex(n)
+
+    monkeypatch.setattr(auth.secrets, "token_hex", competitor_wins)
+    assert load_secret("", str(path)) == b"winner"
+    assert path.read_bytes() == b"winner"
+    assert os.listdir(tmp_path) == ["secret"]
+
+
+def read_secret(path, start, results):
+    start.wait()
+    results.put(load_secret("", path))
+
+
+def test_secret_race_between_processes(tmp_path):
+    path = str(tmp_path / "secret")
+    ctx = mp.get_context("fork")
+    start, results = ctx.Event(), ctx.Queue()
+    workers = [ctx.Process(target=read_secret, args=(path, start, results)) for _ in range(8)]
+    for worker in workers:
+        worker.start()
+    start.set()
+    secrets_seen = {results.get(timeout=30) for _ in workers}
+    for worker in workers:
+        worker.join()
+
+    with open(path, "rb") as f:
+        assert secrets_seen == {f.read()}
+    assert b"" not in secrets_seen
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from fusion import greedy_clusters, overlapping_pairs
+
+
+def random_boxes(rng, n, extent=400):
+    # Cells of assorted sizes, crowded enough that many of them overlap
+    xy = rng.uniform(0, extent, size=(n, 2))
+    wh = rng.uniform(5, 60, size=(n, 2))
+    return np.hstack([xy, xy + wh]).astype(np.float32)
+
+
+def brute_force_iou(xyxy):
+    a, b = xyxy[:, None, :], xyxy[None, :, :]
+    inter_w = (np.minimum(a[..., 2], b[..., 2]) - np.maximum(a[..., 0], b[..., 0])).clip(0)
+    inter_h = (np.minimum(a[..., 3], b[..., 3]) - np.maximum(a[..., 1], b[..., 1])).clip(0)
+    inter = inter_w * inter_h
+    area = (xyxy[:, 2] - xyxy[:, 0]) * (xyxy[:, 3] - xyxy[:, 1])
+    return inter / (area[:, None] + area[None, :] - inter + 1e-9)
+
+
+def brute_force_pairs(xyxy, iou_threshold):
+    i, j = np.nonzero(np.triu(brute_force_iou(xyxy) > iou_threshold, k=1))
+    return set(zip(i.tolist(), j.tolist()))
+
+
+def brute_force_clusters(xyxy, confs, iou_threshold):
+    # The most confident unassigned box takes every unassigned box it overlaps, repeat
+    overlaps = brute_force_iou(xyxy) > iou_threshold
+    cluster = np.full(len(xyxy), -1)
+    for seed in np.argsort(-confs, kind="stable"):
+        if cluster[seed] >= 0:
+            continue
+        cluster[seed] = seed
+        cluster[(cluster < 0) & overlaps[seed]] = seed
+    return cluster
+
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("block", [7, 1024])
+def test_overlapping_pairs_match_brute_force(seed, block):
+    rng = np.random.default_rng(seed)
+    xyxy = random_boxes(rng, int(rng.integers(1, 300)))
+    for iou_threshold in (0.1, 0.55, 0.9):
+        i, j = overlapping_pairs(xyxy, iou_threshold, block=block)
+        found = [(min(a, b), max(a, b)) for a, b in zip(i.tolist(), j.tolist())]
+        assert len(found) == len(set(found))  # Each pair once
+        assert set(found) == brute_force_pairs(xyxy, iou_threshold)
+
+
+def test_overlapping_pairs_identical_boxes():
+    xyxy = np.array([[10, 10, 50, 50]] * 4 + [[200, 200, 220, 220]], dtype=np.float32)
+    i, j = overlapping_pairs(xyxy, 0.55)
+    assert {(min(a, b), max(a, b)) for a, b in zip(i.tolist(), j.tolist())} == brute_force_pairs(xyxy, 0.55)
+
+
+@pytest.mark.parametrize("seed", range(30))
+def test_greedy_clusters_match_brute_force(seed):
+    rng = np.random.default_rng(seed)
+    n = int(rng.integers(1, 300))
+    xyxy = random_boxes(rng, n, extent=int(rng.choice([100, 400])))
+    confs = rng.permutation(n).astype(np.float32) / n  # Distinct, so the order is unambiguous
+    for iou_threshold in (0.1, 0.3, 0.55):
+        i, j = overlapping_pairs(xyxy, iou_threshold)
+        cluster = greedy_clusters(confs, i, j)
+        np.testing.assert_array_equal(cluster, brute_force_clusters(xyxy, confs, iou_threshold))
+
+
+def test_greedy_clusters_chain():
+    # b overlaps a and c, a and c don't overlap: a takes b, so c starts its own cluster
+    confs = np.array([0.9, 0.8, 0.7], dtype=np.float32)
+    cluster = greedy_clusters(confs, np.array([0, 1]), np.array([1, 2]))
+    assert cluster.tolist() == [0, 0, 2]
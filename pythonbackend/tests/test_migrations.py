@@ -0,0 +1,140 @@
+import json
+import random
+import sqlite3
+
+import pytest
+
+from migrations import (DASHBOARD_COUNTS_SQL, MIGRATIONS, check_query_plans, migrate, reconcile_dashboard_stats,
+                        schema_version)
+
+LEGACY_BOXES = [
+    {"label": "Neutrophil", "score": "87%", "x": 10.0, "y": 20.0, "w": 5.0, "h": 6.0},
+    {"label": "RBC", "score": "42.5%", "x": 50.0, "y": 60.0, "w": 3.0, "h": 3.0},
+    {"label": "Neutrophil", "score": "n/a", "x": 1.0, "y": 2.0, "w": 3.0, "h": 4.0},
+    {"score": "99%"},  # No label: skipped
+    "not a box"
+]
+
+
+def baseline_database(path):
+    # A database created before versioned migrations: baseline tables, user_version 0
+    conn = sqlite3.connect(path)
+    for sql in MIGRATIONS[0][2]:
+        conn.execute(sql)
+    conn.execute("INSERT INTO users (username, password, role) VALUES ('doc', 'x', 'Consultant')")
+    conn.executemany("INSERT INTO patients (name, mrn, nhs_number, dob, gender) VALUES (?, ?, '1', '2000', 'F')",
+                     [("A", "M1"), ("B", "M2")])
+    reports = [
+        (1, "Pending", "Acute Myeloid Leukemia", json.dumps(LEGACY_BOXES)),
+        (1, "Authorized", "Normal", json.dumps(LEGACY_BOXES[1:2])),
+        (2, "Pending", "Normal", "not json"),
+        (2, "Pending", "Acute Lymphoblastic Leukemia", None)
+    ]
+    conn.executemany("INSERT INTO reports (patient_id, status, diagnosis, confidence, detections) "
+                     "VALUES (?, ?, ?, '87%', ?)", reports)
+    conn.commit()
+    return conn
+
+
+def dashboard_stats(conn):
+    return conn.execute("SELECT total_patients, pending_reports, critical_alerts FROM dashboard_stats").fetchone()
+
+
+@pytest.fixture
+def legacy(tmp_path):
+    conn = baseline_database(str(tmp_path / "bentara.db"))
+    yield conn
+    conn.close()
+
+
+def test_migrates_baseline_database(legacy):
+    blobs = legacy.execute("SELECT id, detections FROM reports ORDER BY id").fetchall()
+
+    assert migrate(legacy) == [version for version, _, _ in MIGRATIONS]
+    assert schema_version(legacy) == MIGRATIONS[-1][0]
+    assert migrate(legacy) == []
+    assert check_query_plans(legacy) == {}
+
+    # The legacy JSON is left untouched
+    assert legacy.execute("SELECT id, detections FROM reports ORDER BY id").fetchall() == blobs
+
+
+def test_detections_normalized(legacy):
+    migrate(legacy)
+    rows = legacy.execute("""
+        SELECT d.report_id, c.name, d.x, d.y, d.w, d.h, d.confidence, d.model_version
+        FROM detections d JOIN cell_classes c ON d.class_id = c.id ORDER BY d.id
+    """).fetchall()
+    assert rows == [
+        (1, "Neutrophil", 10.0, 20.0, 5.0, 6.0, pytest.approx(0.87), None),
+        (1, "RBC", 50.0, 60.0, 3.0, 3.0, pytest.approx(0.425), None),
+        (1, "Neutrophil", 1.0, 2.0, 3.0, 4.0, 0.0, None),
+        (2, "RBC", 50.0, 60.0, 3.0, 3.0, pytest.approx(0.425), None)
+    ]
+    assert legacy.execute("SELECT COUNT(*) FROM cell_classes").fetchone()[0] == 2
+
+
+def test_existing_model_versions_column(legacy):
+    # Some databases added the column by hand before migration 2 existed
+    legacy.execute("ALTER TABLE reports ADD COLUMN model_versions TEXT")
+    legacy.commit()
+    migrate(legacy)
+    columns = [row[1] for row in legacy.execute("PRAGMA table_info(reports)")]
+    assert columns.count("model_versions") == 1
+
+
+def test_failed_migration_rolls_back(legacy, monkeypatch):
+    def broken(conn):
+        conn.execute("CREATE TABLE half_done (id INTEGER)")
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr("migrations.MIGRATIONS", MIGRATIONS[:3] + [(4, "broken", broken)])
+    with pytest.raises(RuntimeError):
+        migrate(legacy)
+    assert schema_version(legacy) == 3
+    assert legacy.execute("SELECT name FROM sqlite_master WHERE name = 'half_done'").fetchone() is None
+
+
+def test_dashboard_counters_match_recount(legacy):
+    migrate(legacy)
+    assert dashboard_stats(legacy) == legacy.execute(DASHBOARD_COUNTS_SQL).fetchone() == (2, 3, 2)
+
+    rng = random.Random(0)
+    statuses = ["Pending", "Authorized", "Analysing", "Failed", None]
+    diagnoses = ["Normal", "Acute Myeloid Leukemia", "Chronic Lymphocytic Leukemia", None]
+    for step in range(300):
+        report_ids = [row[0] for row in legacy.execute("SELECT id FROM reports")]
+        action = rng.choice(["patient", "insert", "update", "update", "delete", "delete patient"])
+        if action == "patient":
+            legacy.execute("INSERT INTO patients (name, mrn, nhs_number, dob, gender) VALUES ('P', ?, '1', '2000', 'F')",
+                           (f"R{step}",))
+        elif action == "delete patient":
+            legacy.execute("DELETE FROM patients WHERE id = (SELECT MAX(id) FROM patients)")
+        elif action == "insert" or not report_ids:
+            legacy.execute("INSERT INTO reports (patient_id, status, diagnosis) VALUES (1, ?, ?)",
+                           (rng.choice(statuses), rng.choice(diagnoses)))
+        elif action == "update":
+            column = rng.choice(["status", "diagnosis", "both", "notes"])
+            status, diagnosis = rng.choice(statuses), rng.choice(diagnoses)
+            if column == "both":
+                legacy.execute("UPDATE reports SET status = ?, diagnosis = ? WHERE id = ?",
+                               (status, diagnosis, rng.choice(report_ids)))
+            elif column == "notes":
+                legacy.execute("UPDATE reports SET notes = 'x' WHERE id = ?", (rng.choice(report_ids),))
+            else:
+                value = status if column == "status" else diagnosis
+                legacy.execute(f"UPDATE reports SET {column} = ? WHERE id = ?", (value, rng.choice(report_ids)))
+        else:
+            legacy.execute("DELETE FROM reports WHERE id = ?", (rng.choice(report_ids),))
+        legacy.commit()
+        assert dashboard_stats(legacy) == legacy.execute(DASHBOARD_COUNTS_SQL).fetchone(), action
+
+    assert reconcile_dashboard_stats(legacy) == {}
+
+
+def test_reconcile_reports_drift(legacy):
+    migrate(legacy)
+    legacy.execute("UPDATE dashboard_stats SET pending_reports = pending_reports + 4, total_patients = 0")
+    legacy.commit()
+    assert reconcile_dashboard_stats(legacy) == {"total_patients": -2, "pending_reports": 4}
+    assert dashboard_stats(legacy) == (2, 3, 2)
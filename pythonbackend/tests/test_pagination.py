@@ -0,0 +1,124 @@
+import base64
+import json
+
+import pytest
+
+DATES = ["2024-03-01 09:00:00", "2024-03-02 09:00:00", "2024-03-02 09:00:00", "2024-03-03 09:00:00"]
+
+
+@pytest.fixture(scope="module", autouse=True)
+def rows(main):
+    # Many samples share a timestamp, so paging has to break ties on the id
+    conn = main.db.connect()
+    conn.executemany("INSERT INTO research_samples (sample_type, image_url, annotations, date) "
+                     "VALUES (?, 'x.jpg', '[]', ?)",
+                     [("Smear" if n % 3 else "Marrow", DATES[n % len(DATES)]) for n in range(40)])
+    conn.executemany("INSERT INTO patients (name, mrn, nhs_number, dob, gender) VALUES (?, ?, '1', '2000', 'F')",
+                     [(f"P{n}", f"M{n}") for n in range(11)])
+    conn.commit()
+
+
+def cursor_of(values):
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def all_pages(client, url, limit):
+    items, cursor, pages = [], None, 0
+    while True:
+        params = {"limit": limit, **({"cursor": cursor} if cursor else {})}
+        res = client.get(url, params=params)
+        assert res.status_code == 200
+        assert len(res.json()) <= limit
+        items += res.json()
+        pages += 1
+        cursor = res.headers.get("X-Next-Cursor")
+        if not cursor:
+            return items, pages
+
+
+@pytest.mark.parametrize("limit", [1, 3, 7, 40, 100])
+def test_gallery_pages_through_shared_timestamps(client, limit):
+    everything = client.get("/research/gallery").json()
+    assert len(everything) == 40
+    expected = sorted(everything, key=lambda item: (item["date"], item["id"]), reverse=True)
+    assert everything == expected
+
+    items, pages = all_pages(client, "/research/gallery", limit)
+    assert [item["id"] for item in items] == [item["id"] for item in expected]  # No gaps, no repeats
+    assert pages == max(1, -(-40 // limit))
+
+
+def test_gallery_pages_within_a_type(client):
+    expected = client.get("/research/gallery", params={"sample_type": "Marrow"}).json()
+    items, cursor = [], None
+    while True:
+        params = {"sample_type": "Marrow", "limit": 2, **({"cursor": cursor} if cursor else {})}
+        res = client.get("/research/gallery", params=params)
+        items += res.json()
+        cursor = res.headers.get("X-Next-Cursor")
+        if not cursor:
+            break
+    assert items == expected
+    assert {item["type"] for item in items} == {"Marrow"}
+
+
+def test_patients_pages(client):
+    items, pages = all_pages(client, "/patients", 4)
+    assert [item["mrn"] for item in items] == [f"M{n}" for n in reversed(range(11))]
+    assert pages == 3
+
+
+def test_unpaged_request_gets_every_row(client):
+    res = client.get("/patients")
+    assert len(res.json()) == 11
+    assert "X-Next-Cursor" not in res.headers
+
+
+def test_limit_is_clamped(client, main, monkeypatch):
+    assert len(client.get("/patients", params={"limit": -3}).json()) == 1
+    monkeypatch.setattr(main, "PAGE_SIZE", 2)
+    assert len(client.get("/patients", params={"limit": 0}).json()) == 2  # 0 means the default
+    monkeypatch.setattr(main, "MAX_PAGE_SIZE", 5)
+    res = client.get("/patients", params={"limit": 1000})
+    assert len(res.json()) == 5
+    assert "X-Next-Cursor" in res.headers
+
+
+def test_first_page_size_when_only_a_cursor_is_given(client, main, monkeypatch):
+    monkeypatch.setattr(main, "PAGE_SIZE", 2)
+    res = client.get("/patients", params={"cursor": cursor_of([5])})
+    assert [item["id"] for item in res.json()] == [4, 3]
+
+
+@pytest.mark.parametrize("url,cursor", [
+    ("/research/gallery", "not a cursor!"),
+    ("/research/gallery", "%%%"),
+    ("/research/gallery", base64.urlsafe_b64encode(b"\xff\xfe").decode()),
+    ("/research/gallery", cursor_of({"date": "2024", "id": 1})),
+    ("/research/gallery", cursor_of(["2024-03-02 09:00:00"])),  # Gallery cursors are (date, id)
+    ("/research/gallery", cursor_of(["2024-03-02 09:00:00", 3, 4])),
+    ("/patients", cursor_of([])),
+    ("/patients", cursor_of(["2024-03-02 09:00:00", 3]))
+])
+def test_bad_cursor(client, url, cursor):
+    res = client.get(url, params={"cursor": cursor})
+    assert res.status_code == 400
+    assert res.json()["detail"] == "Invalid cursor"
+
+
+def test_fields(client):
+    res = client.get("/research/gallery", params={"fields": " id, type ", "limit": 2})
+    assert res.status_code == 200
+    assert all(list(item) == ["id", "type"] for item in res.json())
+
+
+@pytest.mark.parametrize("url,fields", [
+    ("/research/gallery", "id,secret"),
+    ("/research/gallery", "password"),
+    ("/patients", "id,type")  # A gallery field, not a patient one
+])
+def test_unknown_field(client, url, fields):
+    res = client.get(url, params={"fields": fields})
+    assert res.status_code == 400
+    assert res.json()["detail"].startswith("Unknown fields: ")
+    assert fields.split(",")[-1] in res.json()["detail"]
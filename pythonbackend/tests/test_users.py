@@ -0,0 +1,86 @@
+import pytest
+
+from auth import create_token
+
+
+def register(client, username, password="first-password", role="Consultant"):
+    res = client.post("/register", json={"username": username, "password": password, "full_name": username,
+                                         "email": f"{username}@example.org", "role": role, "license_id": username})
+    assert res.status_code == 200
+
+
+def login(client, username, password):
+    res = client.post("/token", data={"username": username, "password": password})
+    assert res.status_code == 200
+    return res.json()["access_token"]
+
+
+def bearer(token):
+    return {"Authorization": f"Bearer {token}"}
+
+
+def change_password(client, token, current, new):
+    return client.post("/users/change-password", headers=bearer(token),
+                       json={"current_password": current, "new_password": new})
+
+
+def test_password_change_revokes_older_tokens(client):
+    register(client, "alice")
+    laptop = login(client, "alice", "first-password")
+    phone = login(client, "alice", "first-password")
+    assert client.get("/users/me", headers=bearer(phone)).json()["username"] == "alice"
+
+    res = change_password(client, laptop, "first-password", "second-password")
+    assert res.status_code == 200
+    fresh = res.json()["access_token"]
+
+    for old in (laptop, phone):
+        res = client.get("/users/me", headers=bearer(old))
+        assert res.status_code == 401
+        assert res.json()["detail"] == "Token revoked"
+        # Endpoints that only need the token refuse it too
+        assert client.get("/jobs/unknown", headers=bearer(old)).status_code == 401
+
+    assert client.get("/users/me", headers=bearer(fresh)).status_code == 200
+    assert "token_version" not in client.get("/users/me", headers=bearer(fresh)).json()
+    assert client.get("/users/me", headers=bearer(login(client, "alice", "second-password"))).status_code == 200
+
+    # And again: the token that made the first change is revoked by the second
+    newest = change_password(client, fresh, "second-password", "third-password").json()["access_token"]
+    assert client.get("/users/me", headers=bearer(fresh)).status_code == 401
+    assert client.get("/users/me", headers=bearer(newest)).status_code == 200
+
+
+def test_wrong_current_password_keeps_tokens(client):
+    register(client, "bob")
+    token = login(client, "bob", "first-password")
+    res = change_password(client, token, "not-it", "second-password")
+    assert res.status_code == 400
+    assert client.get("/users/me", headers=bearer(token)).status_code == 200
+
+
+def test_profile_update_token_stays_valid(client):
+    register(client, "carol", role="Lab Technician")
+    token = login(client, "carol", "first-password")
+    change_password(client, token, "first-password", "second-password")
+    token = login(client, "carol", "second-password")
+
+    res = client.put("/users/update", headers=bearer(token),
+                     json={"full_name": "Carol", "email": "c@example.org", "role": "Consultant", "license_id": "c"})
+    updated = res.json()["access_token"]
+    assert client.get("/users/me", headers=bearer(updated)).json()["role"] == "Consultant"
+    assert client.get("/users/me", headers=bearer(token)).status_code == 200
+
+
+@pytest.mark.parametrize("username", ["nobody", "erin"])
+def test_deleted_or_unknown_user(client, main, username):
+    if username == "erin":
+        register(client, "erin")
+        token = login(client, "erin", "first-password")
+        conn = main.db.connect()
+        conn.execute("DELETE FROM users WHERE username = 'erin'")
+        conn.commit()
+        main.user_cache.invalidate("erin")
+    else:
+        token = create_token(main.TOKEN_KEY, 999, username, "Consultant")
+    assert client.get("/users/me", headers=bearer(token)).status_code == 401
@@ -141,7 +141,7 @@ export default function PatientDetailsPage() {
                                 {report.diagnosis}
                               </h4>
                               <span className={`text-[10px] font-bold px-2 py-1 rounded-full uppercase tracking-wide flex items-center gap-1 ${
-                                  report.status === 'Authorized' ? 'bg-emerald-100 text-emerald-600' : 'bg-amber-100 text-amber-600'
+                                  report.status === 'Authorized' ? 'bg-emerald-100 text-emerald-600' : report.status === 'Failed' ? 'bg-red-100 text-red-600' : 'bg-amber-100 text-amber-600'
                               }`}>
                                             {report.status === 'Authorized' ? <CheckCircle size={10}/> : <Clock size={10}/>}
                                 {report.status}
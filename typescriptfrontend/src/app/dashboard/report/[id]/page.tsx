@@ -56,6 +56,13 @@ export default function ReportPage() {
         setManualZoom(Math.round(zoom * 100).toString());
     }, [zoom]);
 
+    // Reports are created while the slide is still being analysed: reload until it finishes
+    useEffect(() => {
+        if (data?.status !== "Analysing") return;
+        const timer = setTimeout(fetchReport, 3000);
+        return () => clearTimeout(timer);
+    }, [data]);
+
     const fetchReport = () => {
         const token = localStorage.getItem("access_token");
         fetch(`http://localhost:8000/reports/${params.id}`, {
@@ -99,7 +106,11 @@ export default function ReportPage() {
                 headers: { 'Authorization': `Bearer ${token}` }
             });
             if (res.ok) fetchReport();
-            else alert("Authorization Failed: Permission denied.");
+            else {
+                const body = await res.json().catch(() => ({}));
+                alert(`Authorization Failed: ${body.detail || "Permission denied."}`);
+                fetchReport();
+            }
         } catch (err) { alert("Network Error"); }
         finally { setIsSigningOff(false); }
     };
@@ -188,7 +199,7 @@ export default function ReportPage() {
 
             {/* REPORT PAPER */}
             <div className="max-w-4xl mx-auto bg-white p-12 min-h-[1123px] shadow-2xl print:shadow-none print:min-h-0 relative">
-                {data.status === "Pending" && <div className="absolute top-1/2 left-1/2 -translate-x-1/2 -translate-y-1/2 -rotate-45 text-red-100 font-black text-9xl pointer-events-none border-4 border-red-100 p-10 opacity-50">DRAFT</div>}
+                {data.status !== "Authorized" && <div className="absolute top-1/2 left-1/2 -translate-x-1/2 -translate-y-1/2 -rotate-45 text-red-100 font-black text-9xl pointer-events-none border-4 border-red-100 p-10 opacity-50">DRAFT</div>}
 
                 {/* HEADER */}
                 <div className="flex justify-between items-start border-b-2 border-slate-900 pb-8 mb-8 relative z-10">
@@ -199,7 +210,7 @@ export default function ReportPage() {
                     <div className="text-right">
                         <h2 className="text-xl font-bold text-slate-900">DIAGNOSTIC REPORT</h2>
                         <p className="font-mono text-sm text-slate-500">REF: #{data.id.toString().padStart(6, '0')}</p>
-                        <div className={`mt-2 inline-flex items-center gap-1 px-2 py-1 rounded text-xs font-bold uppercase ${data.status === 'Authorized' ? 'bg-emerald-100 text-emerald-700' : 'bg-amber-100 text-amber-700'}`}>
+                        <div className={`mt-2 inline-flex items-center gap-1 px-2 py-1 rounded text-xs font-bold uppercase ${data.status === 'Authorized' ? 'bg-emerald-100 text-emerald-700' : data.status === 'Failed' ? 'bg-red-100 text-red-700' : 'bg-amber-100 text-amber-700'}`}>
                             {data.status}
                         </div>
                     </div>
@@ -322,6 +333,10 @@ export default function ReportPage() {
                             </button>
                         ) : <span className="bg-slate-100 px-3 py-2 rounded font-bold text-slate-400 text-sm">Consultant Access Required</span>}
                     </div>
+                ) : data.status === "Analysing" ? (
+                    <div className="bg-white p-6 rounded-xl border border-blue-100 shadow-lg flex items-center gap-4 text-blue-800"><Loader2 className="animate-spin" /> <div><h3 className="font-bold">Analysis in Progress</h3><p className="text-sm text-slate-500">The slide is still being analysed. This page updates when it is ready for review.</p></div></div>
+                ) : data.status === "Failed" ? (
+                    <div className="bg-red-50 p-6 rounded-xl border border-red-100 flex items-center gap-4 text-red-800"><AlertCircle /> <div><p className="font-bold">Analysis Failed</p><p className="text-sm">The slide could not be analysed. Please upload it again.</p></div></div>
                 ) : <div className="bg-emerald-50 p-6 rounded-xl border border-emerald-100 flex items-center gap-4 text-emerald-800"><CheckCircle /> <div><p className="font-bold">Authorized</p></div></div>}
             </div>
 
@@ -130,6 +130,9 @@ export default function SettingsPage() {
             });
 
             if (!res.ok) throw new Error("Failed to update.");
+            // The new token carries the new role
+            const data = await res.json();
+            if (data.access_token) localStorage.setItem("access_token", data.access_token);
             localStorage.setItem("user_details", JSON.stringify({ ...payload }));
             setMessage({ type: 'success', text: "Profile details updated successfully." });
         } catch (err) {
@@ -173,6 +176,8 @@ export default function SettingsPage() {
             const data = await res.json();
 
             if (!res.ok) throw new Error(data.detail || "Failed to change password.");
+            // Every token issued before the change is revoked, this one included
+            localStorage.setItem("access_token", data.access_token);
 
             setMessage({ type: 'success', text: "Password changed successfully." });
             setPassData({ currentPassword: "", newPassword: "", confirmPassword: "" }); // Reset form
@@ -33,6 +33,9 @@ export default function PatientUploadPage() {
     const [uploading, setUploading] = useState(false);
     const [error, setError] = useState("");
     const [successReportId, setSuccessReportId] = useState<number | null>(null);
+    // Analysis runs in the background after the upload: poll its job until it finishes
+    const [jobId, setJobId] = useState<string | null>(null);
+    const [jobProgress, setJobProgress] = useState(0);
 
     useEffect(() => {
         fetch(`http://localhost:8000/patients/${params.id}`)
@@ -41,6 +44,35 @@ export default function PatientUploadPage() {
             .catch(() => setLoadingPatient(false));
     }, [params.id]);
 
+    useEffect(() => {
+        if (!jobId || successReportId) return;
+        const token = localStorage.getItem("access_token");
+        const timer = setInterval(async () => {
+            try {
+                const res = await fetch(`http://localhost:8000/jobs/${jobId}`, {
+                    headers: { 'Authorization': `Bearer ${token}` }
+                });
+                const job = await res.json();
+                if (!res.ok) throw new Error(job.detail || "Could not check the analysis");
+                setJobProgress(job.progress || 0);
+                if (job.status === "done") {
+                    setSuccessReportId(job.report_id);
+                } else if (job.status === "failed") {
+                    throw new Error(`Analysis failed: ${job.error || "unknown error"}`);
+                }
+            } catch (err: any) {
+                setError(err.message);
+                setJobId(null);
+                setUploading(false);
+            }
+        }, 2000);
+        return () => clearInterval(timer);
+    }, [jobId, successReportId]);
+
+    useEffect(() => {
+        if (successReportId) setUploading(false);
+    }, [successReportId]);
+
     const handleUpload = async (e: React.FormEvent) => {
         e.preventDefault();
         if (!file || !patient) return;
@@ -67,12 +99,12 @@ export default function PatientUploadPage() {
             const data = await res.json();
             if (!res.ok) throw new Error(data.detail || "Upload failed");
 
-            // SUCCESS: Show success screen
-            setSuccessReportId(data.report_id);
+            // Cached results come back straight away; otherwise wait for the job
+            if (data.job_id) setJobId(data.job_id);
+            else setSuccessReportId(data.report_id);
 
         } catch (err: any) {
             setError(err.message);
-        } finally {
             setUploading(false);
         }
     };
@@ -189,7 +221,7 @@ export default function PatientUploadPage() {
 
                     <button disabled={!file || uploading} className="w-full bg-blue-600 text-white py-4 rounded-xl font-bold hover:bg-blue-700 shadow-lg shadow-blue-200 disabled:opacity-50 flex justify-center items-center gap-2">
                         {uploading ? <Loader2 className="animate-spin" /> : <UploadCloud />}
-                        {uploading ? "Analyzing..." : "Run Analysis & Generate Report"}
+                        {!uploading ? "Run Analysis & Generate Report" : jobId ? `Analyzing... ${Math.round(jobProgress * 100)}%` : "Uploading..."}
                     </button>
                 </form>
             </div>